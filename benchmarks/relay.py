@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Measures the throughput of the relay, using in-memory stand-ins for
+ZooKeeper, PostgreSQL (with PgQ), and the destination handler.
+
+Since there are no external services involved, this measures only the
+overhead of the relay itself (batch retrieval, event decoding, publishing, and
+worker coordination.) The shape of the batches that are relayed can be
+controlled with the command line options::
+
+    python benchmarks/relay.py --batches 1000 --events-per-batch 100 --event-size 250
+
+By default, each tick is created when the relay has consumed the previous one.
+The ``--backlog`` option creates all of the ticks before the relay is started
+instead, which can be combined with ``--adaptive-batching`` to measure the
+throughput of a relay that is catching up.
+
+"""
+import itertools
+import logging
+import time
+
+import click
+
+from pgshovel.administration import initialize_cluster
+from pgshovel.cluster import Cluster
+from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.relay.relay import (
+    AdaptiveBatching,
+    Relay,
+)
+from pgshovel.testing import (
+    CountingHandler,
+    FakeServer,
+    FakeZooKeeper,
+    generate_events,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+SET_NAME = 'benchmark'
+
+
+@click.command(help="Measures relay throughput using in-memory service stand-ins.")
+@click.option('--batches', type=int, default=1000, help="Number of batches to relay.")
+@click.option('--events-per-batch', type=int, default=100, help="Number of events within each batch.")
+@click.option('--event-size', type=int, default=100, help="Size of the padding column within each event (in bytes.)")
+@click.option('--tables', type=int, default=1, help="Number of distinct tables that events are generated for.")
+@click.option('--timeout', type=float, default=600, help="Maximum amount of time to wait for all batches to be relayed.")
+@click.option('--backlog/--no-backlog', default=False, help="Create all ticks before starting the relay.")
+@click.option('--adaptive-batching/--no-adaptive-batching', default=False, help="Combine ticks into larger batches when the relay is behind.")
+def main(batches, events_per_batch, event_size, tables, timeout, backlog, adaptive_batching):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    cluster = Cluster('benchmark', FakeZooKeeper())
+    cluster.start()
+    initialize_cluster(cluster)
+
+    # The events are generated ahead of time to avoid measuring the cost of
+    # creating the pickled payloads.
+    events = list(generate_events(
+        events_per_batch,
+        size=event_size,
+        tables=[('public', 'table_%s' % (i,)) for i in xrange(tables)],
+    ))
+
+    server = FakeServer()
+    if backlog:
+        queue = server.create_queue(cluster.get_queue_name(SET_NAME))
+
+        # The consumer is registered before the ticks are created, so that the
+        # relay starts consuming from the beginning of the backlog.
+        state = {}
+        server.register_consumer(state, queue.name, 'benchmark')
+        server.commit(state)
+        for _ in xrange(batches):
+            queue.tick(events)
+    else:
+        server.create_queue(cluster.get_queue_name(SET_NAME), source=itertools.repeat(events, batches))
+
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = 'fake://'
+    cluster.zookeeper.create(
+        cluster.get_set_path(SET_NAME),
+        BinaryCodec(ReplicationSetConfiguration).encode(configuration),
+    )
+
+    handler = CountingHandler()
+    relay = Relay(
+        cluster,
+        SET_NAME,
+        'benchmark',
+        handler,
+        database_factory=server.get_database,
+        batching=AdaptiveBatching() if adaptive_batching else None,
+    )
+
+    start = time.time()
+    relay.start()
+    # Batches may be combined, so completion is measured by mutations.
+    completed = handler.wait(mutations=batches * events_per_batch, timeout=timeout)
+    elapsed = time.time() - start
+
+    relay.stop_async()
+    relay.result(10)
+
+    if not completed:
+        raise click.ClickException('Timed out after relaying %s of %s mutations.' % (handler.mutations, batches * events_per_batch))
+
+    click.echo('relayed %s batches (%s mutations, %s messages) in %.3f seconds' % (
+        handler.commits,
+        handler.mutations,
+        handler.messages,
+        elapsed,
+    ))
+    click.echo('%.2f batches/second, %.2f mutations/second, %.2f messages/second' % (
+        handler.commits / elapsed,
+        handler.mutations / elapsed,
+        handler.messages / elapsed,
+    ))
+
+
+if __name__ == '__main__':
+    main()
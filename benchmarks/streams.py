@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+Compares the throughput of the consumer stream validation pipelines: the
+chained ``sequences.validate``, ``states.validate`` and ``batches.batched``
+pipeline, and the single pass ``validation.validated_batches`` validator.
+
+By default, the messages are generated (and decoded) ahead of time, so only
+the cost of validation and batching is measured::
+
+    python benchmarks/streams.py --batches 1000 --mutations-per-batch 100
+
+The cost of decoding can also be included, either fully decoding each message
+or lazily decoding only the message envelopes (with ``--decode lazy``.)
+
+"""
+import itertools
+import time
+import uuid
+
+import click
+
+from pgshovel.interfaces.common_pb2 import (
+    BatchIdentifier,
+    Column,
+    Row,
+    Snapshot,
+    Tick,
+    Timestamp,
+)
+from pgshovel.interfaces.streams_pb2 import (
+    BeginOperation,
+    Message,
+    MutationOperation,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.streams.lazy import LazyMessage
+from pgshovel.streams.publisher import Publisher
+from pgshovel.streams.validation import validated_batches
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+def generate_messages(batches, mutations, columns, duplicates):
+    """
+    Generates a list of decoded messages, containing the requested number of
+    batches. Every ``duplicates`` messages, the previous message is repeated.
+    """
+    codec = BinaryCodec(Message)
+    messages = []
+
+    publisher = Publisher(lambda published: messages.extend(codec.decode(codec.encode(message)) for message in published))
+
+    timestamp = Timestamp(seconds=0, nanos=0)
+    node = uuid.uuid1().bytes
+    for id in xrange(1, batches + 1):
+        begin = BeginOperation(
+            start=Tick(id=id, snapshot=Snapshot(min=id, max=id), timestamp=timestamp),
+            end=Tick(id=id + 1, snapshot=Snapshot(min=id + 1, max=id + 1), timestamp=timestamp),
+        )
+        with publisher.batch(BatchIdentifier(id=id, node=node), begin) as publish:
+            for i in xrange(mutations):
+                publish(
+                    MutationOperation(
+                        id=i,
+                        schema='public',
+                        table='example',
+                        operation=MutationOperation.INSERT,
+                        identity_columns=['id'],
+                        new=Row(
+                            columns=[Column(name='id', integer64=i)] +
+                                [Column(name='column_%s' % (c,), string='x' * 20) for c in xrange(columns - 1)],
+                        ),
+                        timestamp=timestamp,
+                        transaction=id,
+                    ),
+                )
+
+    if duplicates:
+        messages = [
+            message
+            for i, original in enumerate(messages)
+            for message in ((original, codec.decode(codec.encode(original))) if i % duplicates == 0 else (original,))
+        ]
+
+    return messages
+
+
+def chained(messages):
+    return batched(states.validate(sequences.validate(messages)))
+
+
+def consume(batches):
+    count = 0
+    for batch, mutations in batches:
+        for mutation in mutations:
+            count += 1
+    return count
+
+
+@click.command(help="Compares the throughput of the chained and single pass stream validators.")
+@click.option('--batches', type=int, default=1000, help="Number of batches in the stream.")
+@click.option('--mutations-per-batch', type=int, default=100, help="Number of mutations within each batch.")
+@click.option('--columns', type=int, default=10, help="Number of columns within each mutated row.")
+@click.option('--duplicates', type=int, default=0, help="Repeat every Nth message, as a publisher retry would (0 disables.)")
+@click.option('--decode', type=click.Choice(('none', 'eager', 'lazy')), default='none', help="How messages are decoded (none measures only validation.)")
+@click.option('--repeat', type=int, default=3, help="Number of times to repeat each measurement (the best result is reported.)")
+def main(batches, mutations_per_batch, columns, duplicates, decode, repeat):
+    messages = generate_messages(batches, mutations_per_batch, columns, duplicates)
+    click.echo('validating %s messages (%s batches, %s mutations per batch)' % (len(messages), batches, mutations_per_batch))
+
+    if decode == 'none':
+        source = lambda: messages
+    else:
+        codec = BinaryCodec(Message if decode == 'eager' else LazyMessage)
+        payloads = [message.SerializeToString() for message in messages]
+        source = lambda: itertools.imap(codec.decode, payloads)
+
+    results = {}
+    for name, pipeline in (('chained', chained), ('fused', validated_batches)):
+        timings = []
+        for _ in xrange(repeat):
+            start = time.time()
+            count = consume(pipeline(source()))
+            timings.append(time.time() - start)
+
+        assert count == batches * mutations_per_batch
+        results[name] = elapsed = min(timings)
+        click.echo('%-8s %.3f seconds, %.2f messages/second' % (name, elapsed, len(messages) / elapsed))
+
+    click.echo('speedup: %.2fx' % (results['chained'] / results['fused'],))
+
+
+if __name__ == '__main__':
+    main()
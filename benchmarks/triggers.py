@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Measures the write amplification caused by the pgshovel log trigger.
+
+pgbench is run against the provided database once for each capture variant
+(including a baseline variant without any triggers installed), reinitializing
+the pgbench tables between runs. The throughput (TPS), WAL volume per
+transaction, and growth of the PgQ event table is reported for each variant.
+
+By default, the replication set configuration is generated by
+``example/set.py``, and compared against a baseline run with no triggers and
+a run that only monitors the key columns of each table. Alternative variants
+can be provided with the ``--variant`` option, using the format
+``NAME=[CONFIGURATION][,TEMPLATE]``, where ``CONFIGURATION`` is the path to a
+text-format replication set configuration (the database DSN is ignored), and
+``TEMPLATE`` is the path to an alternative log trigger function body (to
+compare payload formats.) A variant without a configuration will be run
+without any triggers installed.
+
+The database must be able to be configured for use with pgshovel (it requires
+the PgQ extension, and the PL/Python procedural language.) When using
+``docker-compose``, the ephemeral cluster can be used to run the benchmarks in
+a clean room environment::
+
+    python ephemeral-cluster.py run --rm --entrypoint=python pgshovel \\
+        benchmarks/triggers.py postgresql://postgres@postgres/postgres
+
+(This requires that the ``pgbench`` executable is available in the container,
+which can be provided with the ``--pgbench`` option.)
+"""
+import collections
+import logging
+import os
+import re
+import subprocess
+import sys
+from contextlib import closing
+
+import click
+import psycopg2
+from tabulate import tabulate
+
+from pgshovel import __version__
+from pgshovel.administration import (
+    INSTALL_LOG_TRIGGER_STATEMENT_TEMPLATE,
+    configure_set,
+    setup_database,
+)
+from pgshovel.cluster import Cluster
+from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.utilities.postgresql import quote
+from pgshovel.utilities.protobuf import TextCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+EXAMPLE_CONFIGURATION_SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, 'example', 'set.py')
+
+SET_NAME = 'benchmark'
+
+
+Variant = collections.namedtuple('Variant', 'name configuration template')
+
+Result = collections.namedtuple('Result', 'variant tps transactions wal_bytes events event_table_bytes')
+
+
+def get_example_configuration(dsn):
+    """
+    Returns the replication set configuration generated by the example
+    replication set script for the pgbench tables.
+    """
+    output = subprocess.check_output([sys.executable, EXAMPLE_CONFIGURATION_SCRIPT, dsn])
+    return TextCodec(ReplicationSetConfiguration).decode(output)
+
+
+def get_key_column_configuration(configuration):
+    """
+    Returns a copy of the configuration that only monitors the primary key
+    columns of each table.
+    """
+    result = ReplicationSetConfiguration()
+    result.CopyFrom(configuration)
+    for table in result.tables:
+        del table.columns[:]
+        table.columns.extend(table.primary_keys)
+    return result
+
+
+def get_default_variants(dsn):
+    configuration = get_example_configuration(dsn)
+    return (
+        Variant('baseline', None, None),
+        Variant('all-columns', configuration, None),
+        Variant('key-columns', get_key_column_configuration(configuration), None),
+    )
+
+
+def parse_variant(value):
+    try:
+        name, specification = value.split('=', 1)
+    except ValueError:
+        raise click.BadParameter('variant must be provided as NAME=[CONFIGURATION][,TEMPLATE]: %r' % (value,))
+
+    paths = specification.split(',', 1)
+    configuration_path = paths[0]
+    template_path = paths[1] if len(paths) > 1 else None
+
+    configuration = None
+    if configuration_path:
+        with open(configuration_path) as f:
+            configuration = TextCodec(ReplicationSetConfiguration).decode(f.read())
+
+    template = None
+    if template_path:
+        if configuration is None:
+            raise click.BadParameter('a log trigger template requires a configuration: %r' % (value,))
+        with open(template_path) as f:
+            template = f.read()
+
+    return Variant(name, configuration, template)
+
+
+class Database(object):
+    """
+    Provides access to the server statistics used to measure each run.
+    """
+    def __init__(self, cluster, connection):
+        self.cluster = cluster
+        self.connection = connection
+
+        with self.connection.cursor() as cursor:
+            cursor.execute('SHOW server_version_num')
+            (version,) = cursor.fetchone()
+            self.connection.commit()
+
+        # The transaction log functions were renamed in PostgreSQL 10.
+        if int(version) >= 100000:
+            self.__location_function = 'pg_current_wal_lsn'
+            self.__difference_function = 'pg_wal_lsn_diff'
+        else:
+            self.__location_function = 'pg_current_xlog_location'
+            self.__difference_function = 'pg_xlog_location_diff'
+
+    def get_wal_location(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT {0}()'.format(self.__location_function))
+            (location,) = cursor.fetchone()
+            self.connection.commit()
+        return location
+
+    def get_wal_difference(self, start, end):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT {0}(%s, %s)'.format(self.__difference_function), (end, start))
+            (difference,) = cursor.fetchone()
+            self.connection.commit()
+        return int(difference)
+
+    def get_event_table_statistics(self):
+        """
+        Returns a two-tuple of ``(event count, total relation size)`` for the
+        event tables used by the benchmark queue (or ``(0, 0)`` if the queue
+        does not exist.)
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT queue_data_pfx FROM pgq.queue WHERE queue_name = %s', (self.cluster.get_queue_name(SET_NAME),))
+            row = cursor.fetchone()
+            if row is None:
+                self.connection.commit()
+                return 0, 0
+
+            (table,) = row
+            cursor.execute('SELECT count(*) FROM {0}'.format(table))
+            (count,) = cursor.fetchone()
+
+            # The events are stored in the child tables of the queue table, so
+            # all of the partitions need to be included in the total size.
+            cursor.execute("""
+                SELECT pg_total_relation_size(%s::regclass) + coalesce(sum(pg_total_relation_size(inhrelid)), 0)
+                FROM pg_inherits
+                WHERE inhparent = %s::regclass
+            """, (table, table))
+            (size,) = cursor.fetchone()
+            self.connection.commit()
+
+        return int(count), int(size)
+
+    def reset(self, scale, pgbench):
+        """
+        Removes any existing benchmark queue, and reinitializes the pgbench
+        tables (which also removes any triggers installed on them.)
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_namespace WHERE nspname = %s', ('pgq',))
+            if cursor.fetchone() is not None:
+                cursor.execute(
+                    'SELECT pgq.drop_queue(queue_name) FROM pgq.queue WHERE queue_name = %s',
+                    (self.cluster.get_queue_name(SET_NAME),),
+                )
+            self.connection.commit()
+
+        subprocess.check_call([pgbench, '-i', '-q', '-s', str(scale), self.connection.dsn])
+
+        with self.connection.cursor() as cursor:
+            cursor.execute('CHECKPOINT')
+            self.connection.commit()
+
+    def configure(self, variant):
+        with self.connection.cursor() as cursor:
+            setup_database(self.cluster, cursor)
+
+            if variant.template is not None:
+                logger.info('Installing alternative log trigger function for %s...', variant.name)
+                cursor.execute(INSTALL_LOG_TRIGGER_STATEMENT_TEMPLATE.format(
+                    schema=quote(self.cluster.schema),
+                    body=variant.template,
+                    version=__version__,
+                ))
+
+            configure_set(self.cluster, cursor, SET_NAME, variant.configuration)
+            self.connection.commit()
+
+
+PGBENCH_TPS_EXPRESSION = re.compile(r'^tps = ([\d.]+) \(excluding connections establishing\)$', re.MULTILINE)
+PGBENCH_TPS_WITHOUT_INITIAL_CONNECTION_EXPRESSION = re.compile(r'^tps = ([\d.]+) \(without initial connection time\)$', re.MULTILINE)
+PGBENCH_TRANSACTIONS_EXPRESSION = re.compile(r'^number of transactions actually processed: (\d+)', re.MULTILINE)
+
+
+def run_pgbench(pgbench, dsn, clients, jobs, duration):
+    """
+    Runs pgbench, returning a two-tuple of ``(tps, transactions)``.
+    """
+    output = subprocess.check_output([
+        pgbench,
+        '-n',  # the tables are vacuumed after initialization
+        '-c', str(clients),
+        '-j', str(jobs),
+        '-T', str(duration),
+        dsn,
+    ])
+
+    match = PGBENCH_TPS_EXPRESSION.search(output) or PGBENCH_TPS_WITHOUT_INITIAL_CONNECTION_EXPRESSION.search(output)
+    assert match is not None, 'could not find TPS in pgbench output: %r' % (output,)
+    tps = float(match.group(1))
+
+    match = PGBENCH_TRANSACTIONS_EXPRESSION.search(output)
+    assert match is not None, 'could not find transaction count in pgbench output: %r' % (output,)
+    transactions = int(match.group(1))
+
+    return tps, transactions
+
+
+def run_variant(database, variant, pgbench, scale, clients, jobs, duration):
+    logger.info('Preparing %s...', variant.name)
+    database.reset(scale, pgbench)
+    if variant.configuration is not None:
+        database.configure(variant)
+
+    start = database.get_wal_location()
+    logger.info('Running pgbench for %s (%s seconds)...', variant.name, duration)
+    tps, transactions = run_pgbench(pgbench, database.connection.dsn, clients, jobs, duration)
+    end = database.get_wal_location()
+
+    events, event_table_bytes = database.get_event_table_statistics()
+
+    return Result(
+        variant=variant,
+        tps=tps,
+        transactions=transactions,
+        wal_bytes=database.get_wal_difference(start, end),
+        events=events,
+        event_table_bytes=event_table_bytes,
+    )
+
+
+def get_relative_difference(value, baseline):
+    if not baseline:
+        return None
+    return (value - baseline) / float(baseline) * 100
+
+
+def format_results(results):
+    # The first variant without a configuration is used as the baseline that
+    # all other variants are compared to.
+    baseline = next((r for r in results if r.variant.configuration is None), None)
+
+    rows = []
+    for result in results:
+        wal_bytes_per_transaction = result.wal_bytes / float(result.transactions) if result.transactions else None
+        baseline_wal_bytes_per_transaction = None
+        if baseline is not None and baseline.transactions:
+            baseline_wal_bytes_per_transaction = baseline.wal_bytes / float(baseline.transactions)
+
+        rows.append((
+            result.variant.name,
+            result.tps,
+            get_relative_difference(result.tps, baseline.tps if baseline else None),
+            wal_bytes_per_transaction,
+            get_relative_difference(wal_bytes_per_transaction, baseline_wal_bytes_per_transaction),
+            result.events,
+            result.event_table_bytes,
+            result.event_table_bytes / float(result.events) if result.events else None,
+        ))
+
+    return tabulate(
+        rows,
+        headers=('variant', 'tps', 'tps %', 'wal bytes/tx', 'wal %', 'events', 'event table bytes', 'bytes/event'),
+        floatfmt='.2f',
+    )
+
+
+@click.command(help="Measures the write amplification caused by the pgshovel log trigger using pgbench.")
+@click.option('--cluster', default='benchmark', help="Cluster name used for the database schema and queue names.")
+@click.option('--clients', type=int, default=4, help="Number of concurrent pgbench clients.")
+@click.option('--jobs', type=int, default=1, help="Number of pgbench worker threads.")
+@click.option('--duration', type=int, default=60, help="Duration of each pgbench run (in seconds.)")
+@click.option('--scale', type=int, default=1, help="pgbench scale factor used during initialization.")
+@click.option('--pgbench', default='pgbench', help="Path to the pgbench executable.")
+@click.option('--variant', 'variants', multiple=True, help="Capture variant, as NAME=[CONFIGURATION][,TEMPLATE] (can be repeated.)")
+@click.argument('dsn')
+def main(cluster, clients, jobs, duration, scale, pgbench, variants, dsn):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    if variants:
+        variants = map(parse_variant, variants)
+    else:
+        variants = get_default_variants(dsn)
+
+    # The ZooKeeper client is not needed, since the replication sets are
+    # configured directly on the database without being recorded in the
+    # cluster configuration.
+    cluster = Cluster(cluster, None)
+
+    results = []
+    with closing(psycopg2.connect(dsn)) as connection:
+        database = Database(cluster, connection)
+        for variant in variants:
+            results.append(run_variant(database, variant, pgbench, scale, clients, jobs, duration))
+
+    click.echo(format_results(results))
+
+
+if __name__ == '__main__':
+    main(auto_envvar_prefix='PGSHOVEL_BENCHMARK')
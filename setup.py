@@ -123,6 +123,9 @@ setup(
     entry_points={
         'console_scripts': [
             'pgshovel = pgshovel.cli:__main__',
+            'pgshovel-archive-relay = pgshovel.relay.handlers.archive:__main__',
+            'pgshovel-bench-relay = pgshovel.relay.handlers.bench:__main__',
+            'pgshovel-fanout-relay = pgshovel.relay.handlers.fanout:__main__',
             'pgshovel-kafka-relay = pgshovel.relay.handlers.kafka:__main__ [kafka]',
             'pgshovel-stream-relay = pgshovel.relay.handlers.stream:__main__',
         ],
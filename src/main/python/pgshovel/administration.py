@@ -5,12 +5,17 @@ import itertools
 import logging
 import operator
 import random
+import time
 
 import psycopg2
+from psycopg2 import errorcodes
 from pkg_resources import parse_version
 
 from pgshovel import __version__
-from pgshovel.cluster import check_version
+from pgshovel.cluster import (
+    check_version,
+    copy,
+)
 from pgshovel.database import (
     get_configuration_value,
     get_node_identifier,
@@ -22,12 +27,19 @@ from pgshovel.interfaces.configurations_pb2 import (
     ClusterConfiguration,
     ReplicationSetConfiguration,
 )
+from pgshovel.relay.filters import (
+    compile_predicate,
+    get_filter_columns,
+)
 from pgshovel.utilities import unique
 from pgshovel.utilities.datastructures import FormattedSequence
 from pgshovel.utilities.postgresql import (
+    DEFAULT_MAX_WORKERS,
     Transaction,
     managed,
     quote,
+    raise_first_exception,
+    run_concurrently,
 )
 from pgshovel.utilities.protobuf import BinaryCodec
 from pgshovel.utilities.templates import resource_string
@@ -126,7 +138,7 @@ def setup_database(cluster, cursor):
     return node_id
 
 
-def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False, same_version=True):
+def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False, same_version=True, max_workers=DEFAULT_MAX_WORKERS):
     """
     Returns a dictionary of managed databases by their unique node ID. If the
     same node is referenced multiple times (either by the same, or by different
@@ -144,6 +156,9 @@ def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False
     permanently failed), the ``skip_inaccessible`` arguments allows returning
     only those databases that are able to be connected to and an error is
     logged.
+
+    Databases are connected to (and configured) concurrently, using up to
+    ``max_workers`` threads.
     """
     if not dsns:
         return {}
@@ -158,18 +173,18 @@ def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False
     lock_id = random.randint(-2**63, 2**63-1)  # bigint max/min
     logger.debug('Connecting to databases: %s', FormattedSequence(dsns))
 
-    transactions = []
-
-    for dsn in dsns:
+    def connect(dsn):
         try:
             connection = psycopg2.connect(dsn)
         except Exception as error:
             if skip_inaccessible:
                 logger.warning('%s is inaccessible due to error, skipping: %s', dsn, error)
-                continue
+                return None
             else:
                 raise
 
+        transaction = None
+
         logger.debug('Checking if %s has been configured...', dsn)
         try:
             with connection.cursor() as cursor:
@@ -186,7 +201,6 @@ def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False
             connection.rollback()  # start over
 
             transaction = Transaction(connection, 'setup-database')
-            transactions.append(transaction)
             with connection.cursor() as cursor:
                 # To ensure that we're not attempting to configure the same
                 # database multiple times (which would result in a deadlock,
@@ -218,11 +232,31 @@ def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False
             logger.debug('%s is already configured as %s (version %s).', dsn, node_id, version)
             connection.commit()  # don't leave idle in transaction
 
+        return node_id, connection, transaction
+
+    # Connections are established (and configured, if necessary) concurrently.
+    # If any of the databases could not be used, all of the other connections
+    # are closed (aborting any setup transactions that are in progress) before
+    # the error is raised.
+    results = run_concurrently(connect, dsns, max_workers=max_workers)
+    try:
+        results = filter(None, raise_first_exception(results))
+    except Exception:
+        for dsn, future in results:
+            if future.exception() is None and future.result() is not None:
+                node_id, connection, transaction = future.result()
+                connection.close()
+        raise
+
+    transactions = []
+    for node_id, connection, transaction in results:
         assert node_id not in nodes, 'found duplicate node: %s and %s' % (connection, nodes[node_id])
         nodes[node_id] = connection
+        if transaction is not None:
+            transactions.append(transaction)
 
     if transactions:
-        with managed(transactions):
+        with managed(transactions, max_workers=max_workers):
             commit(ztransaction)
 
     return nodes
@@ -231,47 +265,262 @@ def get_managed_databases(cluster, dsns, configure=True, skip_inaccessible=False
 # Trigger Management
 
 
-def setup_triggers(cluster, cursor, name, configuration):
-    trigger = cluster.get_trigger_name(name)
+INSTALLED_TRIGGERS_STATEMENT = """
+SELECT
+    namespace.nspname,
+    class.relname,
+    trigger.tgargs
+FROM
+    pg_catalog.pg_trigger trigger
+    JOIN pg_catalog.pg_class class ON class.oid = trigger.tgrelid
+    JOIN pg_catalog.pg_namespace namespace ON namespace.oid = class.relnamespace
+WHERE
+    trigger.tgname = %s
+"""
 
-    def create_trigger(table):
-        logger.info('Installing (or replacing) log trigger on %s.%s...', table.schema, table.name)
+CREATE_TRIGGER_STATEMENT_TEMPLATE = """\
+DROP TRIGGER IF EXISTS {name} ON {schema}.{table};
+CREATE TRIGGER {name}
+AFTER INSERT OR UPDATE {columns} OR DELETE
+ON {schema}.{table}
+FOR EACH ROW EXECUTE PROCEDURE {cluster_schema}.log(%s, %s, %s, %s)"""
 
-        primary_keys = unique(list(table.primary_keys))
-        all_columns = unique(primary_keys + list(table.columns))
-        if table.columns:
-            column_list = 'OF %s' % ', '.join(map(quote, all_columns))
+DROP_TRIGGER_STATEMENT_TEMPLATE = """\
+DROP TRIGGER {name} ON {schema}.{table}"""
+
+
+def without_filter(table):
+    table = copy(table)
+    table.ClearField('filter')
+    return table
+
+
+def get_trigger_arguments(cluster, name, table):
+    """
+    Returns the arguments that are provided to the log trigger function by the
+    trigger for the provided table configuration.
+
+    The last argument is the version of the table configuration, which allows
+    installed triggers to be compared to their desired configuration. (The
+    relay filter is not used by the trigger, so it is excluded from the
+    version, and changing it does not require the trigger to be replaced.)
+    """
+    primary_keys = unique(list(table.primary_keys))
+    all_columns = unique(primary_keys + list(table.columns))
+    return (
+        cluster.get_queue_name(name),
+        pickle.dumps(primary_keys),
+        pickle.dumps(all_columns if table.columns else None),
+        get_version(without_filter(table)),
+    )
+
+
+def get_installed_triggers(cluster, cursor, name):
+    """
+    Returns a dictionary of the arguments of the log triggers that are
+    installed for the specified replication set, by ``(schema, table)``.
+    """
+    cursor.execute(INSTALLED_TRIGGERS_STATEMENT, (cluster.get_trigger_name(name),))
+    return dict(
+        # Trigger arguments are stored as a sequence of null terminated strings.
+        ((schema, table), tuple(str(arguments).split('\0')[:-1]))
+        for schema, table, arguments in cursor.fetchall()
+    )
+
+
+def get_create_trigger_statement(cluster, cursor, name, table):
+    primary_keys = unique(list(table.primary_keys))
+    all_columns = unique(primary_keys + list(table.columns))
+    if table.columns:
+        column_list = 'OF %s' % ', '.join(map(quote, all_columns))
+    else:
+        column_list = ''
+
+    statement = CREATE_TRIGGER_STATEMENT_TEMPLATE.format(
+        name=quote(cluster.get_trigger_name(name)),
+        columns=column_list,
+        schema=quote(table.schema),
+        table=quote(table.name),
+        cluster_schema=quote(cluster.schema),
+    )
+    return cursor.mogrify(statement, get_trigger_arguments(cluster, name, table))
+
+
+def get_drop_trigger_statement(cluster, name, schema, table):
+    return DROP_TRIGGER_STATEMENT_TEMPLATE.format(
+        name=quote(cluster.get_trigger_name(name)),
+        schema=quote(schema),
+        table=quote(table),
+    )
+
+
+def get_trigger_changes(cluster, cursor, name, tables):
+    """
+    Compares the log triggers that are installed for the specified replication
+    set to the provided table configurations, returning a list of ``((schema,
+    table), statement)`` pairs for each table where the trigger needs to be
+    installed, replaced, or dropped.
+    """
+    installed = get_installed_triggers(cluster, cursor, name)
+
+    changes = []
+    for table in tables:
+        key = (table.schema, table.name)
+        arguments = installed.pop(key, None)
+        if arguments is None:
+            logger.info('Installing log trigger on %s.%s...', table.schema, table.name)
+        elif arguments != get_trigger_arguments(cluster, name, table):
+            logger.info('Replacing log trigger on %s.%s...', table.schema, table.name)
         else:
-            column_list = ''
-
-        statement = """
-            CREATE TRIGGER {name}
-            AFTER INSERT OR UPDATE {columns} OR DELETE
-            ON {schema}.{table}
-            FOR EACH ROW EXECUTE PROCEDURE {cluster_schema}.log(%s, %s, %s, %s)
-        """.format(
-            name=quote(trigger),
-            columns=column_list,
-            schema=quote(table.schema),
-            table=quote(table.name),
-            cluster_schema=quote(cluster.schema),
-        )
-
-        cursor.execute("DROP TRIGGER IF EXISTS {name} ON {schema}.{table}".format(
-            name=quote(trigger),
-            schema=quote(table.schema),
-            table=quote(table.name),
-        ))
-
-        cursor.execute(statement, (
-            cluster.get_queue_name(name),
-            pickle.dumps(primary_keys),
-            pickle.dumps(all_columns if table.columns else None),
-            get_version(configuration)),
-        )
+            logger.debug('Log trigger on %s.%s is up to date.', table.schema, table.name)
+            continue
 
-    for table in configuration.tables:
-        create_trigger(table)
+        changes.append((key, get_create_trigger_statement(cluster, cursor, name, table)))
+
+    # Any triggers that remain are on tables that are no longer part of the
+    # replication set.
+    for schema, table in sorted(installed):
+        logger.info('Dropping log trigger on %s.%s...', schema, table)
+        changes.append(((schema, table), get_drop_trigger_statement(cluster, name, schema, table)))
+
+    return changes
+
+
+def execute_statements(cursor, statements):
+    """
+    Executes a sequence of statements in a single round trip.
+    """
+    if statements:
+        cursor.execute(';\n'.join(statements))
+
+
+class LockPolicy(collections.namedtuple('LockPolicy', 'timeout attempts backoff max_backoff tables_per_transaction')):
+    """
+    Controls how table locks are acquired when log triggers are changed.
+
+    Trigger changes require a ``SHARE ROW EXCLUSIVE`` lock on the table, which
+    blocks (and is blocked by) writes to the table. If ``timeout`` is set, the
+    changes are made with a ``lock_timeout`` of that many milliseconds, and
+    changes that time out are retried up to ``attempts`` times per table,
+    sleeping for an exponentially increasing delay (starting at ``backoff``
+    seconds, up to ``max_backoff`` seconds) between attempts.
+
+    If ``tables_per_transaction`` is set, trigger changes are applied (and
+    committed) in separate transactions of that many tables before the
+    replication set configuration is changed, so that locks are only held
+    briefly. This is not atomic: if the operation fails, the triggers may be
+    left partially changed until the operation is retried.
+    """
+
+
+DEFAULT_LOCK_POLICY = LockPolicy(
+    timeout=None,
+    attempts=5,
+    backoff=0.5,
+    max_backoff=30,
+    tables_per_transaction=None,
+)
+
+TRIGGER_SAVEPOINT = 'pgshovel_triggers'
+
+
+def is_lock_timeout(error):
+    return isinstance(error, psycopg2.OperationalError) and error.pgcode == errorcodes.LOCK_NOT_AVAILABLE
+
+
+def execute_with_retry(cursor, statements, policy, description):
+    """
+    Executes a sequence of statements within a savepoint, retrying them (with
+    backoff) if they time out while waiting for a lock.
+    """
+    for attempt in xrange(1, policy.attempts + 1):
+        cursor.execute('SAVEPOINT %s' % (TRIGGER_SAVEPOINT,))
+        try:
+            execute_statements(cursor, statements)
+        except Exception as error:
+            if not is_lock_timeout(error):
+                raise
+
+            cursor.execute('ROLLBACK TO SAVEPOINT %s' % (TRIGGER_SAVEPOINT,))
+            if attempt == policy.attempts:
+                raise
+
+            delay = min(policy.backoff * 2 ** (attempt - 1), policy.max_backoff)
+            logger.warning('Timed out waiting for lock on %s (attempt %s of %s), retrying in %.1f seconds...', description, attempt, policy.attempts, delay)
+            time.sleep(delay)
+        else:
+            cursor.execute('RELEASE SAVEPOINT %s' % (TRIGGER_SAVEPOINT,))
+            return
+
+
+def apply_trigger_changes(cursor, changes, policy=DEFAULT_LOCK_POLICY):
+    """
+    Applies a sequence of trigger changes (as returned by
+    ``get_trigger_changes``) using the provided lock policy.
+
+    The changes are first attempted in a single round trip. If the lock
+    timeout is reached, the changes are applied (and retried) one table at a
+    time, so that a single busy table does not cause the changes to every
+    table to be retried.
+    """
+    if not changes:
+        return
+
+    logger.info('Applying changes to %s log trigger(s)...', len(changes))
+    statements = [statement for key, statement in changes]
+    if policy.timeout is None:
+        execute_statements(cursor, statements)
+        return
+
+    # This applies for the remainder of the transaction.
+    cursor.execute('SET LOCAL lock_timeout = %s', (policy.timeout,))
+
+    try:
+        execute_with_retry(cursor, statements, policy._replace(attempts=1), '%s tables' % (len(changes),))
+    except Exception as error:
+        if not is_lock_timeout(error):
+            raise
+
+        logger.info('Could not lock all tables at once, applying changes to each table individually...')
+        for (schema, table), statement in changes:
+            execute_with_retry(cursor, [statement], policy, '%s.%s' % (schema, table))
+
+
+def setup_triggers(cluster, cursor, name, configuration, policy=DEFAULT_LOCK_POLICY):
+    """
+    Installs, replaces or drops log triggers so that the installed triggers
+    for the specified replication set match the provided configuration.
+
+    Only the tables where the trigger has changed are locked.
+    """
+    changes = get_trigger_changes(cluster, cursor, name, configuration.tables)
+    apply_trigger_changes(cursor, changes, policy)
+
+
+def stage_triggers(cluster, connection, name, tables, policy):
+    """
+    Applies the trigger changes for a replication set in separate (committed)
+    transactions of at most ``tables_per_transaction`` tables each, before
+    the replication set configuration is changed.
+
+    The transaction queue is created first (if there are any tables), so that
+    events logged by the new triggers have a destination.
+    """
+    try:
+        with connection.cursor() as cursor:
+            if tables:
+                cursor.execute("SELECT pgq.create_queue(%s)", (cluster.get_queue_name(name),))
+            changes = get_trigger_changes(cluster, cursor, name, tables)
+        connection.commit()
+
+        size = policy.tables_per_transaction
+        for i in xrange(0, len(changes), size):
+            with connection.cursor() as cursor:
+                apply_trigger_changes(cursor, changes[i:i + size], policy)
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
 
 
 def drop_trigger(cluster, cursor, name, schema, table):
@@ -279,11 +528,7 @@ def drop_trigger(cluster, cursor, name, schema, table):
     Drops a log trigger on the provided table for the specified replication set.
     """
     logger.info('Dropping log trigger on %s.%s...', schema, table)
-    cursor.execute('DROP TRIGGER {name} ON {schema}.{table}'.format(
-        name=quote(cluster.get_trigger_name(name)),
-        schema=quote(schema),
-        table=quote(table),
-    ))
+    cursor.execute(get_drop_trigger_statement(cluster, name, schema, table))
 
 
 # Replication Set Management
@@ -308,21 +553,22 @@ class VersionedSet(collections.namedtuple('VersionedSet', 'name version')):
 
 
 def fetch_sets(cluster, names=None):
+    """
+    Returns a list of ``(name, (configuration, stat))`` pairs for the
+    requested replication sets (or all sets, if no names are provided.)
+
+    Names may include a version (as ``name@version``), in which case the
+    configuration must match that version. Configurations are read from the
+    cluster configuration cache.
+    """
     if names is None:
-        names = cluster.zookeeper.get_children(cluster.get_set_path())
+        names = cluster.cache.get_set_names()
 
     sets = map(VersionedSet.expand, names)
-    paths = map(
-        cluster.get_set_path,
-        map(operator.attrgetter('name'), sets),
-    )
-    futures = map(cluster.zookeeper.get_async, paths)
+    configurations = cluster.cache.get_sets(map(operator.attrgetter('name'), sets))
 
     results = []
-    decode = BinaryCodec(ReplicationSetConfiguration).decode
-    for s, future in zip(sets, futures):
-        data, stat = future.get()
-        configuration = decode(data)
+    for s, (name, (configuration, stat)) in zip(sets, configurations):
         assert s.version is None or s.version == get_version(configuration), \
             'versions do not match (%s and %s)' % (s.version, get_version(configuration))
         results.append((s.name, (configuration, stat)))
@@ -333,11 +579,57 @@ def fetch_sets(cluster, names=None):
 def validate_set_configuration(configuration):
     for table in configuration.tables:
         assert len(table.primary_keys) > 0, 'table %s.%s must have associated primary key column(s)' % (quote(table.schema), quote(table.name),)
+        if table.columns:
+            missing = get_filter_columns(table) - set(table.primary_keys) - set(table.columns)
+            assert not missing, 'table %s.%s filter refers to columns that are not monitored: %s' % (
+                quote(table.schema),
+                quote(table.name),
+                ', '.join(sorted(missing)),
+            )
+        for predicate in table.filter.predicates:
+            compile_predicate(predicate)
+
+
+def format_interval(seconds):
+    return '%s seconds' % (seconds,)
+
+
+#: The PgQ queue settings that can be provided by a ``QueueConfiguration``,
+#: with the function used to format the value for ``pgq.set_queue_config``.
+QUEUE_PARAMETERS = (
+    ('ticker_max_count', str),
+    ('ticker_max_lag', format_interval),
+    ('ticker_idle_period', format_interval),
+    ('rotation_period', format_interval),
+)
 
 
-def configure_set(cluster, cursor, name, configuration, previous_configuration=None):
+def get_queue_parameters(configuration):
+    """
+    Returns a list of ``(parameter, value)`` pairs for the provided queue
+    configuration, suitable for use with ``pgq.set_queue_config``. (Settings
+    that are not present in the configuration use the PgQ defaults.)
+    """
+    return [(parameter, format(getattr(configuration, parameter))) for parameter, format in QUEUE_PARAMETERS]
+
+
+def configure_queue(cluster, cursor, name, configuration):
+    """
+    Applies the queue settings for a replication set to it's queue.
+    """
+    queue = cluster.get_queue_name(name)
+    execute_statements(cursor, [
+        cursor.mogrify('SELECT pgq.set_queue_config(%s, %s, %s)', (queue, parameter, value))
+        for parameter, value in get_queue_parameters(configuration.queue)
+    ])
+
+
+def configure_set(cluster, cursor, name, configuration, policy=DEFAULT_LOCK_POLICY):
     """
     Configures a replication set using the provided name and configuration data.
+
+    Log triggers are only installed, replaced or dropped on tables where the
+    installed trigger does not match the configuration.
     """
     logger.info('Configuring replication set on %s...', cursor.connection.dsn)
 
@@ -345,18 +637,13 @@ def configure_set(cluster, cursor, name, configuration, previous_configuration=N
     logger.info('Creating transaction queue (if it does not already exist)...')
     cursor.execute("SELECT pgq.create_queue(%s)", (cluster.get_queue_name(name),))
 
-    setup_triggers(cluster, cursor, name, configuration)
+    logger.info('Applying queue settings...')
+    configure_queue(cluster, cursor, name, configuration)
 
-    if previous_configuration is not None:
-        current_tables = set((t.schema, t.name) for t in previous_configuration.tables)
-        updated_tables = set((t.schema, t.name) for t in configuration.tables)
-        dropped_tables = current_tables - updated_tables
+    setup_triggers(cluster, cursor, name, configuration, policy)
 
-        for schema, table in dropped_tables:
-            drop_trigger(cluster, cursor, name, schema, table)
 
-
-def unconfigure_set(cluster, cursor, name, configuration):
+def unconfigure_set(cluster, cursor, name, policy=DEFAULT_LOCK_POLICY):
     """
     Removes all triggers and log queue for the provided replication set.
     """
@@ -366,8 +653,8 @@ def unconfigure_set(cluster, cursor, name, configuration):
     logger.info('Dropping transaction queue...')
     cursor.execute("SELECT pgq.drop_queue(%s)", (cluster.get_queue_name(name),))
 
-    for table in configuration.tables:
-        drop_trigger(cluster, cursor, name, table.schema, table.name)
+    logger.info('Dropping log triggers...')
+    apply_trigger_changes(cursor, get_trigger_changes(cluster, cursor, name, ()), policy)
 
 
 # Cluster Management
@@ -383,14 +670,14 @@ def initialize_cluster(cluster):
     ztransaction.create(cluster.path, BinaryCodec(ClusterConfiguration).encode(configuration))
     ztransaction.create(cluster.get_set_path())
     commit(ztransaction)
+    cluster.cache.clear()
 
 
 def upgrade_cluster(cluster, force=False):
     zookeeper = cluster.zookeeper
 
     codec = BinaryCodec(ClusterConfiguration)
-    data, stat = zookeeper.get(cluster.path)
-    configuration = codec.decode(data)
+    configuration, stat = cluster.cache.get_cluster_configuration()
 
     # if the configuration is newer or equal, require manual intervention
     assert parse_version(__version__) > parse_version(configuration.version) or force, 'cannot downgrade %s to %s' % (configuration.version, __version__)
@@ -409,26 +696,42 @@ def upgrade_cluster(cluster, force=False):
         # TODO: not entirely sure that this is necessary, but can't hurt
         ztransaction.check(cluster.get_set_path(s), version=stat.version)
 
-    transactions = []
     # get_managed_databases prevents duplicates, so this is safe to perform
     # without doing any advisory locking (although it will error if two sets
     # refer to the same database using different DSNs.) get_managed_databases
     # should provide some capacity for doing deduplication to make this more
     # convenient, probably, but this at least keeps it from inadvertently
     # breaking for now.
-    for connection in get_managed_databases(cluster, databases, configure=False, same_version=False).values():
+    def upgrade(connection):
         transaction = Transaction(connection, 'update-cluster')
-        transactions.append(transaction)
         with connection.cursor() as cursor:
             setup_database(cluster, cursor)
-
-    with managed(transactions):
-        commit(ztransaction)
+        return transaction
+
+    connections = get_managed_databases(cluster, databases, configure=False, same_version=False).values()
+
+    # If any of the databases could not be upgraded, all of the connections
+    # are closed (aborting the upgrade transactions that are in progress)
+    # before the error is raised.
+    try:
+        transactions = raise_first_exception(run_concurrently(upgrade, connections))
+    except Exception:
+        for connection in connections:
+            connection.close()
+        raise
+
+    # Ensure the changes are visible to subsequent reads (and that a failed
+    # version check is not repeated due to stale cached configuration.)
+    try:
+        with managed(transactions):
+            commit(ztransaction)
+    finally:
+        cluster.cache.invalidate()
 
 
 # Replication Set Management
 
-def create_set(cluster, name, configuration):
+def create_set(cluster, name, configuration, policy=DEFAULT_LOCK_POLICY):
     # TODO: add dry run support
 
     validate_set_configuration(configuration)
@@ -439,22 +742,28 @@ def create_set(cluster, name, configuration):
 
     transactions = []
     for connection in databases.values():
+        if policy.tables_per_transaction:
+            stage_triggers(cluster, connection, name, configuration.tables, policy)
+
         transaction = Transaction(connection, 'create-set:%s' % (name,))
         transactions.append(transaction)
 
         with connection.cursor() as cursor:
-            configure_set(cluster, cursor, name, configuration)
+            configure_set(cluster, cursor, name, configuration, policy)
 
     ztransaction.create(
         cluster.get_set_path(name),
         BinaryCodec(ReplicationSetConfiguration).encode(configuration),
     )
 
-    with managed(transactions):
-        commit(ztransaction)
+    try:
+        with managed(transactions):
+            commit(ztransaction)
+    finally:
+        cluster.cache.invalidate(name)
 
 
-def update_set(cluster, name, updated_configuration, allow_forced_removal=False):
+def update_set(cluster, name, updated_configuration, allow_forced_removal=False, policy=DEFAULT_LOCK_POLICY):
     # TODO: add dry run support
 
     validate_set_configuration(updated_configuration)
@@ -489,24 +798,31 @@ def update_set(cluster, name, updated_configuration, allow_forced_removal=False)
 
     transactions = []
 
+    if policy.tables_per_transaction:
+        for connection in additions.values() + mutations.values():
+            stage_triggers(cluster, connection, name, updated_configuration.tables, policy)
+
+        for connection in deletions.values():
+            stage_triggers(cluster, connection, name, (), policy)
+
     for connection in additions.values():
         transaction = Transaction(connection, 'update-set:create:%s' % (name,))
         transactions.append(transaction)
         with connection.cursor() as cursor:
-            configure_set(cluster, cursor, name, updated_configuration, None)
+            configure_set(cluster, cursor, name, updated_configuration, policy)
 
     for connection in mutations.values():
         transaction = Transaction(connection, 'update-set:update:%s' % (name,))
         transactions.append(transaction)
         with connection.cursor() as cursor:
-            configure_set(cluster, cursor, name, updated_configuration, current_configuration)
+            configure_set(cluster, cursor, name, updated_configuration, policy)
 
     # TODO: add help to inform user of the possiblity of retry
     for connection in deletions.values():
         transaction = Transaction(connection, 'update-set:delete:%s' % (name,))
         transactions.append(transaction)
         with connection.cursor() as cursor:
-            unconfigure_set(cluster, cursor, name, current_configuration)
+            unconfigure_set(cluster, cursor, name, policy)
 
     ztransaction.set_data(
         cluster.get_set_path(name),
@@ -514,11 +830,14 @@ def update_set(cluster, name, updated_configuration, allow_forced_removal=False)
         version=stat.version,
     )
 
-    with managed(transactions):
-        commit(ztransaction)
+    try:
+        with managed(transactions):
+            commit(ztransaction)
+    finally:
+        cluster.cache.invalidate(name)
 
 
-def drop_set(cluster, name, allow_forced_removal=False):
+def drop_set(cluster, name, allow_forced_removal=False, policy=DEFAULT_LOCK_POLICY):
     # TODO: add dry run support
 
     (name, (configuration, stat)) = fetch_sets(cluster, (name,))[0]
@@ -536,15 +855,132 @@ def drop_set(cluster, name, allow_forced_removal=False):
 
     # TODO: add help to inform user of the possiblity of retry
     for connection in deletions.values():
+        if policy.tables_per_transaction:
+            stage_triggers(cluster, connection, name, (), policy)
+
         transaction = Transaction(connection, 'drop-set:%s' % (name,))
         transactions.append(transaction)
         with connection.cursor() as cursor:
-            unconfigure_set(cluster, cursor, name, configuration)
+            unconfigure_set(cluster, cursor, name, policy)
 
     ztransaction.delete(
         cluster.get_set_path(name),
         version=stat.version,
     )
 
-    with managed(transactions):
-        commit(ztransaction)
+    try:
+        with managed(transactions):
+            commit(ztransaction)
+    finally:
+        cluster.cache.invalidate(name)
+
+
+# Replication Set Status
+
+QUEUE_STATUS_STATEMENT = """
+SELECT
+    extract(epoch from info.ticker_lag),
+    (
+        SELECT extract(epoch from tick.tick_time)
+        FROM pgq.tick tick
+        WHERE tick.tick_queue = queue.queue_id AND tick.tick_id = info.last_tick_id
+    ),
+    info.ev_new,
+    (
+        SELECT sum(pg_catalog.pg_total_relation_size(inherits.inhrelid))
+        FROM pg_catalog.pg_inherits inherits
+        WHERE inherits.inhparent = queue.queue_data_pfx::regclass
+    )
+FROM
+    pgq.get_queue_info(%s) info
+    JOIN pgq.queue queue ON queue.queue_name = info.queue_name
+"""
+
+CONSUMER_STATUS_STATEMENT = """
+SELECT
+    consumer_name,
+    pending_events,
+    extract(epoch from lag),
+    extract(epoch from last_seen)
+FROM
+    pgq.get_consumer_info(%s)
+ORDER BY
+    consumer_name
+"""
+
+
+class SetStatus(collections.namedtuple('SetStatus', 'name dsn consumer pending_events consumer_lag last_seen ticker_lag last_tick new_events table_size error')):
+    """
+    The status of a replication set queue, and one of it's consumers (if the
+    queue has any consumers.)
+
+    Lags are provided in seconds, ``last_tick`` is the time of the most recent
+    tick (as a UNIX timestamp), and the ``table_size`` is the total size of
+    the queue event tables in bytes. If the status could not be retrieved (or
+    the queue does not exist), ``error`` contains the error and all other
+    status fields are ``None``.
+    """
+
+
+EMPTY_SET_STATUS = SetStatus(*[None] * len(SetStatus._fields))
+
+
+def get_set_status(cluster, names=None, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Returns a list of ``SetStatus`` records for the requested replication sets
+    (or all sets, if no names are provided.)
+
+    Each database is queried concurrently, with one connection per database.
+    """
+    sets = collections.defaultdict(list)
+    for name, (configuration, stat) in fetch_sets(cluster, names):
+        sets[configuration.database.dsn].append(name)
+
+    def query(dsn):
+        results = []
+        connection = psycopg2.connect(dsn)
+        try:
+            with connection.cursor() as cursor:
+                for name in sets[dsn]:
+                    queue = cluster.get_queue_name(name)
+
+                    cursor.execute(QUEUE_STATUS_STATEMENT, (queue,))
+                    row = cursor.fetchone()
+                    if row is None:
+                        error = LookupError('Queue does not exist: %s' % (queue,))
+                        logger.warning('Could not retrieve status of %s from %s: %s', name, dsn, error)
+                        results.append(EMPTY_SET_STATUS._replace(name=name, dsn=dsn, error=error))
+                        continue
+
+                    ticker_lag, last_tick, new_events, table_size = row
+
+                    cursor.execute(CONSUMER_STATUS_STATEMENT, (queue,))
+                    consumers = cursor.fetchall() or [(None, None, None, None)]
+                    for consumer, pending_events, consumer_lag, last_seen in consumers:
+                        results.append(SetStatus(
+                            name,
+                            dsn,
+                            consumer,
+                            pending_events,
+                            consumer_lag,
+                            last_seen,
+                            ticker_lag,
+                            last_tick,
+                            new_events,
+                            table_size,
+                            None,
+                        ))
+        finally:
+            connection.close()
+        return results
+
+    results = []
+    for dsn, future in run_concurrently(query, sets.keys(), max_workers=max_workers):
+        error = future.exception()
+        if error is not None:
+            logger.warning('Could not retrieve status from %s: %s', dsn, error)
+            results.extend(EMPTY_SET_STATUS._replace(name=name, dsn=dsn, error=error) for name in sets[dsn])
+        else:
+            results.extend(future.result())
+
+    return sorted(results, key=operator.attrgetter('name', 'dsn', 'consumer'))
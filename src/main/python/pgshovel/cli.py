@@ -1,21 +1,23 @@
 import code
 import functools
 import logging
+import time
 
 import click
 from tabulate import tabulate
 
 from pgshovel import administration
 from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.relay.bootstrap import Bootstrap
+from pgshovel.relay.entrypoint import HandlerCommand
+from pgshovel.relay.replay import Replayer
+from pgshovel.streams.archives import ArchiveReader
 from pgshovel.utilities.commands import (
     entrypoint,
     pass_cluster,
 )
 from pgshovel.utilities.datastructures import FormattedSequence
-from pgshovel.utilities.protobuf import (
-    BinaryCodec,
-    TextCodec,
-)
+from pgshovel.utilities.protobuf import TextCodec
 
 
 logger = logging.getLogger(__name__)
@@ -52,6 +54,40 @@ def set():
     pass
 
 
+def lock_policy_options(function):
+    """
+    Adds options for controlling how table locks are acquired when log
+    triggers are changed, providing a ``LockPolicy`` as the ``policy``
+    argument to the command.
+    """
+    @click.option(
+        '--lock-timeout',
+        type=int,
+        help="Maximum time (in milliseconds) to wait for a table lock when changing a log trigger. (By default, locks are waited for indefinitely.)",
+    )
+    @click.option(
+        '--lock-attempts',
+        type=int,
+        default=administration.DEFAULT_LOCK_POLICY.attempts,
+        help="Number of times to attempt to lock each table when a lock timeout is set.",
+    )
+    @click.option(
+        '--tables-per-transaction',
+        type=int,
+        help="Change log triggers in separate transactions of this many tables before updating the replication set. (This is not atomic, but holds locks for less time.)",
+    )
+    @functools.wraps(function)
+    def decorated(*args, **kwargs):
+        kwargs['policy'] = administration.DEFAULT_LOCK_POLICY._replace(
+            timeout=kwargs.pop('lock_timeout'),
+            attempts=kwargs.pop('lock_attempts'),
+            tables_per_transaction=kwargs.pop('tables_per_transaction'),
+        )
+        return function(*args, **kwargs)
+
+    return decorated
+
+
 @set.command(short_help='List replication sets.')
 @pass_cluster
 def list(cluster):
@@ -69,49 +105,216 @@ def list(cluster):
     click.echo(tabulate(sorted(rows), headers=('name', 'database', 'table', 'version')))
 
 
+def format_seconds(value):
+    return '%.1fs' % (value,) if value is not None else None
+
+
+def format_timestamp(value):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(float(value))) if value is not None else None
+
+
+def format_size(value):
+    if value is None:
+        return None
+
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if value < 1024:
+            break
+        value /= 1024.0
+    else:
+        unit = 'TiB'
+    return '%.1f%s' % (value, unit)
+
+
+@set.command(short_help='Show queue and consumer status of replication sets.')
+@click.option(
+    '--watch',
+    type=float,
+    metavar='SECONDS',
+    help="Refresh the status every SECONDS seconds until interrupted.",
+)
+@click.argument('names', nargs=-1)
+@pass_cluster
+def status(cluster, watch, names):
+    def render():
+        rows = []
+        for s in administration.get_set_status(cluster, names or None):
+            if s.error is not None:
+                rows.append((s.name, s.dsn, 'error: %s' % (s.error,)) + (None,) * 7)
+                continue
+
+            rows.append((
+                s.name,
+                s.dsn,
+                s.consumer,
+                s.pending_events,
+                format_seconds(s.consumer_lag),
+                format_seconds(s.last_seen),
+                format_seconds(s.ticker_lag),
+                format_timestamp(s.last_tick),
+                s.new_events,
+                format_size(s.table_size),
+            ))
+
+        return tabulate(rows, headers=('name', 'database', 'consumer', 'pending', 'lag', 'last seen', 'tick lag', 'last tick', 'new', 'size'))
+
+    with cluster:
+        if watch is None:
+            click.echo(render())
+            return
+
+        try:
+            while True:
+                output = render()
+                click.clear()
+                click.echo('%s (every %ss)\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), watch))
+                click.echo(output)
+                time.sleep(watch)
+        except KeyboardInterrupt:
+            pass
+
+
 @set.command(short_help='Retrieve replication set configuration.')
 @click.argument('name', type=str)
 @pass_cluster
 def inspect(cluster, name):
     with cluster:
-        data, stat = cluster.zookeeper.get(cluster.get_set_path(name))
-        configuration = BinaryCodec(ReplicationSetConfiguration).decode(data)
+        ((name, (configuration, stat)),) = administration.fetch_sets(cluster, (name,))
         click.echo(TextCodec(ReplicationSetConfiguration).encode(configuration))
         click.echo('version: %s' % (administration.get_version(configuration)), err=True)
+        for parameter, value in administration.get_queue_parameters(configuration.queue):
+            click.echo('queue %s: %s' % (parameter, value), err=True)
 
 
 @set.command(short_help='Create new replication set.')
 @click.argument('name', type=str)
 @click.argument('configuration', type=click.File('r'), default='-')
 @pass_cluster
-def create(cluster, name, configuration):
+@lock_policy_options
+def create(cluster, name, configuration, policy):
     codec = TextCodec(ReplicationSetConfiguration)
     configuration = codec.decode(configuration.read())
 
     with cluster:
-        return administration.create_set(cluster, name, configuration)
+        return administration.create_set(cluster, name, configuration, policy=policy)
 
 
 @set.command(short_help='Updating existing replication set.')
 @click.argument('name', type=str)
 @click.argument('configuration', type=click.File('r'), default='-')
 @pass_cluster
-def update(cluster, name, configuration):
+@lock_policy_options
+def update(cluster, name, configuration, policy):
     codec = TextCodec(ReplicationSetConfiguration)
     configuration = codec.decode(configuration.read())
 
     # TODO: Support forced removal again.
     with cluster:
-        return administration.update_set(cluster, name, configuration)
+        return administration.update_set(cluster, name, configuration, policy=policy)
 
 
 @set.command(short_help='Drop existing replication set.')
 @click.argument('name', type=str)
 @pass_cluster
-def drop(cluster, name):
+@lock_policy_options
+def drop(cluster, name, policy):
     # TODO: Support forced removal again.
     with cluster:
-        return administration.drop_set(cluster, name)
+        return administration.drop_set(cluster, name, policy=policy)
+
+
+@main.command(
+    cls=HandlerCommand,
+    short_help='Replay an archived stream into a relay handler.',
+    subcommand_metavar='HANDLER [OPTIONS] SET',
+)
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option(
+    '--batch-id',
+    type=int,
+    help="Start replaying from the first batch with this (or a greater) batch ID.",
+)
+@click.option(
+    '--after',
+    type=float,
+    help="Start replaying from the first batch that ends at or after this time (as a Unix timestamp.)",
+)
+@click.option(
+    '--rate',
+    type=float,
+    help="Maximum number of messages to replay per second. (By default, messages are replayed as fast as possible.)",
+)
+@click.option(
+    '--batch-size',
+    type=int,
+    default=1000,
+    help="Number of messages provided to the handler at a time.",
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=4,
+    help="Number of threads used to decode messages.",
+)
+def replay(directory, batch_id, after, rate, batch_size, workers):
+    """
+    Replays an archived stream (as written by the archive relay handler) into
+    any relay handler, without the involvement of the database.
+    """
+
+
+@replay.resultcallback()
+def replay_archive(constructed, directory, batch_id, after, rate, batch_size, workers):
+    reader = ArchiveReader(directory)
+
+    position = None
+    if batch_id is not None:
+        position = reader.seek_batch(batch_id)
+    elif after is not None:
+        position = reader.seek_time(after)
+
+    if (batch_id is not None or after is not None) and position is None:
+        raise click.ClickException('No batches matched the starting position.')
+
+    replayer = Replayer(reader, constructed.handler, position, rate=rate, batch_size=batch_size, workers=workers)
+    count = replayer.run()
+    click.echo('Replayed %s messages to %s.' % (count, constructed.handler), err=True)
+
+
+@main.command(
+    cls=HandlerCommand,
+    short_help='Publish the current contents of a replication set to a relay handler.',
+    subcommand_metavar='HANDLER [OPTIONS] SET',
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=4,
+    help="Number of connections used to read tables in parallel.",
+)
+@click.option(
+    '--chunk-size',
+    type=int,
+    default=10000,
+    help="Approximate number of rows read by a worker at a time.",
+)
+def bootstrap(workers, chunk_size):
+    """
+    Publishes the current contents of the tables in a replication set to any
+    relay handler as a single batch of INSERT mutations, read from a
+    consistent snapshot.
+    """
+
+
+@bootstrap.resultcallback()
+@pass_cluster
+def bootstrap_set(cluster, constructed, workers, chunk_size):
+    with cluster:
+        ((name, (configuration, stat)),) = administration.fetch_sets(cluster, (constructed.set,))
+        bootstrap = Bootstrap(cluster, configuration, constructed.handler, workers=workers, chunk_size=chunk_size)
+        count = bootstrap.run()
+
+    click.echo('Bootstrapped %s rows from %s to %s.' % (count, name, constructed.handler), err=True)
 
 
 @main.command(short_help='Launch interactive shell.')
@@ -1,9 +1,16 @@
 import functools
+import itertools
 import logging
 import posixpath
+import threading
+
+from kazoo.client import KazooState
 
 from pgshovel import __version__
-from pgshovel.interfaces.configurations_pb2 import ClusterConfiguration
+from pgshovel.interfaces.configurations_pb2 import (
+    ClusterConfiguration,
+    ReplicationSetConfiguration,
+)
 from pgshovel.utilities.protobuf import BinaryCodec
 
 
@@ -23,23 +30,182 @@ def check_version(cluster):
     zookeeper = cluster.zookeeper
 
     logger.debug('Checking cluster version...')
-    data, stat = zookeeper.get(cluster.path)
-    configuration = BinaryCodec(ClusterConfiguration).decode(data)
+    configuration, stat = cluster.cache.get_cluster_configuration()
     if __version__ != configuration.version:
         raise VersionMismatchError(configuration.version)
 
     logger.debug('Remote version: %s', configuration.version)
 
+    # Since the configuration may have been cached, the version check also
+    # guards against the cached configuration being out of date.
     ztransaction = zookeeper.transaction()
     ztransaction.check(cluster.path, version=stat.version)
     return ztransaction
 
 
+def copy(message):
+    result = type(message)()
+    result.CopyFrom(message)
+    return result
+
+
+class ConfigurationCache(object):
+    """
+    An in-memory cache of the cluster and replication set configurations.
+
+    Configurations are read from ZooKeeper when they are first requested
+    (setting a watch), and remain cached until the watch is triggered by a
+    change to the node, or the ZooKeeper session is interrupted. Callers
+    always receive copies of the cached configurations, so they are free to
+    modify them.
+
+    Since configurations may be briefly out of date (until a watch has been
+    delivered), any updates that are based on cached configurations should
+    check the version of the node in the update transaction. Writers should
+    also ``invalidate`` the nodes they have modified, so that their own
+    writes are visible to subsequent reads.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+        self.__lock = threading.Lock()
+        self.__listening = False
+
+        # Each entry is associated with a generation that is incremented
+        # every time the entry is invalidated. This prevents a read that was
+        # started before an invalidation from populating the cache with out
+        # of date data after the invalidation has occurred.
+        self.__generations = itertools.count()
+        self.__entries = {}
+
+    def __repr__(self):
+        return '<%s: %s (%s entries)>' % (type(self).__name__, self.cluster, len(self.__entries))
+
+    def __handle_state_change(self, state):
+        if state != KazooState.CONNECTED:
+            # Watches may not be delivered while the session is interrupted
+            # (and are lost entirely if the session expires.)
+            self.clear()
+
+    def __get_generation(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            entry = self.__entries[key] = (next(self.__generations), None)
+        return entry[0]
+
+    def __invalidate(self, key, event=None):
+        with self.__lock:
+            if key in self.__entries:
+                logger.debug('Invalidating cached configuration: %s', key)
+                self.__entries[key] = (next(self.__generations), None)
+
+    def __get(self, keys, fetch):
+        """
+        Returns the cached values for the provided keys, fetching any values
+        that are not already cached by calling ``fetch`` with the missing keys
+        and a function that creates the watch for a key.
+        """
+        with self.__lock:
+            if not self.__listening:
+                self.cluster.zookeeper.add_listener(self.__handle_state_change)
+                self.__listening = True
+
+            values = {}
+            missing = {}
+            for key in keys:
+                generation, value = self.__entries.get(key, (None, None))
+                if value is not None:
+                    values[key] = value
+                else:
+                    missing[key] = self.__get_generation(key)
+
+        if missing:
+            watch = lambda key: functools.partial(self.__invalidate, key)
+            fetched = fetch(missing.keys(), watch)
+            with self.__lock:
+                for key, value in fetched.items():
+                    if self.__entries.get(key, (None, None))[0] == missing[key]:
+                        self.__entries[key] = (missing[key], value)
+            values.update(fetched)
+
+        return [values[key] for key in keys]
+
+    def get_cluster_configuration(self):
+        """
+        Returns the cluster configuration and ``ZnodeStat``.
+        """
+        def fetch(keys, watch):
+            (key,) = keys
+            data, stat = self.cluster.zookeeper.get(self.cluster.path, watch=watch(key))
+            return {key: (BinaryCodec(ClusterConfiguration).decode(data), stat)}
+
+        ((configuration, stat),) = self.__get([self.cluster.path], fetch)
+        return copy(configuration), stat
+
+    def get_set_names(self):
+        """
+        Returns the names of all replication sets.
+        """
+        def fetch(keys, watch):
+            (key,) = keys
+            return {key: tuple(self.cluster.zookeeper.get_children(key, watch=watch(key)))}
+
+        (names,) = self.__get([self.cluster.get_set_path()], fetch)
+        return list(names)
+
+    def get_sets(self, names=None):
+        """
+        Returns a list of ``(name, (configuration, stat))`` pairs for the
+        requested replication sets (or all sets, if no names are provided.)
+
+        Any sets that are not already cached are fetched concurrently. If a
+        set does not exist, ``kazoo.exceptions.NoNodeError`` is raised.
+        """
+        if names is None:
+            names = self.get_set_names()
+
+        decode = BinaryCodec(ReplicationSetConfiguration).decode
+
+        def fetch(keys, watch):
+            futures = [(key, self.cluster.zookeeper.get_async(key, watch=watch(key))) for key in keys]
+            results = {}
+            for key, future in futures:
+                data, stat = future.get()
+                results[key] = (decode(data), stat)
+            return results
+
+        values = self.__get(map(self.cluster.get_set_path, names), fetch)
+        return [(name, (copy(configuration), stat)) for name, (configuration, stat) in zip(names, values)]
+
+    def invalidate(self, set=None):
+        """
+        Invalidates the cached configuration for a replication set (as well as
+        the list of replication sets), or the cluster configuration if no
+        replication set is provided.
+        """
+        if set is None:
+            self.__invalidate(self.cluster.path)
+        else:
+            self.__invalidate(self.cluster.get_set_path(set))
+        self.__invalidate(self.cluster.get_set_path())
+
+    def clear(self):
+        """
+        Invalidates all cached configurations.
+        """
+        with self.__lock:
+            for key in self.__entries:
+                self.__entries[key] = (next(self.__generations), None)
+
+
 class Cluster(object):
     def __init__(self, name, zookeeper):
         self.name = name
         self.zookeeper = zookeeper
 
+        #: A cache of the cluster and replication set configurations.
+        self.cache = ConfigurationCache(self)
+
     def __enter__(self):
         self.start()
 
@@ -71,5 +237,9 @@ class Cluster(object):
     def get_set_path(self):
         return functools.partial(posixpath.join, self.path, 'sets')
 
+    @property
+    def get_ledger_path(self):
+        return functools.partial(posixpath.join, self.path, 'ledgers')
+
     def get_queue_name(self, set):
         return 'pgshovel:%s:%s' % (self.name, set)
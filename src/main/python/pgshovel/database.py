@@ -1,5 +1,8 @@
+import collections
 import logging
+import threading
 import uuid
+import weakref
 from contextlib import contextmanager
 
 from pgmanagedconnection import ManagedConnection
@@ -10,8 +13,11 @@ from pgshovel.utilities.postgresql import quote
 logger = logging.getLogger(__name__)
 
 
+CONFIGURATION_VALUE_STATEMENT_TEMPLATE = 'SELECT value FROM {schema}.configuration WHERE key = %s'
+
+
 def get_configuration_value(cluster, cursor, key, default=None):
-    statement = 'SELECT value FROM {schema}.configuration WHERE key = %s'.format(schema=quote(cluster.schema))
+    statement = CONFIGURATION_VALUE_STATEMENT_TEMPLATE.format(schema=quote(cluster.schema))
     cursor.execute(statement, (key,))
     results = cursor.fetchall()
     assert len(results) <= 1
@@ -57,14 +63,133 @@ def get_or_set_node_identifier(cluster, cursor):
     return node_id
 
 
+# The names of the statements that have been prepared on each connection.
+# (Prepared statements are retained for the lifetime of a session, so these are
+# discarded when the connection is.)
+prepared_statements = weakref.WeakKeyDictionary()
+
+prepared_statements_lock = threading.Lock()
+
+
+class PreparedStatement(object):
+    """
+    A statement that is prepared on the server the first time that it is
+    executed on a connection, and executed by name after that, avoiding the
+    overhead of parsing and planning the statement each time it is executed.
+
+    The statement uses positional parameters (``$1``, ``$2``, etc.) with the
+    provided parameter types.
+    """
+    def __init__(self, name, statement, types=()):
+        self.name = name
+        self.statement = statement
+        self.types = types
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.name)
+
+    def get_prepare_statement(self):
+        return 'PREPARE {name}{types} AS {statement}'.format(
+            name=quote(self.name),
+            types=' (%s)' % (', '.join(self.types),) if self.types else '',
+            statement=self.statement,
+        )
+
+    def get_execute_statement(self, parameters=()):
+        return 'EXECUTE {name}{placeholders}'.format(
+            name=quote(self.name),
+            placeholders=' (%s)' % (', '.join(['%s'] * len(parameters)),) if parameters else '',
+        )
+
+    def execute(self, cursor, parameters=()):
+        connection = cursor.connection
+        with prepared_statements_lock:
+            prepared = prepared_statements.setdefault(connection, set())
+
+        if self.name not in prepared:
+            logger.debug('Preparing %s on %s...', self.name, connection)
+            cursor.execute(self.get_prepare_statement())
+            prepared.add(self.name)
+
+        cursor.execute(self.get_execute_statement(parameters), parameters)
+
+
+class ConnectionPool(object):
+    """
+    Retains idle ``ManagedConnection`` objects (up to ``max_idle`` per DSN) so
+    that they can be reused by later ``ManagedDatabase`` instances, rather
+    than establishing a new connection each time one is created.
+    """
+    def __init__(self, max_idle=2):
+        self.max_idle = max_idle
+
+        self.__idle = collections.defaultdict(list)
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        with self.__lock:
+            return '<%s: %s idle connections>' % (
+                type(self).__name__,
+                sum(map(len, self.__idle.values())),
+            )
+
+    def get(self, dsn):
+        """
+        Returns an idle connection for the DSN, or a new (unconnected)
+        connection if there are no idle connections available.
+        """
+        with self.__lock:
+            idle = self.__idle[dsn]
+            if idle:
+                return idle.pop()
+        return ManagedConnection(dsn)
+
+    def put(self, connection):
+        """
+        Returns a connection to the pool. Connections that have been closed
+        (or that exceed the number of idle connections retained per DSN) are
+        discarded.
+        """
+        if connection.closed:
+            return
+
+        with self.__lock:
+            idle = self.__idle[connection.dsn]
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+
+        with connection(close=True):
+            pass
+
+    def clear(self):
+        """
+        Closes and discards all idle connections.
+        """
+        with self.__lock:
+            connections = [connection for idle in self.__idle.values() for connection in idle]
+            self.__idle.clear()
+
+        for connection in connections:
+            with connection(close=True):
+                pass
+
+
+#: The connection pool that is shared by all ``ManagedDatabase`` instances
+#: that are not provided with a pool explicitly.
+default_pool = ConnectionPool()
+
+
 class ManagedDatabase(object):
-    def __init__(self, cluster, dsn, options=None):
+    def __init__(self, cluster, dsn, options=None, pool=None):
         self.cluster = cluster
         self.dsn = dsn
+        self.pool = pool if pool is not None else default_pool
 
         self.__id = None
 
-        self.__connection = ManagedConnection(dsn)
+        self.__connection = None
+        self.__lock = threading.Lock()
 
     def __str__(self):
         return '%s' % (self.dsn,)
@@ -73,7 +198,7 @@ class ManagedDatabase(object):
         # TODO: maybe add backend PID for debugging, or that could go on managed connection
         return '<%s[%s]: %s (%s)>' % (
             type(self).__name__,
-            'CONNECTED' if not self.__connection.closed else 'CLOSED',
+            'CONNECTED' if self.__connection is not None and not self.__connection.closed else 'CLOSED',
             self.dsn,
             self.__id or 'UNKNOWN',
         )
@@ -114,8 +239,14 @@ class ManagedDatabase(object):
         reponsibility of the caller to ensure that the ``id`` attribute is the
         same between accesses.
 
-        This will cause a connection to be established, if one is not already.
+        This will cause a connection to be established (or retrieved from the
+        connection pool), if one is not already.
         """
+        with self.__lock:
+            checkout = self.__connection is None
+            if checkout:
+                self.__connection = self.pool.get(self.dsn)
+
         was_closed = self.__connection.closed
         with self.__connection() as connection:
             # When the connection is established -- either on a new connection,
@@ -123,10 +254,22 @@ class ManagedDatabase(object):
             # need to retrieve the node ID so that we know what database we're
             # actually connected to by UUID. (Some clients may actually need to
             # ensure that this doesn't change after a disconnect -- like when a
-            # DNS entry changes, for instance.)
-            if was_closed:
+            # DNS entry changes, for instance.) Pooled connections are checked
+            # as well, since they may have been established by another client.
+            if was_closed or checkout:
                 with connection.cursor() as cursor:
                     self.__discover_node_id(cursor)
                     connection.commit()
 
             yield connection
+
+    def close(self):
+        """
+        Returns the connection (if one has been established) to the connection
+        pool.
+        """
+        with self.__lock:
+            connection, self.__connection = self.__connection, None
+
+        if connection is not None:
+            self.pool.put(connection)
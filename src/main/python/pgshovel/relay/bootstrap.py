@@ -0,0 +1,386 @@
+"""
+Tools for bootstrapping consumers with the current contents of the tables in
+a replication set.
+
+The tables are read in a single (exported) snapshot by a pool of workers, each
+reading a range of the primary key of a table at a time with ``COPY``. Values
+of the scalar types that PL/Python converts for the log trigger (booleans,
+integers, floating point and numeric values, and ``bytea``) are converted from
+their text representation in the same way, and text values are provided as
+UTF-8 encoded strings, as they are by PL/Python. Values of other types that
+PL/Python converts (such as arrays) are provided as their text representation,
+so may differ from those in mutations that are relayed from the queue. The
+rows are published as ``INSERT`` mutations within a single batch, which is
+tagged with the snapshot that the rows were read in. Since a transaction is
+visible in the bootstrap batch if (and only if) it is visible in that
+snapshot, consumers can line the bootstrap batch up with the batches that are
+relayed from the queue by comparing the snapshot to the ``BeginOperation``
+tick snapshots (and transaction IDs) of those batches.
+"""
+import collections
+import decimal
+import functools
+import itertools
+import logging
+import threading
+import time
+
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+
+from pgshovel.database import get_node_identifier
+from pgshovel.interfaces.common_pb2 import (
+    BatchIdentifier,
+    Tick,
+)
+from pgshovel.interfaces.streams_pb2 import (
+    BeginOperation,
+    MutationOperation,
+)
+from pgshovel.relay.filters import compile_filters
+from pgshovel.streams.publisher import Publisher
+from pgshovel.utilities import unique
+from pgshovel.utilities.conversions import (
+    row_converter,
+    to_snapshot,
+    to_timestamp,
+)
+from pgshovel.utilities.postgresql import quote
+
+
+logger = logging.getLogger(__name__)
+
+
+#: The batch ID used for bootstrap batches. (PgQ batch IDs start at 1, so this
+#: cannot collide with a batch that has been relayed from the queue.)
+BOOTSTRAP_BATCH_ID = 0
+
+EXPORT_SNAPSHOT_STATEMENT = """
+SELECT
+    pg_export_snapshot(),
+    txid_current(),
+    txid_current_snapshot(),
+    extract(epoch from now())
+"""
+
+# The upper bound of each chunk is found by paging through the primary key
+# index from the previous bound, so that the table does not need to be sorted
+# (or scanned) before the first chunk can be read.
+CHUNK_BOUNDARY_STATEMENT_TEMPLATE = """
+SELECT {keys} FROM {schema}.{table}
+WHERE {condition}
+ORDER BY {keys}
+OFFSET %s LIMIT 1
+"""
+
+CHUNK_STATEMENT_TEMPLATE = """
+SELECT {columns} FROM {schema}.{table}
+WHERE {conditions}
+ORDER BY {keys}
+"""
+
+COLUMNS_STATEMENT_TEMPLATE = "SELECT {columns} FROM {schema}.{table} LIMIT 0"
+
+
+Chunk = collections.namedtuple('Chunk', 'table lower upper')
+
+
+def get_chunks(table, boundaries):
+    """
+    Yields the chunks that cover the primary key of a table, given an
+    iterable of the (ordered) primary key values that are the upper bounds of
+    each chunk.
+
+    The lower bound of each chunk is exclusive, and the upper bound is
+    inclusive. The first and last chunks are unbounded on one side (and a
+    table without any boundaries is read as a single chunk.)
+    """
+    lower = None
+    for upper in boundaries:
+        yield Chunk(table, lower, upper)
+        lower = upper
+    yield Chunk(table, lower, None)
+
+
+def to_bytes(value):
+    """
+    Converts the text representation of a ``bytea`` value (in either the
+    ``hex`` or ``escape`` output format) to a string of bytes.
+    """
+    if value.startswith('\\x'):
+        return value[2:].decode('hex')
+    return value.decode('string_escape')
+
+
+#: Conversions from the text representation of values to the Python values
+#: provided by PL/Python, by type OID. Values of any other type are provided
+#: as their text representation.
+CONVERSIONS = {
+    16: lambda value: value == 't',  # bool
+    17: to_bytes,  # bytea
+    20: long,  # int8
+    21: int,  # int2
+    23: int,  # int4
+    700: float,  # float4
+    701: float,  # float8
+    1700: decimal.Decimal,  # numeric
+}
+
+
+def to_text(value):
+    # Text is provided by PL/Python as (UTF-8 encoded) bytes, which is also
+    # what filter predicate values are compared against.
+    return value
+
+
+def get_converters(description):
+    """
+    Returns a list of ``(name, converter)`` pairs for the columns of a cursor
+    description.
+    """
+    return [(column[0], CONVERSIONS.get(column[1], to_text)) for column in description]
+
+
+def decode_row(converters, line):
+    """
+    Decodes a line of ``COPY`` text format output into a dictionary of column
+    values, using the converters returned by ``get_converters``.
+    """
+    row = {}
+    for (name, convert), value in zip(converters, line.split('\t')):
+        row[name] = convert(value.decode('string_escape')) if value != '\\N' else None
+    return row
+
+
+class RowReader(object):
+    """
+    A file-like object that can be used as the destination of a ``COPY ... TO
+    STDOUT`` statement (in text format), decoding each line that is written to
+    it into a row.
+    """
+    def __init__(self, converters):
+        self.converters = converters
+        self.rows = []
+        self.__buffer = ''
+
+    def write(self, data):
+        lines = (self.__buffer + data).split('\n')
+        self.__buffer = lines.pop()
+        self.rows.extend(decode_row(self.converters, line) for line in lines)
+
+
+class Bootstrap(object):
+    """
+    Publishes the current contents of the tables in a replication set to a
+    handler as a single batch of ``INSERT`` mutations.
+
+    The tables are read by a pool of ``workers`` threads, each with their own
+    connection to the database that imports a snapshot exported by the
+    coordinating connection. Each table is read in chunks of approximately
+    ``chunk_size`` rows, which are published in the order of the tables in
+    the configuration (and by primary key within a table.) Rows are filtered
+    (and projected) in the same way as ``INSERT`` mutations by the relay.
+    """
+    def __init__(self, cluster, configuration, handler, workers=4, chunk_size=10000, connect=psycopg2.connect):
+        self.cluster = cluster
+        self.configuration = configuration
+        self.handler = handler
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        #: A callable that accepts a DSN, returning a ``psycopg2.connection``.
+        self.connect = connect
+
+        #: The number of rows that have been published.
+        self.count = 0
+
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+
+        # The exported snapshot and node ID of the coordinating connection.
+        self.__snapshot = None
+        self.__node_id = None
+
+        # The column converters for each table, by ``(schema, table)``.
+        self.__converters = {}
+
+    def __connection(self):
+        """
+        Returns the connection for the current worker thread, establishing it
+        (and importing the exported snapshot) if it has not already been.
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is not None:
+            return connection
+
+        connection = self.connect(self.configuration.database.dsn)
+        with self.__connections_lock:
+            self.__connections.append(connection)
+
+        connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        connection.set_client_encoding('UTF8')
+        with connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', (self.__snapshot,))
+
+            # Ensure that the snapshot was imported by the same database that
+            # exported it (and not another database that has been reached due
+            # to a DNS change, proxy configuration, etc.)
+            node_id = get_node_identifier(self.cluster, cursor)
+            if node_id != self.__node_id:
+                raise RuntimeError('Identifier mismatch: %s and %s' % (node_id, self.__node_id))
+
+        self.__local.connection = connection
+        return connection
+
+    def __get_columns(self, table):
+        if table.columns:
+            return ', '.join(map(quote, unique(list(table.primary_keys) + list(table.columns))))
+        else:
+            return '*'
+
+    def __get_chunks(self, table):
+        statement = COLUMNS_STATEMENT_TEMPLATE.format(
+            columns=self.__get_columns(table),
+            schema=quote(table.schema),
+            table=quote(table.name),
+        )
+        with self.__connection().cursor() as cursor:
+            cursor.execute(statement)
+            self.__converters[(table.schema, table.name)] = get_converters(cursor.description)
+
+        logger.debug('Reading %s.%s in chunks of %s rows.', table.schema, table.name, self.chunk_size)
+        return get_chunks(table, self.__get_boundaries(table))
+
+    def __get_boundaries(self, table):
+        keys = ', '.join(map(quote, table.primary_keys))
+        template = functools.partial(
+            CHUNK_BOUNDARY_STATEMENT_TEMPLATE.format,
+            keys=keys,
+            schema=quote(table.schema),
+            table=quote(table.name),
+        )
+
+        # Each boundary is only requested when the chunk before it is being
+        # scheduled, so that it is found with a short index scan from the
+        # previous boundary while the previous chunks are being read.
+        with self.__connection().cursor() as cursor:
+            cursor.execute(template(condition='true'), (self.chunk_size - 1,))
+            boundary = cursor.fetchone()
+            while boundary is not None:
+                yield boundary
+                cursor.execute(template(condition='(%s) > %%s' % (keys,)), (boundary, self.chunk_size - 1))
+                boundary = cursor.fetchone()
+
+    def __read(self, chunk):
+        table = chunk.table
+        keys = ', '.join(map(quote, table.primary_keys))
+
+        conditions = ['true']
+        parameters = []
+        if chunk.lower is not None:
+            conditions.append('({keys}) > %s'.format(keys=keys))
+            parameters.append(chunk.lower)
+        if chunk.upper is not None:
+            conditions.append('({keys}) <= %s'.format(keys=keys))
+            parameters.append(chunk.upper)
+
+        query = CHUNK_STATEMENT_TEMPLATE.format(
+            columns=self.__get_columns(table),
+            schema=quote(table.schema),
+            table=quote(table.name),
+            conditions=' AND '.join(conditions),
+            keys=keys,
+        )
+
+        reader = RowReader(self.__converters[(table.schema, table.name)])
+        with self.__connection().cursor() as cursor:
+            query = cursor.mogrify(query, parameters)
+            cursor.copy_expert('COPY (%s) TO STDOUT' % (query,), reader)
+
+        return chunk, reader.rows
+
+    def __close(self):
+        with self.__connections_lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections = []
+
+    def run(self):
+        """
+        Publishes the contents of the replication set tables, returning the
+        number of rows that were published.
+        """
+        connection = self.connect(self.configuration.database.dsn)
+        try:
+            # The snapshot is only able to be imported while the transaction
+            # that exported it is still open, so this connection must remain
+            # in the transaction until all of the chunks have been read.
+            connection.set_session(isolation_level='REPEATABLE READ')
+            with connection.cursor() as cursor:
+                cursor.execute(EXPORT_SNAPSHOT_STATEMENT)
+                self.__snapshot, transaction, snapshot, timestamp = cursor.fetchone()
+                self.__node_id = get_node_identifier(self.cluster, cursor)
+
+            logger.info('Bootstrapping from snapshot %s (exported as %s.)', snapshot, self.__snapshot)
+
+            tick = Tick(
+                id=0,
+                snapshot=to_snapshot(snapshot),
+                timestamp=to_timestamp(timestamp),
+            )
+            batch = BatchIdentifier(
+                id=BOOTSTRAP_BATCH_ID,
+                node=self.__node_id.bytes,
+            )
+
+            ids = itertools.count(1)
+
+            def to_mutation(table, row):
+                return MutationOperation(
+                    id=next(ids),
+                    schema=table.schema,
+                    table=table.name,
+                    operation=MutationOperation.INSERT,
+                    identity_columns=table.primary_keys,
+                    new=row_converter.to_protobuf(row),
+                    timestamp=tick.timestamp,
+                    transaction=transaction,
+                )
+
+            filters = compile_filters(self.configuration) or {}
+
+            started = time.time()
+            publisher = Publisher(self.handler.push)
+            with ThreadPoolExecutor(self.workers) as executor, \
+                    publisher.batch(batch, BeginOperation(start=tick, end=tick)) as publish:
+                chunks = itertools.chain.from_iterable(itertools.imap(self.__get_chunks, self.configuration.tables))
+
+                def publish_chunk(future):
+                    chunk, rows = future.result()
+                    apply = filters.get((chunk.table.schema, chunk.table.name))
+                    for row in rows:
+                        if apply is not None:
+                            result = apply('INSERT', None, row)
+                            if result is None:
+                                continue
+                            row = result[2]
+                        publish(to_mutation(chunk.table, row))
+                        self.count += 1
+
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(self.__read, chunk))
+                    if len(pending) >= self.workers * 2:
+                        publish_chunk(pending.popleft())
+
+                while pending:
+                    publish_chunk(pending.popleft())
+
+            elapsed = time.time() - started
+            logger.info('Bootstrapped %s rows in %.3f seconds (%.1f rows/s.)', self.count, elapsed, self.count / (elapsed or float('nan')))
+        finally:
+            self.__close()
+            connection.close()
+
+        return self.count
@@ -1,34 +1,158 @@
+import functools
 import logging
 import signal
+from collections import namedtuple
 
 import click
 
-from pgshovel.relay.relay import Relay
-from pgshovel.utilities import commands
+from pgshovel.cluster import Cluster
+from pgshovel.relay import pipeline
+from pgshovel.relay.evented import EventedRelay
+from pgshovel.relay.relay import (
+    AdaptiveBatching,
+    Relay,
+)
+from pgshovel.utilities import (
+    commands,
+    load,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
-def entrypoint(command):
+#: Relay handler commands, by name. (These are loaded when used, since some
+#: handlers require optional dependencies.)
+HANDLERS = {
+    'archive': 'pgshovel.relay.handlers.archive:main',
+    'bench': 'pgshovel.relay.handlers.bench:main',
+    'fanout': 'pgshovel.relay.handlers.fanout:main',
+    'kafka': 'pgshovel.relay.handlers.kafka:main',
+    'stream': 'pgshovel.relay.handlers.stream:main',
+}
+
+
+def parse_table(value):
+    """
+    Parses a table name (optionally qualified by its schema) into a
+    ``(schema, table)`` pair.
+    """
+    schema, _, table = value.rpartition('.')
+    if not table:
+        raise ValueError('Invalid table name: %r' % (value,))
+    return (schema or 'public', table)
+
+
+def entrypoint(command=None, set_options=(), multiple_sets=True):
     """
     Adds common command-line options, arguments, and signal handling to the
     provided relay constructor.
 
+    When several sets are relayed, a handler is constructed for each set, and
+    the handlers must not share a destination. ``set_options`` names the
+    handler options that determine the destination, which must then contain a
+    ``{set}`` placeholder. Handlers whose destination cannot be configured for
+    each set should set ``multiple_sets`` to ``False``.
+
     This must be the last (innermost) decorator used.
     """
-    @click.argument('set')
+    if command is None:
+        return functools.partial(entrypoint, set_options=set_options, multiple_sets=multiple_sets)
+
+    @click.argument('sets', nargs=-1, required=True)
     @click.option(
         '--consumer-id',
         default='default',
         help="PgQ consumer registration identifier.",
     )
+    @click.option(
+        '--engine',
+        type=click.Choice(['threaded', 'evented']),
+        default='threaded',
+        help="Relay implementation to use. The evented engine can relay several sets from a single thread.",
+    )
+    @click.option(
+        '--adaptive-batching/--no-adaptive-batching',
+        default=False,
+        help="Combine ticks into larger batches when the relay is behind.",
+    )
+    @click.option(
+        '--max-batch-events',
+        type=int,
+        default=100000,
+        help="Upper bound on the number of events that a batch waits for when adaptive batching is enabled.",
+    )
+    @click.option(
+        '--max-batch-latency',
+        type=float,
+        default=5.0,
+        help="Maximum number of seconds that a batch is delayed to collect events when adaptive batching is enabled.",
+    )
+    @click.option(
+        '--ledger/--no-ledger',
+        default=False,
+        help="Record published batches in ZooKeeper, so that they are not published again after a restart.",
+    )
+    @click.option(
+        '--table',
+        'tables',
+        multiple=True,
+        metavar='SCHEMA.TABLE',
+        help="Only relay the mutations of this table (may be repeated.) Other events are not read from the database.",
+    )
+    @click.option(
+        '--chunk-size',
+        type=int,
+        default=1,
+        help="Maximum number of messages of a batch that are provided to the handler at a time.",
+    )
+    @click.option(
+        '--stage',
+        'stages',
+        multiple=True,
+        metavar='NAME[:ARGUMENT]',
+        help="Add a processing stage ahead of the handler (may be repeated, stages are applied in order.) "
+             "Available stages: %s." % (', '.join(sorted(pipeline.STAGES)),),
+    )
     @commands.entrypoint
-    def decorated(cluster, set, consumer_id, *args, **kwargs):
-        handler = command(cluster, set, *args, **kwargs)
+    def decorated(cluster, sets, consumer_id, engine, adaptive_batching, max_batch_events, max_batch_latency, ledger, tables, chunk_size, stages, *args, **kwargs):
+        if engine == 'threaded' and len(sets) > 1:
+            raise click.UsageError('The threaded engine can only relay a single set (use --engine evented to relay several.)')
+
+        if len(sets) > 1:
+            if not multiple_sets:
+                raise click.UsageError('This handler can only relay a single set, since the sets would share its destination.')
+
+            for name in set_options:
+                if '{set}' not in kwargs[name]:
+                    raise click.BadParameter(
+                        'must contain a {set} placeholder when relaying several sets',
+                        param_hint='--%s' % (name.replace('_', '-'),),
+                    )
+
+        try:
+            tables = [parse_table(table) for table in tables]
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint='--table')
+
+        try:
+            stages = map(pipeline.parse_stage, stages)
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint='--stage')
+
+        handlers = dict((set, pipeline.build(stages, command(cluster, set, *args, **kwargs))) for set in sets)
+
+        if adaptive_batching:
+            batching = functools.partial(AdaptiveBatching, max_events=max_batch_events, max_latency=max_batch_latency)
+        else:
+            batching = None
 
         with cluster:
-            relay = Relay(cluster, set, consumer_id, handler)
+            if engine == 'evented':
+                relay = EventedRelay(cluster, sets, consumer_id, handlers, batching=batching, ledger=ledger, tables=tables, chunk_size=chunk_size)
+            else:
+                (set,) = sets
+                relay = Relay(cluster, set, consumer_id, handlers[set], batching=batching() if batching else None, ledger=ledger, tables=tables, chunk_size=chunk_size)
             relay.start()
 
             def __request_exit(signal, frame):
@@ -44,4 +168,55 @@ def entrypoint(command):
                     relay.result()
                     break
 
+    # The handler constructor, and the names of the parameters that are added
+    # by this decorator, are retained so that handlers can also be constructed
+    # outside of a relay process. (See ``HandlerCommand``.)
+    decorated.handler = command
+    decorated.entrypoint_parameters = frozenset(p.name for p in decorated.__click_params__)
+
     return decorated
+
+
+ConstructedHandler = namedtuple('ConstructedHandler', 'handler set')
+
+
+class HandlerCommand(click.MultiCommand):
+    """
+    A command that provides each relay handler as a subcommand, allowing
+    handlers to be constructed with their usual command line options outside
+    of a relay process.
+
+    Each subcommand accepts the options of the handler, as well as the name of
+    the replication set, and returns a ``ConstructedHandler``. The handler can
+    be used by providing a result callback to this command.
+    """
+    def list_commands(self, ctx):
+        return sorted(HANDLERS)
+
+    def get_command(self, ctx, name):
+        try:
+            command = load(HANDLERS[name])
+        except KeyError:
+            return None
+
+        callback = command.callback
+
+        def construct(set, **kwargs):
+            handler = callback.handler(ctx.find_object(Cluster), set, **kwargs)
+            return ConstructedHandler(handler, set)
+
+        params = [p for p in command.params if p.name not in callback.entrypoint_parameters]
+        params.append(click.Argument(('set',)))
+
+        return click.Command(name, params=params, callback=construct, help=command.help)
+
+
+def construct_handler(cluster, set, args):
+    """
+    Constructs a relay handler for the replication set from command line
+    arguments of the form ``HANDLER [OPTIONS]`` (for example, ``['kafka',
+    '--kafka-topic', 'example']``), using the ``HandlerCommand``.
+    """
+    command = HandlerCommand('handler')
+    with command.make_context('handler', list(args) + [set], obj=cluster) as ctx:
+        return command.invoke(ctx).handler
@@ -0,0 +1,727 @@
+"""
+An event-driven relay engine, which relays any number of replication sets
+from a single thread.
+
+Each replication set is relayed by a coroutine (a generator that yields the
+statements that it needs to have executed, and receives their results), which
+is run against an asynchronous ``psycopg2`` connection by a ``Task``. A single
+``EventLoop`` waits on the sockets of all connections at once, so that idle
+sets do not each require a thread that polls for new batches. Sets that were
+idle are checked for new batches again after a fixed interval.
+
+ZooKeeper watches are delivered on the ZooKeeper client thread, and are handed
+over to the event loop thread, where all changes to the relay state are made.
+Handlers are called on the event loop thread as well, so a handler that
+blocks while publishing delays the other sets relayed by the same process.
+"""
+import collections
+import errno
+import fcntl
+import functools
+import heapq
+import itertools
+import logging
+import math
+import os
+import select
+import sys
+import threading
+import time
+import uuid
+
+import psycopg2
+import psycopg2.extensions
+from concurrent.futures import Future
+from kazoo.client import KazooState
+from kazoo.recipe.watchers import DataWatch
+
+from pgshovel.database import (
+    CONFIGURATION_VALUE_STATEMENT_TEMPLATE,
+    NODE_ID_KEY,
+)
+from pgshovel.interfaces.common_pb2 import (
+    BatchIdentifier,
+    Tick,
+)
+from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.interfaces.streams_pb2 import BeginOperation
+from pgshovel.relay.filters import compile_filters
+from pgshovel.relay.ledger import Ledger
+from pgshovel.relay.relay import (
+    BATCH_INFO_STATEMENT,
+    FINISH_BATCH_STATEMENT,
+    NEXT_BATCH_CUSTOM_STATEMENT,
+    NEXT_BATCH_INFO_STATEMENT,
+    RECOVERABLE_ERRORS,
+    get_batch_events_query,
+    to_mutation,
+)
+from pgshovel.streams.publisher import Publisher
+from pgshovel.utilities.conversions import (
+    to_snapshot,
+    to_timestamp,
+)
+from pgshovel.utilities.postgresql import quote
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class Timer(object):
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    A minimal single-threaded event loop, which dispatches callbacks for file
+    descriptor readiness (using ``poll``), timers, and callbacks that have
+    been scheduled by other threads.
+
+    Callbacks that are scheduled with ``call_soon`` are run on the next
+    iteration of the loop (rather than immediately), so that a busy task
+    cannot starve other tasks of their turn.
+    """
+    def __init__(self):
+        self.__poll = select.poll()
+        self.__handlers = {}
+
+        self.__timers = []
+        self.__sequence = itertools.count()
+
+        self.__ready = collections.deque()
+        self.__ready_lock = threading.Lock()
+
+        self.__running = False
+        self.__closed = False
+
+        # Writing to this pipe interrupts ``poll``, so that callbacks that are
+        # scheduled from other threads are run promptly.
+        self.__wakeup_read, self.__wakeup_write = os.pipe()
+        for fd in (self.__wakeup_read, self.__wakeup_write):
+            set_nonblocking(fd)
+        self.__poll.register(self.__wakeup_read, select.POLLIN)
+
+    def __repr__(self):
+        return '<%s: %s handlers, %s timers>' % (type(self).__name__, len(self.__handlers), len(self.__timers))
+
+    def call_soon(self, callback, *args):
+        with self.__ready_lock:
+            self.__ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self.__ready_lock:
+            if self.__closed:
+                logger.debug('Discarding %r, event loop has been closed.', callback)
+                return
+            self.__ready.append((callback, args))
+            try:
+                os.write(self.__wakeup_write, '\0')
+            except OSError as error:
+                if error.errno != errno.EAGAIN:
+                    raise
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.__timers, (timer.deadline, next(self.__sequence), timer))
+        return timer
+
+    def watch(self, fd, events, callback):
+        """
+        Calls ``callback`` with the returned events when the file descriptor
+        is ready for any of the requested ``events``. The callback remains
+        registered until ``unwatch`` is called.
+        """
+        if fd in self.__handlers:
+            self.__poll.modify(fd, events)
+        else:
+            self.__poll.register(fd, events)
+        self.__handlers[fd] = callback
+
+    def unwatch(self, fd):
+        if self.__handlers.pop(fd, None) is not None:
+            self.__poll.unregister(fd)
+
+    def __get_timeout(self):
+        with self.__ready_lock:
+            if self.__ready:
+                return 0
+
+        while self.__timers and self.__timers[0][2].cancelled:
+            heapq.heappop(self.__timers)
+
+        if self.__timers:
+            return max(0, int(math.ceil((self.__timers[0][0] - time.time()) * 1000)))
+        else:
+            return None
+
+    def run(self):
+        """
+        Runs the loop until ``stop`` is called.
+        """
+        self.__running = True
+        while self.__running:
+            try:
+                events = self.__poll.poll(self.__get_timeout())
+            except select.error as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, revents in events:
+                if fd == self.__wakeup_read:
+                    try:
+                        while os.read(self.__wakeup_read, 4096):
+                            pass
+                    except OSError as error:
+                        if error.errno != errno.EAGAIN:
+                            raise
+                    continue
+
+                handler = self.__handlers.get(fd)
+                if handler is not None:
+                    handler(revents)
+
+            now = time.time()
+            while self.__timers and self.__timers[0][0] <= now:
+                deadline, sequence, timer = heapq.heappop(self.__timers)
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+            # Only the callbacks that were ready before this point are run, so
+            # that callbacks which schedule further callbacks yield to the
+            # other handlers first.
+            with self.__ready_lock:
+                ready, self.__ready = self.__ready, collections.deque()
+            for callback, args in ready:
+                callback(*args)
+
+    def stop(self):
+        self.__running = False
+
+    def close(self):
+        with self.__ready_lock:
+            self.__closed = True
+            os.close(self.__wakeup_read)
+            os.close(self.__wakeup_write)
+
+
+Query = collections.namedtuple('Query', 'statement parameters')
+
+Sleep = collections.namedtuple('Sleep', 'seconds')
+
+
+class TaskCancelled(Exception):
+    """
+    Raised within the coroutine of a task that has been cancelled.
+    """
+
+
+def connect_async(dsn):
+    return psycopg2.connect(dsn, async=True)
+
+
+class Task(object):
+    """
+    Runs a coroutine against an asynchronous connection to a database.
+
+    The coroutine yields ``Query`` objects to have a statement executed (and
+    is sent the resulting rows, or ``None`` if the statement does not return
+    any rows), or ``Sleep`` objects to be resumed after a delay. Errors are
+    raised within the coroutine at the point that the query was yielded.
+
+    When the coroutine exits, the connection is closed, and ``callback`` is
+    called with the task and the ``sys.exc_info()`` of the error that the
+    coroutine exited with (or ``None``, if it returned.)
+    """
+    def __init__(self, loop, dsn, coroutine, callback, connect=connect_async):
+        self.loop = loop
+        self.dsn = dsn
+        self.coroutine = coroutine
+        self.callback = callback
+        self.connect = connect
+
+        #: The time that the task was started.
+        self.started = None
+
+        self.connection = None
+
+        self.__fd = None
+        self.__timer = None
+        self.__finished = False
+
+    def __repr__(self):
+        return '<%s: %s (%s)>' % (type(self).__name__, self.dsn, 'finished' if self.__finished else 'running')
+
+    def start(self):
+        self.started = time.time()
+        try:
+            self.connection = self.connect(self.dsn)
+        except Exception:
+            self.__finish(sys.exc_info())
+        else:
+            self.__wait(self.__resume)
+
+    def __unwatch(self):
+        if self.__fd is not None:
+            self.loop.unwatch(self.__fd)
+            self.__fd = None
+
+    def __wait(self, callback):
+        """
+        Polls the connection until the operation in progress is complete, and
+        then calls ``callback`` with ``(None, error)``.
+        """
+        if self.__finished:
+            return
+
+        try:
+            state = self.connection.poll()
+        except Exception:
+            self.__unwatch()
+            self.loop.call_soon(callback, None, sys.exc_info())
+            return
+
+        if state == psycopg2.extensions.POLL_OK:
+            self.__unwatch()
+            self.loop.call_soon(callback, None, None)
+        elif state in (psycopg2.extensions.POLL_READ, psycopg2.extensions.POLL_WRITE):
+            events = select.POLLIN if state == psycopg2.extensions.POLL_READ else select.POLLOUT
+            self.__fd = self.connection.fileno()
+            self.loop.watch(self.__fd, events, lambda revents: self.__wait(callback))
+        else:
+            error = psycopg2.OperationalError('Unexpected connection state: %s' % (state,))
+            self.__unwatch()
+            self.loop.call_soon(callback, None, (type(error), error, None))
+
+    def __execute(self, query):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(query.statement, query.parameters)
+        except Exception:
+            self.loop.call_soon(self.__resume, None, sys.exc_info())
+            return
+
+        def complete(value, error):
+            if error is None:
+                try:
+                    value = cursor.fetchall() if cursor.description is not None else None
+                except Exception:
+                    error = sys.exc_info()
+            self.__resume(value, error)
+
+        self.__wait(complete)
+
+    def __wake(self):
+        self.__timer = None
+        self.__resume(None, None)
+
+    def __resume(self, value, error):
+        if self.__finished:
+            return
+
+        try:
+            if error is not None:
+                operation = self.coroutine.throw(*error)
+            else:
+                operation = self.coroutine.send(value)
+        except StopIteration:
+            self.__finish(None)
+            return
+        except Exception:
+            self.__finish(sys.exc_info())
+            return
+
+        if isinstance(operation, Query):
+            self.__execute(operation)
+        elif isinstance(operation, Sleep):
+            self.__timer = self.loop.call_later(operation.seconds, self.__wake)
+        else:
+            error = TypeError('Cannot handle operation: %r' % (operation,))
+            self.loop.call_soon(self.__resume, None, (type(error), error, None))
+
+    def wake(self):
+        """
+        Resumes the coroutine immediately, if it is sleeping.
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+            self.loop.call_soon(self.__resume, None, None)
+
+    def cancel(self):
+        """
+        Raises ``TaskCancelled`` within the coroutine, and closes the
+        connection (abandoning any transaction that is in progress.)
+        """
+        if self.__finished:
+            return
+
+        try:
+            self.coroutine.throw(TaskCancelled())
+        except (TaskCancelled, StopIteration):
+            pass
+        except Exception as error:
+            logger.warning('Caught exception while cancelling %r: %s', self, error, exc_info=True)
+        else:
+            self.coroutine.close()
+
+        error = TaskCancelled()
+        self.__finish((type(error), error, None))
+
+    def __finish(self, exc_info):
+        self.__finished = True
+        self.__unwatch()
+
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as error:
+                logger.info('Could not close connection: %s', error, exc_info=True)
+
+        self.callback(self, exc_info)
+
+
+def relay_set(cluster, set, consumer, handler, stopping, batching=None, idle_interval=0.5, fetch_size=1000, ledger=None, get_filters=lambda: None, tables=None, chunk_size=1):
+    """
+    Returns a coroutine (for use with a ``Task``) that relays the batches of a
+    replication set to the handler. This is the equivalent of
+    ``pgshovel.relay.relay.Worker``.
+
+    The coroutine returns between batches once ``stopping`` returns ``True``.
+    The current filters for the set are retrieved with ``get_filters`` at the
+    start of each batch.
+    """
+    queue = cluster.get_queue_name(set)
+    tables = frozenset(tables) if tables else None
+
+    statement = CONFIGURATION_VALUE_STATEMENT_TEMPLATE.format(schema=quote(cluster.schema))
+    ((node_id,),) = yield Query(statement, (NODE_ID_KEY,))
+    node_id = uuid.UUID(str(node_id))
+    logger.debug('Connected to %s as %s.', set, node_id)
+
+    if ledger is not None:
+        # This is the only time the ledger is read from ZooKeeper -- the last
+        # recorded batch is kept in memory afterwards.
+        ledger.load(node_id.bytes)
+
+    # Asynchronous connections are always in autocommit mode, so the consumer
+    # registration does not need an explicit transaction.
+    parameters = (queue, consumer)
+    ((new,),) = yield Query("SELECT * FROM pgq.register_consumer(%s, %s)", parameters)
+    logger.info('Registered %s as queue consumer: %s (%s registration).', set, consumer, 'new' if new else 'existing')
+
+    for prepared in (NEXT_BATCH_INFO_STATEMENT, NEXT_BATCH_CUSTOM_STATEMENT, BATCH_INFO_STATEMENT, FINISH_BATCH_STATEMENT):
+        yield Query(prepared.get_prepare_statement(), ())
+
+    publisher = Publisher(handler.push, chunk_size)
+
+    while not stopping():
+        yield Query('BEGIN', ())
+
+        # Check to see if there is a batch available to be relayed.
+        if batching is None:
+            parameters = (queue, consumer)
+            ((batch_id,),) = yield Query(NEXT_BATCH_INFO_STATEMENT.get_execute_statement(parameters), parameters)
+        else:
+            parameters = (queue, consumer) + batching.get_parameters()
+            ((batch_id,),) = yield Query(NEXT_BATCH_CUSTOM_STATEMENT.get_execute_statement(parameters), parameters)
+
+        if batch_id is None:
+            yield Query('COMMIT', ())
+            yield Sleep(idle_interval)
+            continue
+
+        parameters = (batch_id,)
+        ((start_id, start_snapshot, start_timestamp, end_id, end_snapshot, end_timestamp, lag),) = yield Query(
+            BATCH_INFO_STATEMENT.get_execute_statement(parameters),
+            parameters,
+        )
+
+        batch = BatchIdentifier(
+            id=batch_id,
+            node=node_id.bytes,
+        )
+
+        begin = BeginOperation(
+            start=Tick(
+                id=start_id,
+                snapshot=to_snapshot(start_snapshot),
+                timestamp=to_timestamp(start_timestamp),
+            ),
+            end=Tick(
+                id=end_id,
+                snapshot=to_snapshot(end_snapshot),
+                timestamp=to_timestamp(end_timestamp),
+            ),
+        )
+
+        events = 0
+        convert = functools.partial(to_mutation, filters=get_filters(), tables=tables)
+        if ledger is not None and ledger.is_published(batch):
+            logger.info('Skipping batch %s of %s, which has already been published.', batch_id, set)
+            ((success,),) = yield Query(FINISH_BATCH_STATEMENT.get_execute_statement(parameters), parameters)
+            if not success:
+                raise RuntimeError('Could not close batch!')
+        else:
+            with publisher.batch(batch, begin) as publish:
+                # The events are read through a cursor, to avoid having to
+                # load the entire event block into memory at once.
+                statement, events_parameters = get_batch_events_query(batch_id, tables)
+                yield Query('DECLARE pgshovel_events NO SCROLL CURSOR FOR %s' % (statement,), events_parameters)
+
+                while True:
+                    rows = yield Query('FETCH %s FROM pgshovel_events', (fetch_size,))
+                    if not rows:
+                        break
+
+                    for mutation in itertools.imap(convert, rows):
+                        if mutation is not None:
+                            publish(mutation)
+                    events += len(rows)
+
+                yield Query('CLOSE pgshovel_events', ())
+
+                ((success,),) = yield Query(FINISH_BATCH_STATEMENT.get_execute_statement(parameters), parameters)
+                if not success:
+                    raise RuntimeError('Could not close batch!')
+
+            if ledger is not None:
+                ledger.record(batch)
+
+        yield Query('COMMIT', ())
+
+        logger.debug('Successfully relayed batch %s.', batch)
+
+        if batching is not None:
+            batching.update(events, float(lag))
+
+
+class EventedRelay(threading.Thread):
+    """
+    Relays the batches of several replication sets, using a single thread.
+
+    This provides the same API as ``pgshovel.relay.relay.Relay``, but accepts
+    a sequence of set names, and a mapping of set names to handlers.
+    """
+    def __init__(self, cluster, sets, consumer, handlers, throttle=10, batching=None, idle_interval=0.5, stop_timeout=10, connect=connect_async, ledger=False, tables=None, chunk_size=1):
+        super(EventedRelay, self).__init__(name='relay')
+        self.daemon = True
+
+        self.cluster = cluster
+        self.sets = sets
+        self.consumer = consumer
+        self.handlers = handlers
+        self.throttle = throttle
+
+        #: A callable that returns a new ``AdaptiveBatching`` instance for each
+        #: set (if batches should be combined when a set is behind.)
+        self.batching = batching
+
+        #: The number of seconds to wait before checking an idle set for new
+        #: batches.
+        self.idle_interval = idle_interval
+
+        #: The number of seconds to wait for in progress batches to be
+        #: completed when stopping.
+        self.stop_timeout = stop_timeout
+
+        #: A callable that accepts a DSN, returning an asynchronous
+        #: ``psycopg2.connection``.
+        self.connect = connect
+
+        #: Whether or not published batches are recorded in a ``Ledger`` (for
+        #: each set.)
+        self.ledger = ledger
+
+        #: The ``(schema, table)`` pairs to relay the mutations of (if not all
+        #: of the tables in the replication sets.)
+        self.tables = tables
+
+        #: The maximum number of messages provided to each handler at a time.
+        self.chunk_size = chunk_size
+
+        self.__loop = EventLoop()
+
+        self.__stopping = False
+        self.__error = None
+
+        # The DSN, compiled filters, current task, and pending restart timer
+        # for each set.
+        self.__dsns = {}
+        self.__filters = {}
+        self.__tasks = {}
+        self.__restarts = {}
+
+        self.__result = Future()
+        self.__result.set_running_or_notify_cancel()  # cannot be cancelled
+
+    def __start_task(self, set):
+        self.__restarts.pop(set, None)
+
+        batching = self.batching() if self.batching is not None else None
+        coroutine = relay_set(
+            self.cluster,
+            set,
+            self.consumer,
+            self.handlers[set],
+            lambda: self.__stopping,
+            batching,
+            self.idle_interval,
+            ledger=Ledger(self.cluster, set, self.consumer) if self.ledger else None,
+            get_filters=functools.partial(self.__filters.get, set),
+            tables=self.tables,
+            chunk_size=self.chunk_size,
+        )
+
+        task = self.__tasks[set] = Task(
+            self.__loop,
+            self.__dsns[set],
+            coroutine,
+            functools.partial(self.__handle_task_exit, set),
+            self.connect,
+        )
+        logger.debug('Starting %r for %s...', task, set)
+        task.start()
+
+    def __handle_task_exit(self, set, task, exc_info):
+        if self.__tasks.get(set) is not task:
+            return  # this task has been replaced, and is no longer relevant
+
+        del self.__tasks[set]
+
+        if exc_info is not None and not issubclass(exc_info[0], TaskCancelled):
+            error = exc_info[1]
+            if self.__stopping:
+                logger.warning('%s exited with error while stopping: %s', set, error)
+            elif isinstance(error, RECOVERABLE_ERRORS):
+                delay = max(0, task.started + self.throttle - time.time())
+                logger.info('Restarting %s in %.1f seconds, previously exited with recoverable error: %s', set, delay, error)
+                self.__restarts[set] = self.__loop.call_later(delay, self.__start_task, set)
+            else:
+                logger.error('Caught exception in %s: %s', set, error, exc_info=exc_info)
+                self.__error = exc_info
+                self.__stop()
+
+        if self.__stopping and not self.__tasks:
+            self.__loop.stop()
+
+    def __configure(self, set, data):
+        if self.__stopping:
+            return
+
+        if data is None:
+            logger.warning('Received no replication set configuration data for %s! Requesting exit...', set)
+            self.__stop()
+            return
+
+        logger.debug('Recieved an update to replication set configuration for %s.', set)
+        configuration = BinaryCodec(ReplicationSetConfiguration).decode(data)
+        self.__filters[set] = compile_filters(configuration)
+
+        dsn = configuration.database.dsn
+        if self.__dsns.get(set) == dsn:
+            return
+
+        self.__dsns[set] = dsn
+
+        restart = self.__restarts.pop(set, None)
+        if restart is not None:
+            restart.cancel()
+
+        task = self.__tasks.pop(set, None)
+        if task is not None:
+            task.cancel()
+
+        self.__start_task(set)
+
+    def __stop(self):
+        if self.__stopping:
+            return
+
+        logger.debug('Stopping %s tasks...', len(self.__tasks))
+        self.__stopping = True
+
+        for restart in self.__restarts.values():
+            restart.cancel()
+        self.__restarts.clear()
+
+        # Idle tasks are woken up, so that they can exit immediately. Tasks
+        # that are relaying a batch exit once the batch is complete.
+        for task in self.__tasks.values():
+            task.wake()
+
+        if self.__tasks:
+            self.__loop.call_later(self.stop_timeout, self.__abandon)
+        else:
+            self.__loop.stop()
+
+    def __abandon(self):
+        logger.warning('Exiting with %s tasks still running!', len(self.__tasks))
+        for task in self.__tasks.values():
+            task.cancel()
+        self.__tasks.clear()
+        self.__loop.stop()
+
+    def run(self):
+        def __handle_session_state_change(state):
+            if state == KazooState.SUSPENDED:
+                logger.warning('Lost connection to ZooKeeper! Requesting exit...')
+                self.stop_async()
+
+        def __handle_configuration_change(set, data, stat):
+            if self.__stopping:
+                return False
+            self.__loop.call_soon_threadsafe(self.__configure, set, data)
+
+        try:
+            logger.debug('Started relay (cluster: %s, sets: %s).', self.cluster, ', '.join(self.sets))
+
+            self.cluster.zookeeper.add_listener(__handle_session_state_change)
+
+            for set in self.sets:
+                DataWatch(
+                    self.cluster.zookeeper,
+                    self.cluster.get_set_path(set),
+                    functools.partial(__handle_configuration_change, set),
+                )
+
+            self.__loop.run()
+        except Exception as error:
+            logger.exception('Caught exception in relay: %s', error)
+            self.__result.set_exception(error)
+        else:
+            if self.__error is not None:
+                self.__result.set_exception(self.__error[1])
+            else:
+                logger.debug('Stopped.')
+                self.__result.set_result(None)
+        finally:
+            for task in self.__tasks.values():
+                task.cancel()
+            self.__loop.close()
+            self.cluster.zookeeper.remove_listener(__handle_session_state_change)
+
+    def result(self, timeout=None):
+        return self.__result.result(timeout)
+
+    def stop_async(self):
+        logger.debug('Requesting stop...')
+        self.__loop.call_soon_threadsafe(self.__stop)
+        return self.__result
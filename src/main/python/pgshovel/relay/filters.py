@@ -0,0 +1,120 @@
+"""
+Filtering and projection of mutations by the relay, as configured by the
+``filter`` of each ``TableConfiguration`` in a replication set.
+
+Filters are compiled into functions once for each configuration, and are
+applied to the decoded event payloads, so that no messages are constructed
+for mutations that are not published.
+"""
+from pgshovel.interfaces.configurations_pb2 import (
+    ColumnPredicate,
+    TableFilterConfiguration,
+)
+from pgshovel.utilities import unique
+
+
+def to_python(value):
+    """
+    Returns the Python representation of a ``Value``, as it would appear in a
+    decoded event payload.
+    """
+    field = value.WhichOneof('value')
+    if field is None:
+        return None
+
+    result = getattr(value, field)
+    if isinstance(result, unicode):
+        result = result.encode('utf-8')
+    return result
+
+
+def compile_predicate(predicate):
+    """
+    Returns a function that accepts a row (as a dictionary), and returns
+    whether or not the row satisfies the ``ColumnPredicate``.
+    """
+    column = predicate.column
+    values = frozenset(map(to_python, predicate.values))
+
+    if predicate.operator == ColumnPredicate.IN:
+        return lambda row: row.get(column) in values
+    elif predicate.operator == ColumnPredicate.NOT_IN:
+        return lambda row: row.get(column) not in values
+    else:
+        raise ValueError('Unknown operator: %s' % (predicate.operator,))
+
+
+def compile_table_filter(table):
+    """
+    Returns a function for the filter of the provided ``TableConfiguration``
+    that accepts the operation (as a string) and the old and new states of a
+    mutated row, and returns the ``(operation, old, new)`` to be published, or
+    ``None`` if the mutation should not be published.
+
+    The predicates of an update are evaluated against both the old and the
+    new state of the row, so that consumers see rows enter and leave the
+    filtered subset of the table: an update of a row that no longer satisfies
+    the predicates is published as a ``DELETE`` (of the old state), and an
+    update of a row that now satisfies them is published as an ``INSERT`` (of
+    the new state.) The operations filter applies to the published operation.
+    """
+    configuration = table.filter
+
+    if configuration.operations:
+        operations = frozenset(TableFilterConfiguration.Operation.Name(operation) for operation in configuration.operations)
+    else:
+        operations = None
+
+    predicates = map(compile_predicate, configuration.predicates)
+
+    if configuration.columns:
+        columns = unique(list(table.primary_keys) + list(configuration.columns))
+        project = lambda row: dict((column, row[column]) for column in columns if column in row) if row else row
+    else:
+        project = None
+
+    def matches(row):
+        return all(predicate(row) for predicate in predicates)
+
+    def apply(operation, old, new):
+        if predicates:
+            if operation == 'UPDATE':
+                if not matches(new):
+                    operation, new = 'DELETE', None
+                if not matches(old):
+                    operation, old = 'INSERT', None
+                if not old and not new:
+                    return None
+            elif not matches(new if new else old):
+                return None
+
+        if operations is not None and operation not in operations:
+            return None
+
+        if project is not None:
+            return operation, project(old), project(new)
+        else:
+            return operation, old, new
+
+    return apply
+
+
+def compile_filters(configuration):
+    """
+    Returns a dictionary of compiled table filters for a
+    ``ReplicationSetConfiguration``, keyed by ``(schema, table)``, or ``None``
+    if none of the tables in the replication set have a filter.
+    """
+    filters = {}
+    for table in configuration.tables:
+        if table.HasField('filter'):
+            filters[(table.schema, table.name)] = compile_table_filter(table)
+    return filters or None
+
+
+def get_filter_columns(table):
+    """
+    Returns the set of columns that are referenced by the filter of a
+    ``TableConfiguration``.
+    """
+    return set(predicate.column for predicate in table.filter.predicates) | set(table.filter.columns)
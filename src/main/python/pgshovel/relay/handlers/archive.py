@@ -0,0 +1,89 @@
+import atexit
+import functools
+import threading
+
+import click
+
+from pgshovel.relay.entrypoint import entrypoint
+from pgshovel.streams.archives import (
+    COMPRESSION,
+    SegmentWriter,
+)
+
+
+class ArchiveWriter(object):
+    def __init__(self, segments):
+        self.segments = segments
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        return 'Archive writer (directory: %s)' % (self.segments,)
+
+    def push(self, messages):
+        with self.__lock:
+            for message in messages:
+                self.segments.write(message)
+
+    def close(self):
+        with self.__lock:
+            self.segments.close()
+
+
+@click.command(
+    help="Archives mutation batches to rotating segment files in the specified directory.",
+)
+@click.option(
+    '--directory',
+    type=click.Path(file_okay=False, writable=True),
+    required=True,
+    help="Path to archive directory. This may contain {cluster} and {set} placeholders ({set} is required when "
+         "relaying several sets.)",
+)
+@click.option(
+    '--max-segment-size',
+    type=int,
+    default=256 * 1024 * 1024,
+    help="Size (in uncompressed bytes) after which the segment is rotated at the end of the current batch.",
+)
+@click.option(
+    '--max-segment-age',
+    type=float,
+    default=3600,
+    help="Age (in seconds) after which the segment is rotated at the end of the current batch.",
+)
+@click.option(
+    '--compression',
+    type=click.Choice(sorted(name for name in COMPRESSION if name is not None)),
+    help="Compression to use for each segment.",
+)
+@click.option(
+    '--buffer-size',
+    type=int,
+    default=1024 * 1024,
+    help="Size of the write buffer (in bytes.)",
+)
+@click.option(
+    '--fsync/--no-fsync',
+    default=True,
+    help="Sync segments to disk at the end of every batch.",
+)
+@entrypoint(set_options=('directory',))
+def main(cluster, set, directory, max_segment_size, max_segment_age, compression, buffer_size, fsync):
+    writer = ArchiveWriter(
+        SegmentWriter(
+            directory.format(cluster=cluster.name, set=set),
+            max_size=max_segment_size,
+            max_age=max_segment_age,
+            compression=compression,
+            buffer_size=buffer_size,
+            fsync=fsync,
+        ),
+    )
+    atexit.register(writer.close)  # complete the current segment when exiting
+    return writer
+
+
+__main__ = functools.partial(main, auto_envvar_prefix='PGSHOVEL')
+
+if __name__ == '__main__':
+    __main__()
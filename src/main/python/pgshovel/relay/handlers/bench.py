@@ -0,0 +1,183 @@
+import atexit
+import functools
+import logging
+import threading
+import time
+
+import click
+
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.relay.entrypoint import entrypoint
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+class SizeDistribution(object):
+    """
+    Records an approximate distribution of sizes using power-of-two buckets,
+    avoiding the need to retain every observed value.
+    """
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, size):
+        self.buckets[size.bit_length()] += 1
+        self.count += 1
+        self.total += size
+        self.maximum = max(self.maximum, size)
+
+    def percentile(self, percentile):
+        """
+        Returns the upper bound of the bucket containing the requested
+        percentile (or ``None`` if no values have been recorded.)
+        """
+        if not self.count:
+            return None
+
+        threshold = self.count * percentile / 100.0
+        seen = 0
+        for bits, count in enumerate(self.buckets):
+            seen += count
+            if seen >= threshold:
+                return min((1 << bits) - 1, self.maximum)
+
+    def __str__(self):
+        if not self.count:
+            return '(empty)'
+
+        return 'mean: %.1f, p50: <=%s, p90: <=%s, p99: <=%s, max: %s' % (
+            self.total / float(self.count),
+            self.percentile(50),
+            self.percentile(90),
+            self.percentile(99),
+            self.maximum,
+        )
+
+
+class BenchmarkWriter(object):
+    """
+    Discards all messages, while recording throughput statistics.
+
+    The time between receiving the first message of a batch and receiving the
+    terminal (commit or rollback) message is attributed to either the handler
+    (time spent within ``push``), or the worker (the remainder of the time,
+    spent retrieving and decoding events, and publishing.) Time between
+    batches is recorded as idle time, which includes time spent waiting for
+    new batches to become available.
+    """
+    def __init__(self, codec, interval=10.0, set=None):
+        self.codec = codec
+        self.interval = interval
+
+        #: The name of the replication set (if any), which identifies the
+        #: reports of this writer when several sets are relayed.
+        self.set = set
+
+        self.sizes = SizeDistribution()
+        self.messages = 0
+        self.batches = 0
+
+        self.handler_time = 0.0
+        self.worker_time = 0.0
+        self.idle_time = 0.0
+
+        self.__lock = threading.Lock()
+        self.__started = None
+        self.__last = None  # time the last push returned
+        self.__in_batch = False
+        self.__last_report = (None, 0, 0)  # time, messages, batches
+
+    def __str__(self):
+        if self.set is not None:
+            return 'Benchmark writer (set: %s, codec: %s)' % (self.set, type(self.codec).__name__)
+        return 'Benchmark writer (codec: %s)' % (type(self.codec).__name__,)
+
+    def push(self, messages):
+        start = time.time()
+        with self.__lock:
+            if self.__started is None:
+                self.__started = start
+                self.__last_report = (start, 0, 0)
+            elif self.__in_batch:
+                self.worker_time += start - self.__last
+            else:
+                self.idle_time += start - self.__last
+
+            for message in messages:
+                self.sizes.add(len(self.codec.encode(message)))
+                self.messages += 1
+
+                operation = message.batch_operation.WhichOneof('operation')
+                if operation == 'begin_operation':
+                    self.__in_batch = True
+                elif operation in ('commit_operation', 'rollback_operation'):
+                    self.__in_batch = False
+                    self.batches += 1
+
+            self.__last = time.time()
+            self.handler_time += self.__last - start
+
+            if self.__last - self.__last_report[0] >= self.interval:
+                self.__report()
+
+    def report(self):
+        """
+        Logs the statistics that have been collected.
+        """
+        with self.__lock:
+            self.__report()
+
+    def __report(self):
+        now = time.time()
+        last, messages, batches = self.__last_report
+        self.__last_report = (now, self.messages, self.batches)
+
+        if self.__started is None:
+            logger.info('%s: No messages received.', self)
+            return
+
+        elapsed = (now - last) or float('nan')
+        busy = (self.handler_time + self.worker_time) or float('nan')
+        logger.info(
+            '%s: Received %s messages in %s batches (%.1f messages/s, %.1f batches/s over last %.1fs). '
+            'Worker: %.1f%% (%.3fs), handler: %.1f%% (%.3fs), idle: %.3fs. Message sizes: %s',
+            self,
+            self.messages,
+            self.batches,
+            (self.messages - messages) / elapsed,
+            (self.batches - batches) / elapsed,
+            now - last,
+            self.worker_time / busy * 100,
+            self.worker_time,
+            self.handler_time / busy * 100,
+            self.handler_time,
+            self.idle_time,
+            self.sizes,
+        )
+
+
+@click.command(
+    help="Discards mutation batches, while recording relay throughput statistics.",
+)
+@click.option(
+    '--report-interval',
+    type=float,
+    default=10.0,
+    help="Interval between throughput reports (in seconds.)",
+)
+@entrypoint
+def main(cluster, set, report_interval):
+    writer = BenchmarkWriter(BinaryCodec(Message), report_interval, set)
+    atexit.register(writer.report)  # report the final totals when exiting
+    return writer
+
+
+__main__ = functools.partial(main, auto_envvar_prefix='PGSHOVEL')
+
+if __name__ == '__main__':
+    __main__()
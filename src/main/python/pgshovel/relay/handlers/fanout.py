@@ -0,0 +1,68 @@
+import functools
+import shlex
+
+import click
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    wait,
+)
+
+from pgshovel.relay.entrypoint import (
+    construct_handler,
+    entrypoint,
+)
+
+
+class FanoutWriter(object):
+    """
+    Pushes messages to several handlers concurrently, so that a relay can
+    publish a replication set to more than one destination while only reading
+    and decoding its events once.
+
+    Each push returns once every handler has accepted the messages, so a batch
+    is only finished after all of the handlers have acknowledged it. If any of
+    the handlers fail, an error is raised once all of the handlers have
+    returned.
+    """
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+        # The last handler is pushed to from the calling thread.
+        self.__executor = ThreadPoolExecutor(max(len(handlers) - 1, 1))
+
+    def __str__(self):
+        return 'Fan-out writer (%s)' % (', '.join(map(str, self.handlers)),)
+
+    def push(self, messages):
+        messages = tuple(messages)  # shared between all of the handlers
+
+        futures = [self.__executor.submit(handler.push, messages) for handler in self.handlers[:-1]]
+        try:
+            self.handlers[-1].push(messages)
+        finally:
+            wait(futures)
+
+        for future in futures:
+            future.result()
+
+
+@click.command(
+    help="Publishes mutation batches to several relay handlers concurrently.",
+)
+@click.option(
+    '--handler',
+    'handlers',
+    multiple=True,
+    required=True,
+    metavar='"HANDLER [OPTIONS]"',
+    help="A handler and its options, as they would be provided to the replay or bootstrap commands (may be repeated.)",
+)
+@entrypoint(multiple_sets=False)
+def main(cluster, set, handlers):
+    return FanoutWriter([construct_handler(cluster, set, shlex.split(handler)) for handler in handlers])
+
+
+__main__ = functools.partial(main, auto_envvar_prefix='PGSHOVEL')
+
+if __name__ == '__main__':
+    __main__()
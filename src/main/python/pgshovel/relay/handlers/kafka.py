@@ -1,11 +1,17 @@
 from __future__ import absolute_import
 
+import collections
 import functools
+import itertools
 import threading
+import uuid
 
 import click
 
-from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.interfaces.streams_pb2 import (
+    Header,
+    Message,
+)
 from pgshovel.relay.entrypoint import entrypoint
 from pgshovel.utilities import import_extras
 from pgshovel.utilities.protobuf import BinaryCodec
@@ -41,6 +47,124 @@ class KafkaWriter(object):
             self.producer.send_messages(self.topic, *map(self.codec.encode, messages))
 
 
+class TableRouter(object):
+    """
+    Routes the messages of a stream to a topic for each table, using a topic
+    name template that contains ``{schema}`` and/or ``{table}`` placeholders.
+
+    Each topic is a valid stream on its own. Messages are resequenced with a
+    separate publisher for each topic, and a batch is only published to the
+    topics of the tables that it contains mutations for: the begin operation
+    is published to a topic ahead of the first mutation that is routed to it,
+    and the commit (or rollback) operation is published to every topic that
+    the batch was published to.
+    """
+    def __init__(self, template):
+        self.template = template
+
+        self.__topics = {}
+
+        # The upstream publisher, and the publisher ID and sequence for each
+        # topic. (These are reset whenever the upstream publisher changes.)
+        self.__publisher = None
+        self.__publishers = {}
+
+        # The begin message of the batch in progress, and the topics that it
+        # has been published to.
+        self.__begin = None
+        self.__open = []
+
+    def get_topic(self, schema, table):
+        key = (schema, table)
+        topic = self.__topics.get(key)
+        if topic is None:
+            topic = self.__topics[key] = self.template.format(schema=schema, table=table)
+        return topic
+
+    def __resequence(self, topic, message):
+        try:
+            publisher, sequence = self.__publishers[topic]
+        except KeyError:
+            publisher, sequence = self.__publishers[topic] = (uuid.uuid1().bytes, itertools.count(0))
+
+        return Message(
+            header=Header(
+                publisher=publisher,
+                sequence=next(sequence),
+                timestamp=message.header.timestamp,
+            ),
+            batch_operation=message.batch_operation,
+        )
+
+    def route(self, messages):
+        """
+        Returns a list of ``(topic, messages)`` pairs for the provided
+        messages, in the order that each topic was first routed to.
+        """
+        routes = collections.OrderedDict()
+
+        def send(topic, message):
+            routes.setdefault(topic, []).append(self.__resequence(topic, message))
+
+        for message in messages:
+            if message.header.publisher != self.__publisher:
+                self.__publisher = message.header.publisher
+                self.__publishers.clear()
+                self.__begin = None
+                self.__open = []
+
+            operation = message.batch_operation.WhichOneof('operation')
+            if operation == 'begin_operation':
+                self.__begin = message
+                self.__open = []
+            elif operation == 'mutation_operation':
+                mutation = message.batch_operation.mutation_operation
+                topic = self.get_topic(mutation.schema, mutation.table)
+                if topic not in self.__open:
+                    send(topic, self.__begin)
+                    self.__open.append(topic)
+                send(topic, message)
+            else:
+                for topic in self.__open:
+                    send(topic, message)
+                self.__begin = None
+                self.__open = []
+
+        return routes.items()
+
+
+class RoutingKafkaWriter(object):
+    """
+    Publishes mutations to a Kafka topic for each table, using a
+    ``TableRouter``.
+    """
+    def __init__(self, producer, router, codec):
+        self.producer = producer
+        self.router = router
+        self.codec = codec
+
+        self.__topics = set()
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        return 'Kafka writer (topics: %s, codec: %s)' % (self.router.template, type(self.codec).__name__)
+
+    def __repr__(self):
+        return '<%s: %s on %r>' % (
+            type(self).__name__,
+            self.router.template,
+            [':'.join(map(str, h)) for h in self.producer.client.hosts]
+        )
+
+    def push(self, messages):
+        with self.__lock:
+            for topic, messages in self.router.route(messages):
+                if topic not in self.__topics:
+                    self.producer.client.ensure_topic_exists(topic)
+                    self.__topics.add(topic)
+                self.producer.send_messages(topic, *map(self.codec.encode, messages))
+
+
 @click.command(
     help="Publishes mutation batches to the specified Kafka topic.",
 )
@@ -52,14 +176,19 @@ class KafkaWriter(object):
 @click.option(
     '--kafka-topic',
     default='{cluster}.{set}.mutations',
-    help="Destination Topic for mutation batch publishing.",
+    help="Destination Topic for mutation batch publishing. If the topic contains {schema} or {table} placeholders, "
+         "the mutations for each table are published to a separate topic. ({set} is required when relaying several "
+         "sets.)",
 )
-@entrypoint
+@entrypoint(set_options=('kafka_topic',))
 def main(cluster, set, kafka_hosts, kafka_topic):
     client = KafkaClient(kafka_hosts)
     producer = SimpleProducer(client)
-    topic = kafka_topic.format(cluster=cluster.name, set=set)
-    return KafkaWriter(producer, topic, BinaryCodec(Message))
+    topic = kafka_topic.format(cluster=cluster.name, set=set, schema='{schema}', table='{table}')
+    if '{schema}' in topic or '{table}' in topic:
+        return RoutingKafkaWriter(producer, TableRouter(topic), BinaryCodec(Message))
+    else:
+        return KafkaWriter(producer, topic, BinaryCodec(Message))
 
 
 __main__ = functools.partial(main, auto_envvar_prefix='PGSHOVEL')
@@ -35,7 +35,7 @@ class StreamWriter(object):
     default='-',
     help="Path to output file.",
 )
-@entrypoint
+@entrypoint(multiple_sets=False)
 def main(cluster, set, stream):
     return StreamWriter(stream, TextCodec(Message))
 
@@ -0,0 +1,120 @@
+"""
+Tracking of the batches that have been published by a relay, so that batches
+are not published again after the relay restarts.
+"""
+import functools
+import logging
+import threading
+import uuid
+
+from kazoo.exceptions import NoNodeError
+
+from pgshovel.interfaces.common_pb2 import BatchIdentifier
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+class Ledger(object):
+    """
+    Records the last batch that has been published by a replication set
+    consumer for each database node in ZooKeeper.
+
+    A batch is recorded after it has been published to the handler, but
+    before the queue transaction that finishes the batch is committed. If the
+    relay exits between those two points, the queue provides the same batch
+    again when the relay restarts, and the ledger allows it to be finished
+    without being published a second time. (Recording the batch within the
+    queue transaction would not help, since the record would be rolled back
+    along with the rest of that transaction.)
+
+    A relay that exits after publishing a batch but before it is recorded can
+    still publish the batch again, so consumers must continue to tolerate
+    duplicate batches -- the ledger only narrows the window in which they
+    occur.
+
+    The ledger of each node is only read from ZooKeeper once (when the node is
+    first used), and the last recorded batch is kept in memory after that.
+    Batches are recorded asynchronously, so that publishing is not blocked on
+    a round trip to ZooKeeper. If a write fails, the error is raised by the
+    next call to ``record``.
+    """
+    codec = BinaryCodec(BatchIdentifier)
+
+    def __init__(self, cluster, set, consumer):
+        self.cluster = cluster
+        self.set = set
+        self.consumer = consumer
+
+        self.__lock = threading.Lock()
+        self.__batches = {}
+        self.__error = None
+
+    def __repr__(self):
+        return '<%s: %s/%s>' % (type(self).__name__, self.set, self.consumer)
+
+    def get_path(self, node):
+        return self.cluster.get_ledger_path(self.set, self.consumer, uuid.UUID(bytes=node).hex)
+
+    def get(self, node):
+        """
+        Returns the ``BatchIdentifier`` of the last batch that was published
+        from the node, or ``None`` if no batches have been recorded.
+        """
+        try:
+            data, stat = self.cluster.zookeeper.get(self.get_path(node))
+        except NoNodeError:
+            return None
+        return self.codec.decode(data)
+
+    def load(self, node):
+        """
+        Returns the ``BatchIdentifier`` of the last batch that was published
+        from the node (as ``get`` does), reading it from ZooKeeper only if it
+        has not already been loaded.
+        """
+        with self.__lock:
+            try:
+                return self.__batches[node]
+            except KeyError:
+                batch_identifier = self.__batches[node] = self.get(node)
+                return batch_identifier
+
+    def is_published(self, batch_identifier):
+        return self.load(batch_identifier.node) == batch_identifier
+
+    def record(self, batch_identifier):
+        """
+        Records a batch as the last batch published from its node.
+        """
+        previous = self.load(batch_identifier.node)
+
+        with self.__lock:
+            if self.__error is not None:
+                error, self.__error = self.__error, None
+                raise error
+
+            self.__batches[batch_identifier.node] = batch_identifier
+
+        path = self.get_path(batch_identifier.node)
+        data = self.codec.encode(batch_identifier)
+        if previous is None:
+            # Requests from a session are processed in order, so any writes
+            # that follow this one are applied after the node is created.
+            logger.debug('Creating ledger for %s at %s...', self, path)
+            result = self.cluster.zookeeper.create_async(path, data, makepath=True)
+        else:
+            result = self.cluster.zookeeper.set_async(path, data)
+        result.rawlink(functools.partial(self.__written, batch_identifier.node))
+
+    def __written(self, node, result):
+        try:
+            result.get()
+        except Exception as error:
+            logger.error('Could not record batch in %s: %s', self, error)
+            with self.__lock:
+                # The ledger is read again from ZooKeeper when it is next
+                # used, since the batch in memory may not have been written.
+                self.__batches.pop(node, None)
+                self.__error = error
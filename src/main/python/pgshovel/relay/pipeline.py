@@ -0,0 +1,310 @@
+"""
+Processing stages that can be chained between a relay and its handler.
+
+Each stage is constructed with the next stage (or handler) in the chain, and
+implements the same ``push`` API as a handler, so that a chain of stages can
+be used anywhere that a handler can. Messages are passed along the chain in
+the chunks that they are published in, rather than one at a time, to keep the
+overhead of each stage low.
+"""
+import collections
+import fnmatch
+import logging
+import threading
+import time
+import zlib
+
+from pgshovel.interfaces.common_pb2 import Row
+from pgshovel.interfaces.streams_pb2 import (
+    BatchOperation,
+    Header,
+    Message,
+    MutationOperation,
+)
+from pgshovel.utilities.conversions import row_converter
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_mutation(message):
+    """
+    Returns the ``MutationOperation`` of a message, or ``None`` if the message
+    is not a mutation.
+    """
+    operation = message.batch_operation
+    if operation.WhichOneof('operation') == 'mutation_operation':
+        return operation.mutation_operation
+
+
+class Resequencer(object):
+    """
+    Renumbers the messages of a stream that messages have been removed from,
+    so that the sequence of each publisher remains contiguous.
+
+    Messages are only copied when their sequence changes (they may also have
+    been provided to other handlers, so they are never modified.)
+    """
+    def __init__(self):
+        self.__publisher = None
+        self.__sequence = None
+
+    def resequence(self, messages):
+        result = []
+        for message in messages:
+            header = message.header
+            if header.publisher != self.__publisher:
+                self.__publisher = header.publisher
+                self.__sequence = header.sequence
+
+            if header.sequence != self.__sequence:
+                message = Message(
+                    header=Header(
+                        publisher=header.publisher,
+                        sequence=self.__sequence,
+                        timestamp=header.timestamp,
+                    ),
+                    batch_operation=message.batch_operation,
+                )
+
+            self.__sequence += 1
+            result.append(message)
+        return result
+
+
+class Stage(object):
+    """
+    Base class for pipeline stages, which transform each chunk of messages
+    with ``process`` before pushing the result to the next handler.
+
+    Stages may remove mutations from the stream, but must retain all other
+    messages, so that the batches remain valid. Stages that remove messages
+    should set ``resequence``.
+    """
+    #: Whether or not the messages returned by ``process`` need to be
+    #: resequenced before they are pushed to the next handler.
+    resequence = False
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.__resequencer = Resequencer() if self.resequence else None
+
+    def __str__(self):
+        return '%s -> %s' % (type(self).__name__, self.handler)
+
+    def process(self, messages):
+        """
+        Returns the sequence of messages to push to the next handler.
+        """
+        raise NotImplementedError
+
+    def push(self, messages):
+        messages = self.process(messages)
+        if self.__resequencer is not None:
+            messages = self.__resequencer.resequence(messages)
+        if messages:
+            self.handler.push(messages)
+
+
+class TableFilter(Stage):
+    """
+    Removes the mutations of tables that do not match any of the provided
+    ``fnmatch`` patterns (for example, ``public.auth_*``.) Patterns without a
+    schema match tables in the ``public`` schema.
+    """
+    resequence = True
+
+    def __init__(self, handler, patterns):
+        super(TableFilter, self).__init__(handler)
+        self.patterns = [pattern if '.' in pattern else 'public.%s' % (pattern,) for pattern in patterns]
+        self.__matches = {}
+
+    def matches(self, schema, table):
+        key = (schema, table)
+        try:
+            return self.__matches[key]
+        except KeyError:
+            name = '%s.%s' % key
+            result = self.__matches[key] = any(fnmatch.fnmatchcase(name, pattern) for pattern in self.patterns)
+            return result
+
+    def process(self, messages):
+        result = []
+        for message in messages:
+            mutation = get_mutation(message)
+            if mutation is None or self.matches(mutation.schema, mutation.table):
+                result.append(message)
+        return result
+
+
+class ColumnFilter(Stage):
+    """
+    Removes the provided columns from the rows of all mutations. Identity
+    columns are never removed.
+    """
+    def __init__(self, handler, columns):
+        super(ColumnFilter, self).__init__(handler)
+        self.columns = frozenset(columns)
+
+    def __project(self, mutation):
+        excluded = self.columns.difference(mutation.identity_columns)
+
+        def project(row):
+            return Row(columns=[column for column in row.columns if column.name not in excluded])
+
+        projected = MutationOperation()
+        projected.CopyFrom(mutation)
+        for state in ('old', 'new'):
+            if mutation.HasField(state):
+                getattr(projected, state).CopyFrom(project(getattr(mutation, state)))
+        return projected
+
+    def process(self, messages):
+        result = []
+        for message in messages:
+            mutation = get_mutation(message)
+            if mutation is not None and any(
+                column.name in self.columns
+                for row in (mutation.old, mutation.new)
+                for column in row.columns
+            ):
+                message = Message(
+                    header=message.header,
+                    batch_operation=BatchOperation(
+                        batch_identifier=message.batch_operation.batch_identifier,
+                        mutation_operation=self.__project(mutation),
+                    ),
+                )
+            result.append(message)
+        return result
+
+
+class Sample(Stage):
+    """
+    Retains the mutations of approximately ``rate`` (between 0 and 1) of the
+    rows of each table. Rows are selected by the hash of their identity, so
+    that all of the mutations of a selected row are retained.
+    """
+    resequence = True
+
+    def __init__(self, handler, rate):
+        super(Sample, self).__init__(handler)
+        self.rate = rate
+        self.__threshold = int(rate * (1 << 32))
+
+    def selected(self, mutation):
+        row = row_converter.to_python(mutation.new if mutation.HasField('new') else mutation.old)
+        identity = (mutation.schema, mutation.table, tuple(row.get(column) for column in mutation.identity_columns))
+        return (zlib.crc32(repr(identity)) & 0xffffffff) < self.__threshold
+
+    def process(self, messages):
+        result = []
+        for message in messages:
+            mutation = get_mutation(message)
+            if mutation is None or self.selected(mutation):
+                result.append(message)
+        return result
+
+
+class Metrics(Stage):
+    """
+    Counts the mutations that pass through the stage by table and operation,
+    logging the counts every ``interval`` seconds.
+    """
+    def __init__(self, handler, interval=10.0):
+        super(Metrics, self).__init__(handler)
+        self.interval = interval
+
+        self.counts = collections.Counter()
+
+        self.__lock = threading.Lock()
+        self.__last_report = (time.time(), collections.Counter())
+
+    def process(self, messages):
+        counts = collections.Counter()
+        for message in messages:
+            mutation = get_mutation(message)
+            if mutation is not None:
+                counts[(mutation.schema, mutation.table, mutation.operation)] += 1
+
+        with self.__lock:
+            self.counts.update(counts)
+            if time.time() - self.__last_report[0] >= self.interval:
+                self.__report()
+
+        return messages
+
+    def report(self):
+        """
+        Logs the counts that have been collected.
+        """
+        with self.__lock:
+            self.__report()
+
+    def __report(self):
+        now = time.time()
+        last, counts = self.__last_report
+        self.__last_report = (now, self.counts.copy())
+
+        elapsed = (now - last) or float('nan')
+        for (schema, table, operation), count in sorted(self.counts.items()):
+            logger.info(
+                '%s.%s %s: %s mutations (%.1f/s over last %.1fs)',
+                schema,
+                table,
+                MutationOperation.Operation.Name(operation),
+                count,
+                (count - counts[(schema, table, operation)]) / elapsed,
+                now - last,
+            )
+
+
+def split(argument):
+    return [value for value in argument.split(',') if value]
+
+
+def parse_rate(argument):
+    rate = float(argument)
+    if not 0 <= rate <= 1:
+        raise ValueError('rate must be between 0 and 1')
+    return rate
+
+
+#: Stages that can be configured on the command line, by name, along with a
+#: function that parses the argument of the stage specification.
+STAGES = {
+    'tables': (TableFilter, split),
+    'exclude-columns': (ColumnFilter, split),
+    'sample': (Sample, parse_rate),
+    'metrics': (Metrics, lambda argument: float(argument) if argument else 10.0),
+}
+
+
+def parse_stage(specification):
+    """
+    Parses a stage specification of the form ``name[:argument]`` (for
+    example, ``sample:0.01``), returning a function that accepts the next
+    handler and returns the configured stage.
+    """
+    name, _, argument = specification.partition(':')
+    try:
+        cls, parse = STAGES[name]
+    except KeyError:
+        raise ValueError('Unknown stage %r (must be one of: %s)' % (name, ', '.join(sorted(STAGES))))
+
+    try:
+        argument = parse(argument)
+    except ValueError as error:
+        raise ValueError('Invalid argument for stage %r: %s' % (name, error))
+
+    return lambda handler: cls(handler, argument)
+
+
+def build(stages, handler):
+    """
+    Returns a chain of stages (as returned by ``parse_stage``) that ends with
+    the provided handler. The first stage receives messages first.
+    """
+    for stage in reversed(stages):
+        handler = stage(handler)
+    return handler
@@ -18,7 +18,10 @@ from kazoo.client import KazooState
 from kazoo.recipe.watchers import DataWatch
 
 from pgshovel import __version__
-from pgshovel.database import ManagedDatabase
+from pgshovel.database import (
+    ManagedDatabase,
+    PreparedStatement,
+)
 from pgshovel.interfaces.common_pb2 import (
     BatchIdentifier,
     Snapshot,
@@ -33,6 +36,8 @@ from pgshovel.interfaces.streams_pb2 import (
     BeginOperation,
     MutationOperation,
 )
+from pgshovel.relay.filters import compile_filters
+from pgshovel.relay.ledger import Ledger
 from pgshovel.streams.publisher import Publisher
 from pgshovel.utilities.conversions import (
     row_converter,
@@ -45,24 +50,53 @@ from pgshovel.utilities.protobuf import BinaryCodec
 logger = logging.getLogger(__name__)
 
 
-BATCH_INFO_STATEMENT = """
+# The statements that are executed for every batch are prepared on each
+# connection, so that they are only parsed and planned once per session.
+
+BATCH_INFO_STATEMENT = PreparedStatement('pgshovel_batch_info', """
 SELECT
     start_tick.tick_id,
     start_tick.tick_snapshot,
     extract(epoch from start_tick.tick_time),
     end_tick.tick_id,
     end_tick.tick_snapshot,
-    extract(epoch from end_tick.tick_time)
+    extract(epoch from end_tick.tick_time),
+    extract(epoch from now() - end_tick.tick_time)
 FROM
-    pgq.get_batch_info(%s) batch,
+    pgq.get_batch_info($1) batch,
     pgq.tick start_tick,
     pgq.tick end_tick
 WHERE
     start_tick.tick_id = batch.prev_tick_id AND end_tick.tick_id = batch.tick_id
-"""
+""", ('bigint',))
+
+
+BATCH_EVENTS_STATEMENT = "SELECT ev_id, ev_data, extract(epoch from ev_time), ev_txid FROM pgq.get_batch_events(%s)"
+
+# The log trigger records the schema and table of each event in the first two
+# extra fields. Events that were logged before these were recorded are always
+# selected, and are filtered once their payloads have been decoded.
+BATCH_EVENTS_TABLES_CLAUSE = " WHERE ev_extra1 IS NULL OR (ev_extra1, ev_extra2) IN %s"
 
 
-def to_mutation(row):
+def get_batch_events_query(batch_id, tables=None):
+    """
+    Returns the statement and parameters that select the events of a batch.
+    If a collection of ``(schema, table)`` pairs is provided, only the events
+    for those tables are selected by the database.
+    """
+    if not tables:
+        return BATCH_EVENTS_STATEMENT, (batch_id,)
+    return BATCH_EVENTS_STATEMENT + BATCH_EVENTS_TABLES_CLAUSE, (batch_id, tuple(sorted(tables)))
+
+
+def to_mutation(row, filters=None, tables=None):
+    """
+    Returns a ``MutationOperation`` for an event row. If filters (as returned
+    by ``compile_filters``) are provided and the mutation is filtered out, or
+    a collection of ``(schema, table)`` pairs is provided and does not contain
+    the table of the mutation, ``None`` is returned instead.
+    """
     id, payload, timestamp, transaction = row
 
     version, payload = payload.split(':', 1)
@@ -71,6 +105,17 @@ def to_mutation(row):
 
     (schema, table), operation, primary_key_columns, (old, new), configuration_version = pickle.loads(payload)
 
+    if tables is not None and (schema, table) not in tables:
+        return None
+
+    if filters is not None:
+        apply = filters.get((schema, table))
+        if apply is not None:
+            result = apply(operation, old, new)
+            if result is None:
+                return None
+            operation, old, new = result
+
     states = {}
     if old:
         states['old'] = row_converter.to_protobuf(old)
@@ -92,24 +137,127 @@ def to_mutation(row):
     )
 
 
+NEXT_BATCH_INFO_STATEMENT = PreparedStatement(
+    'pgshovel_next_batch_info',
+    "SELECT batch_id FROM pgq.next_batch_info($1, $2)",
+    ('text', 'text'),
+)
+
+NEXT_BATCH_CUSTOM_STATEMENT = PreparedStatement('pgshovel_next_batch_custom', """
+SELECT batch_id FROM pgq.next_batch_custom(
+    $1,
+    $2,
+    $3 * interval '1 second',
+    $4,
+    $5 * interval '1 second'
+)
+""", ('text', 'text', 'double precision', 'integer', 'double precision'))
+
+FINISH_BATCH_STATEMENT = PreparedStatement(
+    'pgshovel_finish_batch',
+    "SELECT * FROM pgq.finish_batch($1)",
+    ('bigint',),
+)
+
+
+class AdaptiveBatching(object):
+    """
+    Controls the size of the batches that are requested from the queue by a
+    worker, using ``pgq.next_batch_custom``.
+
+    When the end of a batch was more than ``target_latency`` seconds old when
+    it was retrieved, the worker is behind, and the minimum number of events
+    per batch is doubled (up to ``max_events``) so that several ticks are
+    combined into a single batch, reducing the per-batch overhead while the
+    worker catches up. When the worker is caught up, the minimum is halved
+    until it is removed entirely, returning to tick-to-tick batches.
+
+    While a minimum number of events is requested, batches are also allowed
+    to end once they cover ``max_latency`` seconds (PgQ creates the batch
+    when either condition is satisfied), so that a quiet queue is not delayed
+    indefinitely waiting for more events.
+    """
+    def __init__(self, max_events=100000, target_latency=1.0, max_latency=5.0):
+        self.max_events = max_events
+        self.target_latency = target_latency
+        self.max_latency = max_latency
+
+        #: The current minimum number of events per batch (or ``None``, if
+        #: batches are not being combined.)
+        self.min_events = None
+
+    def __repr__(self):
+        return '<%s: %s minimum events>' % (type(self).__name__, self.min_events)
+
+    def get_parameters(self):
+        """
+        Returns the ``(min_lag, min_count, min_interval)`` parameters for
+        ``pgq.next_batch_custom`` (with intervals in seconds.)
+        """
+        if self.min_events is None:
+            return (None, None, None)
+        else:
+            return (None, self.min_events, self.max_latency)
+
+    def update(self, events, lag):
+        """
+        Updates the minimum batch size, given the number of events in the last
+        batch and the age (in seconds) of the end of the batch when it was
+        retrieved.
+        """
+        if lag > self.target_latency:
+            self.min_events = min(max(self.min_events, events, 1) * 2, self.max_events)
+        elif self.min_events is not None:
+            self.min_events = self.min_events // 2 or None
+
+
 class Worker(threading.Thread):
-    def __init__(self, cluster, dsn, set, consumer, handler):
+    def __init__(self, cluster, dsn, set, consumer, handler, database_factory=ManagedDatabase, batching=None, ledger=None, filters=None, tables=None, chunk_size=1):
         super(Worker, self).__init__(name=dsn)
         self.daemon = True
 
         self.cluster = cluster
-        self.database = ManagedDatabase(cluster, dsn)
+        self.database = database_factory(cluster, dsn)
         self.set = set
         self.consumer = consumer
         self.handler = handler
 
+        #: An ``AdaptiveBatching`` instance, if batches should be combined
+        #: when the worker is behind (otherwise, each batch spans one tick.)
+        self.batching = batching
+
+        #: A ``Ledger`` instance, if published batches should be recorded (and
+        #: not published again if they are provided by the queue again.)
+        self.ledger = ledger
+
+        #: The compiled filters for the replication set (see
+        #: ``compile_filters``.) This may be replaced while the worker is
+        #: running, and takes effect from the next batch.
+        self.filters = filters
+
+        #: The ``(schema, table)`` pairs to relay the mutations of, if only a
+        #: subset of the tables in the replication set should be relayed.
+        self.tables = frozenset(tables) if tables else None
+
+        #: The maximum number of messages provided to the handler at a time.
+        self.chunk_size = chunk_size
+
         self.__stop_requested = threading.Event()
 
         self.__result = Future()
         self.__result.set_running_or_notify_cancel()  # cannot be cancelled
 
+    def __finish_batch(self, connection, batch_id):
+        with connection.cursor() as cursor:
+            FINISH_BATCH_STATEMENT.execute(cursor, (batch_id,))
+            (success,) = cursor.fetchone()
+
+        # XXX: Not sure why this could happen?
+        if not success:
+            raise RuntimeError('Could not close batch!')
+
     def run(self):
-        publisher = Publisher(self.handler.push)
+        publisher = Publisher(self.handler.push, self.chunk_size)
 
         try:
             logger.debug('Started worker.')
@@ -125,27 +273,41 @@ class Worker(threading.Thread):
                 logger.info('Registered as queue consumer: %s (%s registration).', self.consumer, 'new' if new else 'existing')
                 connection.commit()
 
+            if self.ledger is not None:
+                # This is the only time the ledger is read from ZooKeeper --
+                # the last recorded batch is kept in memory afterwards.
+                self.ledger.load(self.database.id.bytes)
+
             logger.info('Ready to relay events.')
+            idle = False
             while True:
-                if self.__stop_requested.wait(0.01):
+                # Only wait between batches when there was nothing to consume,
+                # so that a backlog can be relayed without delay.
+                if self.__stop_requested.wait(0.01) if idle else self.__stop_requested.is_set():
                     break
 
                 # TODO: this needs a timeout as well
                 # TODO: this probably should have a lock on consumption
                 with self.database.connection() as connection:
                     # Check to see if there is a batch available to be relayed.
-                    statement = "SELECT batch_id FROM pgq.next_batch_info(%s, %s)"
+                    parameters = (self.cluster.get_queue_name(self.set), self.consumer)
                     with connection.cursor() as cursor:
-                        cursor.execute(statement, (self.cluster.get_queue_name(self.set), self.consumer,))
+                        if self.batching is None:
+                            NEXT_BATCH_INFO_STATEMENT.execute(cursor, parameters)
+                        else:
+                            NEXT_BATCH_CUSTOM_STATEMENT.execute(cursor, parameters + self.batching.get_parameters())
                         (batch_id,) = cursor.fetchone()
+                        idle = batch_id is None
                         if batch_id is None:
                             connection.commit()
                             continue  #  There is nothing to consume.
 
                     # Fetch the details of the batch.
                     with connection.cursor() as cursor:
-                        cursor.execute(BATCH_INFO_STATEMENT, (batch_id,))
-                        start_id, start_snapshot, start_timestamp, end_id, end_snapshot, end_timestamp = cursor.fetchone()
+                        BATCH_INFO_STATEMENT.execute(cursor, (batch_id,))
+                        # The lag is calculated by the database, so that it
+                        # is not affected by the clock of the relay host.
+                        start_id, start_snapshot, start_timestamp, end_id, end_snapshot, end_timestamp, lag = cursor.fetchone()
 
                     batch = BatchIdentifier(
                         id=batch_id,
@@ -165,38 +327,53 @@ class Worker(threading.Thread):
                         ),
                     )
 
-                    with publisher.batch(batch, begin) as publish:
-                        # Fetch the events for the batch. This uses a named cursor
-                        # to avoid having to load the entire event block into
-                        # memory at once.
-                        with connection.cursor('events') as cursor:
-                            statement = "SELECT ev_id, ev_data, extract(epoch from ev_time), ev_txid FROM pgq.get_batch_events(%s)"
-                            cursor.execute(statement, (batch_id,))
+                    events = 0
+                    convert = functools.partial(to_mutation, filters=self.filters, tables=self.tables)
+                    if self.ledger is not None and self.ledger.is_published(batch):
+                        # The batch was published before the relay last
+                        # exited, but the queue transaction was not committed.
+                        logger.info('Skipping batch %s, which has already been published.', batch_id)
+                        self.__finish_batch(connection, batch_id)
+                    else:
+                        with publisher.batch(batch, begin) as publish:
+                            # Fetch the events for the batch. This uses a named cursor
+                            # to avoid having to load the entire event block into
+                            # memory at once.
+                            with connection.cursor('events') as cursor:
+                                cursor.execute(*get_batch_events_query(batch_id, self.tables))
 
-                            for mutation in itertools.imap(to_mutation, cursor):
-                                publish(mutation)
+                                for mutation in itertools.imap(convert, cursor):
+                                    if mutation is not None:
+                                        publish(mutation)
+                                    events += 1
 
-                        with connection.cursor() as cursor:
-                            cursor.execute("SELECT * FROM pgq.finish_batch(%s)", (batch_id,))
-                            (success,) = cursor.fetchone()
+                            self.__finish_batch(connection, batch_id)
 
-                        # XXX: Not sure why this could happen?
-                        if not success:
-                            raise RuntimeError('Could not close batch!')
+                        if self.ledger is not None:
+                            self.ledger.record(batch)
 
                     # XXX: Since this is outside of the batch block, this
                     # downstream consumers need to be able to handle receiving
                     # the same transaction multiple times, probably by checking
-                    # a metadata table before starting to apply a batch.
+                    # a metadata table before starting to apply a batch. (The
+                    # ledger avoids this when the relay exits here, but not
+                    # when it exits before the batch has been recorded.)
                     connection.commit()
 
                     logger.debug('Successfully relayed batch %s.', batch)
 
+                    if self.batching is not None:
+                        self.batching.update(events, float(lag))
+
         except Exception as error:
             logger.exception('Caught exception in worker: %s', error)
+            self.database.close()
             self.__result.set_exception(error)
         else:
             logger.debug('Stopped.')
+            # The connection is released before the result is set, so that it
+            # can be reused as soon as the worker has stopped.
+            self.database.close()
             self.__result.set_result(None)
 
     def result(self, timeout=None):
@@ -215,7 +392,7 @@ WorkerState = namedtuple('WorkerState', 'worker time')
 
 
 class Relay(threading.Thread):
-    def __init__(self, cluster, set, consumer, handler, throttle=10):
+    def __init__(self, cluster, set, consumer, handler, throttle=10, database_factory=ManagedDatabase, batching=None, ledger=False, tables=None, chunk_size=1):
         super(Relay, self).__init__(name='relay')
         self.daemon = True
 
@@ -225,6 +402,25 @@ class Relay(threading.Thread):
         self.handler = handler
         self.throttle = throttle
 
+        #: A callable that accepts the cluster and a DSN, returning a
+        #: ``ManagedDatabase`` (or an object that implements the same API)
+        #: that is used by the workers.
+        self.database_factory = database_factory
+
+        #: An ``AdaptiveBatching`` instance that is used by the workers (if
+        #: batches should be combined when the workers are behind.)
+        self.batching = batching
+
+        #: The ``Ledger`` that published batches are recorded in (if enabled.)
+        self.ledger = Ledger(cluster, set, consumer) if ledger else None
+
+        #: The ``(schema, table)`` pairs to relay the mutations of (if not all
+        #: of the tables in the replication set.)
+        self.tables = tables
+
+        #: The maximum number of messages provided to the handler at a time.
+        self.chunk_size = chunk_size
+
         self.__stop_requested = threading.Event()
 
         self.__result = Future()
@@ -273,8 +469,8 @@ class Relay(threading.Thread):
             stopping = []
 
             # XXX just store the config
-            def start_worker(dsn):
-                worker = Worker(self.cluster, dsn, self.set, self.consumer, self.handler)
+            def start_worker(dsn, filters):
+                worker = Worker(self.cluster, dsn, self.set, self.consumer, self.handler, self.database_factory, self.batching, self.ledger, filters, self.tables, self.chunk_size)
                 worker.start()
                 return WorkerState(worker, time.time())
 
@@ -291,14 +487,18 @@ class Relay(threading.Thread):
                 logger.debug('Recieved an update to replication set configuration.')
                 configuration = BinaryCodec(ReplicationSetConfiguration).decode(data)
 
+                filters = compile_filters(configuration)
+
                 with self.__worker_state_lock:
                     # TODO: this is annoying and repetative and should be cleaned up
                     if self.__worker_state is None:
-                        self.__worker_state = start_worker(configuration.database.dsn)
+                        self.__worker_state = start_worker(configuration.database.dsn, filters)
                     elif self.__worker_state.worker.database.dsn != configuration.database.dsn:
                         self.__worker_state.worker.stop_async()
                         stopping.append(WorkerState(self.__worker_state.worker, time.time()))
-                        self.__worker_state = start_worker(configuration.database.dsn)
+                        self.__worker_state = start_worker(configuration.database.dsn, filters)
+                    else:
+                        self.__worker_state.worker.filters = filters
 
             logger.debug('Fetching replication set configuration...')
             DataWatch(
@@ -321,7 +521,7 @@ class Relay(threading.Thread):
                             if time.time() > (self.__worker_state.time + self.throttle):
                                 logger.info('Trying to restart %r, previously exited with recoverable error: %s', self.__worker_state.worker, error)
                                 # TODO: hack, make a restart method
-                                self.__worker_state = start_worker(self.__worker_state.worker.database.dsn)
+                                self.__worker_state = start_worker(self.__worker_state.worker.database.dsn, self.__worker_state.worker.filters)
                         else:
                             # otherwise, exit immediately
                             raise RuntimeError('Found unexpected dead worker: %r' % (self.__worker_state.worker,))
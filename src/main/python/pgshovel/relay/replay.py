@@ -0,0 +1,111 @@
+"""
+Tools for replaying archived streams into relay handlers.
+"""
+import collections
+import itertools
+import logging
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+class Replayer(object):
+    """
+    Replays an archive (starting from an optional position) into a handler.
+
+    Payloads are read from the archive in chunks of ``batch_size`` messages,
+    decoded by a pool of ``workers`` threads (so that decoding can continue
+    while the handler is blocked on I/O), and each chunk is provided to the
+    handler in a single ``push`` call. The replay rate can be limited to
+    ``rate`` messages per second.
+
+    The messages are replayed with their original headers, so the output
+    stream has the same publisher and sequence framing as the original
+    stream. If the replay starts in the middle of a publisher's stream, the
+    messages from that publisher are given a new publisher ID and renumbered
+    from zero (since validators require that a publisher's stream starts at
+    the beginning.)
+    """
+    codec = BinaryCodec(Message)
+
+    def __init__(self, reader, handler, position=None, rate=None, batch_size=1000, workers=4):
+        self.reader = reader
+        self.handler = handler
+        self.position = position
+        self.rate = rate
+        self.batch_size = batch_size
+        self.workers = workers
+
+        #: The number of messages that have been pushed to the handler.
+        self.count = 0
+
+        self.__started = None
+
+        # The publisher (and replacement publisher and sequence) of messages
+        # that are being renumbered.
+        self.__renumbered = None
+        self.__publisher = None
+        self.__sequence = None
+
+    def __decode(self, payloads):
+        return map(self.codec.decode, payloads)
+
+    def __reframe(self, message):
+        header = message.header
+        if self.__started is None and header.sequence != 0:
+            logger.info('Replay starts at sequence %s of publisher %r, renumbering.', header.sequence, header.publisher)
+            self.__renumbered = header.publisher
+            self.__publisher = uuid.uuid1().bytes
+            self.__sequence = itertools.count(0)
+
+        if self.__renumbered is not None:
+            if header.publisher == self.__renumbered:
+                header.publisher = self.__publisher
+                header.sequence = next(self.__sequence)
+            else:
+                self.__renumbered = None
+
+    def __push(self, messages):
+        for message in messages:
+            self.__reframe(message)
+            if self.__started is None:
+                self.__started = time.time()
+
+        self.handler.push(messages)
+        self.count += len(messages)
+
+        if self.rate:
+            delay = self.count / float(self.rate) - (time.time() - self.__started)
+            if delay > 0:
+                time.sleep(delay)
+
+    def run(self):
+        """
+        Replays the archive, returning the number of messages that were
+        replayed.
+        """
+        payloads = self.reader.read(self.position)
+        chunks = iter(lambda: list(itertools.islice(payloads, self.batch_size)), [])
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(self.__decode, chunk))
+                if len(pending) >= self.workers * 2:
+                    self.__push(pending.popleft().result())
+
+            while pending:
+                self.__push(pending.popleft().result())
+
+        if self.__started is not None:
+            elapsed = time.time() - self.__started
+            logger.info('Replayed %s messages in %.3f seconds (%.1f messages/s.)', self.count, elapsed, self.count / (elapsed or float('nan')))
+
+        return self.count
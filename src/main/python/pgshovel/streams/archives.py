@@ -0,0 +1,592 @@
+"""
+Tools for archiving streams to local disk.
+
+An archive is a directory of segment files. Each segment contains a sequence
+of binary encoded ``Message`` payloads, each prefixed with it's length as a
+varint (the same framing used by the protocol buffer libraries for delimited
+streams.) Segments may optionally be compressed with gzip or bzip2.
+
+Segments are only rotated at batch boundaries, so each segment (other than
+one that was interrupted by a crash) contains only complete batches. Segments
+are also rotated when the node that batches are published from changes, so
+each segment only contains the batches of a single node, in order. While a
+segment is being written, it has a ``.partial`` suffix, which is removed when
+the segment is closed. Partial segments that are left behind by a crash are
+completed when the archive is next opened for writing, and a message that was
+truncated by the crash is ignored when the segment is read.
+
+Each segment has a sidecar index, containing a fixed width record for every
+batch in the segment: the batch identifier, the start and end tick IDs, the
+end tick timestamp, and the offset of the start of the batch within the
+segment file. Compressed segments are flushed at every batch boundary, so
+decompression can begin at any indexed offset. This allows an ``ArchiveReader``
+to seek directly to a batch (by identifier or time) without reading any of
+the preceding data.
+"""
+import bz2
+import logging
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple
+
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.utilities.protobuf import (
+    BinaryCodec,
+    decode_varint,
+    encode_varint,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+PARTIAL_SUFFIX = '.partial'
+
+SEGMENT_TEMPLATE = '{number:010d}.segment{suffix}'
+
+SEGMENT_EXPRESSION = re.compile(r'^(?P<number>\d{10})\.segment(?P<suffix>\.gz|\.bz2)?$')
+
+INDEX_TEMPLATE = '{number:010d}.index'
+
+#: node, batch id, start tick id, end tick id, end tick timestamp (seconds,
+#: nanoseconds), segment offset
+INDEX_ENTRY = struct.Struct('>16sQQQqiQ')
+
+IndexEntry = namedtuple('IndexEntry', 'node id start end timestamp offset')
+
+Position = namedtuple('Position', 'number path offset')
+
+TERMINAL_OPERATIONS = frozenset(('commit_operation', 'rollback_operation'))
+
+
+# Compression
+
+class Encoder(object):
+    """
+    Passes data through without compression.
+    """
+    suffix = ''
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+    def finish(self):
+        return ''
+
+
+class GzipEncoder(object):
+    """
+    Compresses data as a single gzip member.
+
+    Flushing performs a full flush, so that the data that has been written is
+    readable, and decompression can be restarted from the flush point.
+    """
+    suffix = '.gz'
+
+    def __init__(self, level=6):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_FULL_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BZ2Encoder(object):
+    """
+    Compresses data as a sequence of bzip2 streams.
+
+    The bzip2 format doesn't support flushing without ending the stream, so
+    each flush completes the current stream (and a new stream is started when
+    more data is written.)
+    """
+    suffix = '.bz2'
+
+    def __init__(self, level=9):
+        self.level = level
+        self.compressor = None
+
+    def compress(self, data):
+        if self.compressor is None:
+            self.compressor = bz2.BZ2Compressor(self.level)
+        return self.compressor.compress(data)
+
+    def flush(self):
+        if self.compressor is None:
+            return ''
+        data = self.compressor.flush()
+        self.compressor = None
+        return data
+
+    finish = flush
+
+
+# Decoders can be restarted from any flush point of the corresponding encoder
+# (other than the start of the segment), as recorded by the segment index.
+
+class Decoder(object):
+    def __init__(self, restart=False):
+        pass
+
+    def decompress(self, data):
+        return data
+
+
+class GzipDecoder(object):
+    def __init__(self, restart=False):
+        # When restarting, there is no gzip header to be read, just the
+        # remainder of the raw deflate stream.
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS if restart else 16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        return self.decompressor.decompress(data)
+
+
+class BZ2Decoder(object):
+    def __init__(self, restart=False):
+        self.decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        output = []
+        while data:
+            try:
+                output.append(self.decompressor.decompress(data))
+            except EOFError:
+                # The previous stream ended at the end of the last chunk.
+                self.decompressor = bz2.BZ2Decompressor()
+                continue
+
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = bz2.BZ2Decompressor()
+        return ''.join(output)
+
+
+COMPRESSION = {
+    None: (Encoder, Decoder),
+    'gzip': (GzipEncoder, GzipDecoder),
+    'bz2': (BZ2Encoder, BZ2Decoder),
+}
+
+SUFFIXES = dict((encoder.suffix, name) for name, (encoder, decoder) in COMPRESSION.items())
+
+
+# Segments
+
+def list_segments(directory):
+    """
+    Returns a list of ``(number, path)`` tuples for each complete segment in
+    the archive directory, in order.
+    """
+    segments = []
+    for name in os.listdir(directory):
+        match = SEGMENT_EXPRESSION.match(name)
+        if match is not None:
+            segments.append((int(match.group('number')), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def get_index_path(path):
+    """
+    Returns the path of the index for a segment.
+    """
+    match = SEGMENT_EXPRESSION.match(os.path.basename(path))
+    if match is None:
+        raise ValueError('Invalid segment path: {0}'.format(path))
+    return os.path.join(os.path.dirname(path), INDEX_TEMPLATE.format(number=int(match.group('number'))))
+
+
+def get_compression(path):
+    """
+    Returns the name of the compression used by a segment (which may be a
+    partial segment), based on it's path.
+    """
+    name = os.path.basename(path)
+    if name.endswith(PARTIAL_SUFFIX):
+        name = name[:-len(PARTIAL_SUFFIX)]
+
+    match = SEGMENT_EXPRESSION.match(name)
+    if match is None:
+        raise ValueError('Invalid segment path: {0}'.format(path))
+    return SUFFIXES[match.group('suffix') or '']
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Segment(object):
+    """
+    A segment (and it's index) that is being written to.
+    """
+    def __init__(self, path, encoder, buffer_size):
+        self.path = path
+        self.encoder = encoder
+
+        self.file = open(path + PARTIAL_SUFFIX, 'wb', buffer_size)
+        self.index = open(get_index_path(path), 'wb')
+
+        #: The number of (uncompressed) bytes written to this segment.
+        self.size = 0
+
+        #: The number of bytes written to the segment file.
+        self.offset = 0
+
+        #: Whether or not data has been written since the last flush.
+        self.dirty = False
+
+        #: The node of the batches in this segment (once one has been added.)
+        self.node = None
+
+        self.created = time.time()
+
+    def __str__(self):
+        return self.path
+
+    def __write(self, data):
+        self.offset += len(data)
+        self.file.write(data)
+
+    def write(self, data):
+        self.size += len(data)
+        self.dirty = True
+        self.__write(self.encoder.compress(data))
+
+    def add_index_entry(self, batch_operation):
+        """
+        Records the start of a batch at the current offset. (The segment
+        must have been flushed since the last write.)
+        """
+        assert not self.dirty
+        self.node = batch_operation.batch_identifier.node
+        begin = batch_operation.begin_operation
+        self.index.write(
+            INDEX_ENTRY.pack(
+                batch_operation.batch_identifier.node,
+                batch_operation.batch_identifier.id,
+                begin.start.id,
+                begin.end.id,
+                begin.end.timestamp.seconds,
+                begin.end.timestamp.nanos,
+                self.offset,
+            ),
+        )
+
+    def __sync(self, fsync):
+        for f in (self.file, self.index):
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+
+    def flush(self, fsync=True):
+        self.__write(self.encoder.flush())
+        self.dirty = False
+        self.__sync(fsync)
+
+    def close(self, fsync=True):
+        self.__write(self.encoder.finish())
+        self.__sync(fsync)
+        self.file.close()
+        self.index.close()
+        os.rename(self.path + PARTIAL_SUFFIX, self.path)
+        if fsync:
+            fsync_directory(os.path.dirname(self.path))
+
+
+class SegmentWriter(object):
+    """
+    Writes messages to a rotating sequence of segments in an archive
+    directory.
+
+    Messages are written through a write buffer of ``buffer_size`` bytes. The
+    segment is flushed (and, unless disabled, synced to disk) at the end of
+    every batch. The segment is rotated at the end of a batch if it contains
+    more than ``max_size`` (uncompressed) bytes, or was created more than
+    ``max_age`` seconds ago, and before the start of a batch from a different
+    node than the batches already in the segment.
+
+    This class is *not* designed to be thread safe.
+    """
+    codec = BinaryCodec(Message)
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024, max_age=None, compression=None, buffer_size=1024 * 1024, fsync=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.__recover()
+
+        segments = list_segments(directory)
+        self.__number = segments[-1][0] + 1 if segments else 0
+        self.__segment = None
+
+    def __str__(self):
+        return self.directory
+
+    def __recover(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(PARTIAL_SUFFIX) and SEGMENT_EXPRESSION.match(name[:-len(PARTIAL_SUFFIX)]):
+                path = os.path.join(self.directory, name)
+                logger.warning('Completing partial segment %s, which may end with a truncated message.', path)
+                os.rename(path, path[:-len(PARTIAL_SUFFIX)])
+
+    def __open(self):
+        encoder_class, _ = COMPRESSION[self.compression]
+        path = os.path.join(
+            self.directory,
+            SEGMENT_TEMPLATE.format(number=self.__number, suffix=encoder_class.suffix),
+        )
+        self.__number += 1
+        logger.debug('Opening segment %s...', path)
+        return Segment(path, encoder_class(), self.buffer_size)
+
+    def __rotation_required(self, segment):
+        if segment.size >= self.max_size:
+            return True
+        if self.max_age is not None and time.time() - segment.created >= self.max_age:
+            return True
+        return False
+
+    def write(self, message):
+        operation = message.batch_operation.WhichOneof('operation')
+        if operation == 'begin_operation' and self.__segment is not None:
+            node = message.batch_operation.batch_identifier.node
+            if self.__segment.node not in (None, node):
+                self.close()
+
+        if self.__segment is None:
+            self.__segment = self.__open()
+
+        if operation == 'begin_operation':
+            # Batches are generally flushed when they are completed, but a
+            # batch may have been interrupted, and the start of each batch
+            # needs to be a valid restart point for decompression.
+            if self.__segment.dirty:
+                self.__segment.flush(fsync=False)
+            self.__segment.add_index_entry(message.batch_operation)
+
+        payload = self.codec.encode(message)
+        self.__segment.write(encode_varint(len(payload)) + payload)
+
+        if operation in TERMINAL_OPERATIONS:
+            if self.__rotation_required(self.__segment):
+                self.close()
+            else:
+                self.__segment.flush(self.fsync)
+
+    def close(self):
+        """
+        Closes the current segment (if there is one.) A new segment will be
+        started if more messages are written.
+        """
+        if self.__segment is not None:
+            logger.debug('Closing segment %s (%s bytes)...', self.__segment, self.__segment.size)
+            self.__segment.close(self.fsync)
+            self.__segment = None
+
+
+def map_file(path):
+    """
+    Returns a read only memory map of a file (or an empty string, if the file
+    is empty, since empty files cannot be mapped.)
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_segment(path, offset=0, chunk_size=1024 * 1024):
+    """
+    Yields each message payload in a segment, starting from the provided
+    offset (which must be the start of the segment, or an indexed offset.)
+
+    The segment file is memory mapped. Uncompressed payloads are read directly
+    from the map, while compressed segments are decompressed in chunks.
+    """
+    _, decoder_class = COMPRESSION[get_compression(path)]
+    data = map_file(path)
+
+    if decoder_class is Decoder:
+        buffer, chunks = data, iter(())
+    else:
+        decoder = decoder_class(restart=offset != 0)
+        buffer, chunks = '', (data[i:i + chunk_size] for i in xrange(offset, len(data), chunk_size))
+        offset = 0
+
+    try:
+        while True:
+            while True:
+                try:
+                    length, start = decode_varint(buffer, offset)
+                except IndexError:
+                    break
+
+                end = start + length
+                if end > len(buffer):
+                    break
+
+                yield buffer[start:end]
+                offset = end
+
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+
+            buffer = buffer[offset:] + decoder.decompress(chunk)
+            offset = 0
+
+        if offset < len(buffer):
+            logger.warning('Ignoring truncated message at the end of segment %s (%s bytes).', path, len(buffer) - offset)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def read_archive(directory):
+    """
+    Yields each message payload in an archive, across all segments.
+    """
+    return ArchiveReader(directory).read()
+
+
+class SegmentIndex(object):
+    """
+    Provides access to the (memory mapped) entries of a segment index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__data = map_file(path)
+
+    def __len__(self):
+        return len(self.__data) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+
+        node, id, start, end, seconds, nanos, offset = INDEX_ENTRY.unpack_from(self.__data, i * INDEX_ENTRY.size)
+        return IndexEntry(node, id, start, end, seconds + nanos / 1e9, offset)
+
+    def close(self):
+        if isinstance(self.__data, mmap.mmap):
+            self.__data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def bisect(self, predicate):
+        """
+        Returns the position of the first entry that satisfies the predicate,
+        which must be monotonic (false for all entries preceding the entry,
+        and true for all entries following it.)
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if predicate(self[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+
+class ArchiveReader(object):
+    """
+    Reads archives, optionally starting from a specific batch.
+
+    Positions are located using the segment indexes, and can then be read
+    from without reading any of the preceding data::
+
+        >>> reader = ArchiveReader(directory)
+        >>> position = reader.seek_time(time.time() - 3600)
+        >>> for payload in reader.read(position):
+        ...     message = codec.decode(payload)
+
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __str__(self):
+        return self.directory
+
+    def __indexes(self):
+        for number, path in list_segments(self.directory):
+            try:
+                index = SegmentIndex(get_index_path(path))
+            except IOError:
+                logger.warning('Segment %s does not have an index, skipping.', path)
+                continue
+
+            with index:
+                yield number, path, index
+
+    def seek_time(self, timestamp):
+        """
+        Returns the position of the first batch with an end tick at or after
+        the provided time (or ``None``, if there is no such batch.)
+        """
+        predicate = lambda entry: entry.timestamp >= timestamp
+        for number, path, index in self.__indexes():
+            if len(index) and predicate(index[-1]):
+                return Position(number, path, index[index.bisect(predicate)].offset)
+
+    def seek_batch(self, id, node=None):
+        """
+        Returns the position of the first batch with an identifier at or
+        after the provided batch ID (optionally restricted to batches from a
+        specific node), or ``None`` if there is no such batch.
+        """
+        predicate = lambda entry: entry.id >= id
+        for number, path, index in self.__indexes():
+            # Each segment only contains batches from a single node (in the
+            # order that they were published), so it can be bisected.
+            if not len(index) or (node is not None and index[0].node != node):
+                continue
+            if predicate(index[-1]):
+                return Position(number, path, index[index.bisect(predicate)].offset)
+
+    def read(self, position=None):
+        """
+        Yields each message payload in the archive, starting from the
+        provided position (or the start of the archive.)
+        """
+        for number, path in list_segments(self.directory):
+            if position is None:
+                offset = 0
+            elif number < position.number:
+                continue
+            elif number == position.number:
+                offset = position.offset
+            else:
+                offset = 0
+
+            for payload in read_segment(path, offset):
+                yield payload
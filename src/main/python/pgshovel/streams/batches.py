@@ -3,14 +3,6 @@ Tools for aiding batch consumption.
 """
 import itertools
 
-from pgshovel.interfaces.streams_pb2 import (
-    BatchOperation,
-    BeginOperation,
-    CommitOperation,
-    MutationOperation,
-    RollbackOperation,
-)
-
 
 def get_operation(message):
     if message is None:
@@ -65,18 +57,19 @@ def batched(messages):
     def make_mutation_iterator(messages):
         for message in messages:
             # Only batch operations are supported in this context.
-            operation = get_operation(message)
-            assert isinstance(operation, BatchOperation)
+            assert message.WhichOneof('operation') == 'batch_operation'
 
-            operation = get_operation(operation)
+            # Operations are identified by name (rather than by type) so that
+            # lazily decoded messages can also be batched.
+            operation = message.batch_operation.WhichOneof('operation')
 
-            if isinstance(operation, BeginOperation):
+            if operation == 'begin_operation':
                 continue  # skip
-            elif isinstance(operation, MutationOperation):
-                yield operation
-            elif isinstance(operation, CommitOperation):
+            elif operation == 'mutation_operation':
+                yield message.batch_operation.mutation_operation
+            elif operation == 'commit_operation':
                 return
-            elif isinstance(operation, RollbackOperation):
+            elif operation == 'rollback_operation':
                 raise TransactionCancelled('Transaction rolled back.')
             else:
                 raise ValueError('Unexpected operation in transaction.')
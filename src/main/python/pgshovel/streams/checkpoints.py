@@ -0,0 +1,150 @@
+"""
+Tools for recording the position of a consumer within a stream, so that
+validation can be resumed after the consumer is restarted.
+
+A checkpoint records the publisher and sequence of the last message processed
+by the consumer, as well as the state of the stream after that message was
+processed. Checkpoints are generally recorded after a batch has been committed
+to the destination::
+
+    store = FileCheckpointStore('/var/lib/consumer/checkpoint')
+    checkpoint = store.get()
+
+    messages = sequences.validate(messages, checkpoint=checkpoint)
+    for state, message in states.validate(messages, start=get_state(checkpoint)):
+        ...
+        if isinstance(state, states.Committed):
+            store.set(to_checkpoint(state, message))
+
+"""
+import errno
+import os
+import sqlite3
+import tempfile
+
+from pgshovel.interfaces.streams_pb2 import Checkpoint
+from pgshovel.streams.states import (
+    Committed,
+    InTransaction,
+    RolledBack,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+STATES = {
+    Checkpoint.IN_TRANSACTION: InTransaction,
+    Checkpoint.COMMITTED: Committed,
+    Checkpoint.ROLLED_BACK: RolledBack,
+}
+
+CHECKPOINT_STATES = dict((value, key) for key, value in STATES.items())
+
+
+def to_checkpoint(state, message):
+    """
+    Creates a checkpoint from the state of the stream after the provided
+    message has been processed.
+    """
+    return Checkpoint(
+        publisher=message.header.publisher,
+        sequence=message.header.sequence,
+        state=CHECKPOINT_STATES[type(state)],
+        batch_identifier=state.batch_identifier,
+    )
+
+
+def get_state(checkpoint):
+    """
+    Returns the stream state recorded by a checkpoint (or ``None``, if no
+    checkpoint is provided.)
+    """
+    if checkpoint is None:
+        return None
+
+    return STATES[checkpoint.state](checkpoint.publisher, checkpoint.batch_identifier)
+
+
+class CheckpointStore(object):
+    """
+    Persists the most recent checkpoint of a consumer.
+    """
+    codec = BinaryCodec(Checkpoint)
+
+    def get(self):
+        """
+        Returns the most recently stored checkpoint, or ``None`` if no
+        checkpoint has been stored.
+        """
+        raise NotImplementedError
+
+    def set(self, checkpoint):
+        """
+        Durably stores a checkpoint, replacing any previous checkpoint.
+        """
+        raise NotImplementedError
+
+
+class FileCheckpointStore(CheckpointStore):
+    """
+    Stores a checkpoint in a file.
+
+    Checkpoints are written to a temporary file that is renamed over the
+    previous checkpoint, so the stored checkpoint is never partially written.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'File checkpoint store (path: %s)' % (self.path,)
+
+    def get(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return self.codec.decode(f.read())
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                return None
+            raise
+
+    def set(self, checkpoint):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.checkpoint')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.codec.encode(checkpoint))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(path, self.path)
+        except Exception:
+            os.unlink(path)
+            raise
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    """
+    Stores checkpoints in a SQLite database, keyed by consumer name (allowing
+    multiple consumers to share a database.)
+    """
+    def __init__(self, path, name='default'):
+        self.path = path
+        self.name = name
+
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, checkpoint BLOB NOT NULL)')
+
+    def __str__(self):
+        return 'SQLite checkpoint store (path: %s, name: %s)' % (self.path, self.name)
+
+    def get(self):
+        row = self.connection.execute('SELECT checkpoint FROM checkpoints WHERE name = ?', (self.name,)).fetchone()
+        if row is None:
+            return None
+        return self.codec.decode(str(row[0]))
+
+    def set(self, checkpoint):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO checkpoints (name, checkpoint) VALUES (?, ?)',
+                (self.name, sqlite3.Binary(self.codec.encode(checkpoint))),
+            )
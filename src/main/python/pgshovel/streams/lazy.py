@@ -0,0 +1,155 @@
+"""
+Tools for lazily decoding input streams.
+
+Validating a stream only requires the message header and the batch envelope
+(the batch identifier and operation type) of each message, but fully decoding
+a ``Message`` also decodes every ``Row`` and ``Column`` that it contains. The
+classes here parse messages into wire compatible envelope messages (which
+leave row data encoded) and only decode rows when they are accessed.
+
+Lazy messages provide the subset of the ``Message`` interface that is used by
+the stream validation tools, and can be decoded using the standard codecs::
+
+    >>> codec = BinaryCodec(LazyMessage)
+    >>> message = codec.decode(payload)
+
+If the complete message is required, it can be retrieved with ``decode``.
+"""
+from pgshovel.interfaces.common_pb2 import Row
+from pgshovel.interfaces.streams_pb2 import (
+    Message,
+    MessageEnvelope,
+    MutationOperation,
+)
+
+
+class LazyMessage(object):
+    """
+    A lazily decoded ``Message``.
+    """
+    __slots__ = ('payload', 'envelope', 'header', 'batch_operation')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.envelope = envelope = MessageEnvelope.FromString(payload)
+
+        # These are accessed for every message during validation, so they are
+        # assigned here rather than being retrieved through properties.
+        self.header = envelope.header
+        self.batch_operation = LazyBatchOperation(envelope.batch_operation)
+
+    @classmethod
+    def FromString(cls, payload):
+        return cls(payload)
+
+    def __repr__(self):
+        return '<{0}: {1!r}>'.format(type(self).__name__, self.envelope)
+
+    def __eq__(self, other):
+        if not isinstance(other, LazyMessage):
+            return NotImplemented
+        return self.payload == other.payload
+
+    def __ne__(self, other):
+        return not self == other
+
+    def WhichOneof(self, name):
+        return self.envelope.WhichOneof(name)
+
+    def SerializeToString(self):
+        return self.payload
+
+    def decode(self):
+        """
+        Returns the fully decoded ``Message``.
+        """
+        return Message.FromString(self.payload)
+
+
+class LazyBatchOperation(object):
+    """
+    A ``BatchOperation`` that contains a lazily decoded mutation.
+    """
+    __slots__ = ('envelope', 'batch_identifier')
+
+    def __init__(self, envelope):
+        self.envelope = envelope
+        self.batch_identifier = envelope.batch_identifier
+
+    def __repr__(self):
+        return '<{0}: {1!r}>'.format(type(self).__name__, self.envelope)
+
+    @property
+    def begin_operation(self):
+        return self.envelope.begin_operation
+
+    @property
+    def mutation_operation(self):
+        return LazyMutationOperation(self.envelope.mutation_operation)
+
+    @property
+    def commit_operation(self):
+        return self.envelope.commit_operation
+
+    @property
+    def rollback_operation(self):
+        return self.envelope.rollback_operation
+
+    def WhichOneof(self, name):
+        return self.envelope.WhichOneof(name)
+
+
+class LazyMutationOperation(object):
+    """
+    A ``MutationOperation`` that decodes the ``old`` and ``new`` rows when they
+    are first accessed. All other fields are available without decoding any
+    row data.
+    """
+    __slots__ = ('envelope', '__old', '__new')
+
+    def __init__(self, envelope):
+        self.envelope = envelope
+        self.__old = None
+        self.__new = None
+
+    def __repr__(self):
+        return '<{0}: {1!r}>'.format(type(self).__name__, self.envelope)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMutationOperation):
+            return self.envelope == other.envelope
+        elif isinstance(other, MutationOperation):
+            return self.decode() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    id = property(lambda self: self.envelope.id)
+    schema = property(lambda self: self.envelope.schema)
+    table = property(lambda self: self.envelope.table)
+    operation = property(lambda self: self.envelope.operation)
+    identity_columns = property(lambda self: self.envelope.identity_columns)
+    timestamp = property(lambda self: self.envelope.timestamp)
+    transaction = property(lambda self: self.envelope.transaction)
+
+    @property
+    def old(self):
+        if self.__old is None:
+            self.__old = Row.FromString(self.envelope.old)
+        return self.__old
+
+    @property
+    def new(self):
+        if self.__new is None:
+            self.__new = Row.FromString(self.envelope.new)
+        return self.__new
+
+    def HasField(self, name):
+        return self.envelope.HasField(name)
+
+    def decode(self):
+        """
+        Returns the fully decoded ``MutationOperation``.
+        """
+        return MutationOperation.FromString(self.envelope.SerializeToString())
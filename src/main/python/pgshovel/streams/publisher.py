@@ -30,7 +30,7 @@ class Publisher(object):
 
     This class is *not* designed to be thread safe.
     """
-    def __init__(self, receiver):
+    def __init__(self, receiver, chunk_size=1):
         #: A function or callable for writing to an output stream. This is
         #: assumed to be synchronous, and that the receiver function will block
         #: until the messages have been acknowledged by the destination. If the
@@ -38,20 +38,27 @@ class Publisher(object):
         #: receiver should raise an exception.
         self.receiver = receiver
 
+        #: The maximum number of messages of a batch that are provided to the
+        #: receiver at a time. Messages are buffered until a chunk is full, or
+        #: the batch has been completed (which is always provided to the
+        #: receiver before ``batch`` returns.)
+        self.chunk_size = chunk_size
+
         self.id = uuid.uuid1().bytes
         self.sequence = itertools.count(0)
 
-    def publish(self, **kwargs):
-        self.receiver((
-            Message(
-                header=Header(
-                    publisher=self.id,
-                    sequence=next(self.sequence),
-                    timestamp=to_timestamp(time.time()),
-                ),
-                **kwargs
+    def __message(self, **kwargs):
+        return Message(
+            header=Header(
+                publisher=self.id,
+                sequence=next(self.sequence),
+                timestamp=to_timestamp(time.time()),
             ),
-        ))
+            **kwargs
+        )
+
+    def publish(self, **kwargs):
+        self.receiver((self.__message(**kwargs),))
 
     @contextmanager
     def batch(self, batch_identifier, begin_operation):
@@ -60,8 +67,21 @@ class Publisher(object):
         messages are sent. The context manager provides a function that can be
         used to publish mutation events that are part of the batch.
         """
+        chunk = []
+
+        def flush():
+            if chunk:
+                messages = tuple(chunk)
+                del chunk[:]  # not retried if the receiver fails
+                self.receiver(messages)
+
+        def publish(**kwargs):
+            chunk.append(self.__message(**kwargs))
+            if len(chunk) >= self.chunk_size:
+                flush()
+
         logger.debug('Starting transaction...')
-        self.publish(
+        publish(
             batch_operation=BatchOperation(
                 batch_identifier=batch_identifier,
                 begin_operation=begin_operation,
@@ -69,7 +89,7 @@ class Publisher(object):
         )
 
         def mutation(mutation_operation):
-            return self.publish(
+            return publish(
                 batch_operation=BatchOperation(
                     batch_identifier=batch_identifier,
                     mutation_operation=mutation_operation,
@@ -80,20 +100,22 @@ class Publisher(object):
             yield mutation
         except Exception:
             logger.debug('Attempting to publish rollback of in progress transaction...')
-            self.publish(
+            publish(
                 batch_operation=BatchOperation(
                     batch_identifier=batch_identifier,
                     rollback_operation=RollbackOperation(),
                 ),
             )
+            flush()
             logger.debug('Published rollback.')
             raise
         else:
             logger.debug('Attempting to publish commit of in progress transaction...')
-            self.publish(
+            publish(
                 batch_operation=BatchOperation(
                     batch_identifier=batch_identifier,
                     commit_operation=CommitOperation(),
                 ),
             )
+            flush()
             logger.debug('Published commit.')
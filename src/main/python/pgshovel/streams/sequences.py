@@ -33,13 +33,18 @@ class InvalidSequenceStartError(Exception):
     """
 
 
-def validate(messages):
+def validate(messages, checkpoint=None):
     """
     Validates a stream of Message instances, ensuring that the correct
     sequencing order is maintained, all messages are present, and only a single
     publisher is communicating on the stream.
 
     Duplicate messages are dropped if they have already been yielded.
+
+    If a ``Checkpoint`` is provided, validation resumes from the checkpoint
+    position: messages from the checkpoint publisher up to (and including) the
+    checkpoint sequence are dropped, and the next message must follow the
+    checkpoint sequence.
     """
     # TODO: Also warn on non-monotonic timestamp advancement.
 
@@ -53,6 +58,33 @@ def validate(messages):
         if message.header.publisher in dead:
             raise InvalidPublisher('Received message from previously used publisher.')
 
+        if checkpoint is not None:
+            if checkpoint.publisher == message.header.publisher:
+                if message.header.sequence <= checkpoint.sequence:
+                    logger.debug('Skipping message preceding checkpoint.')
+                    continue
+                elif checkpoint.sequence + 1 != message.header.sequence:
+                    raise SequencingError(
+                        'Invalid sequence: {0} to {1}'.format(
+                            checkpoint.sequence,
+                            message.header.sequence,
+                        )
+                    )
+
+                checkpoint = None
+                yield message
+                previous = message
+                continue
+            else:
+                logger.info(
+                    'Publisher of %r has changed from %r (at checkpoint) to %r.',
+                    messages,
+                    checkpoint.publisher,
+                    message.header.publisher,
+                )
+                dead.add(checkpoint.publisher)
+                checkpoint = None
+
         if previous is not None:
             if previous.header.publisher == message.header.publisher:
                 # If the message we just received is exactly the same as the
@@ -83,8 +115,6 @@ def validate(messages):
                 dead.add(previous.header.publisher)
                 previous = None
 
-        # TODO: This needs to handle starting consumption in the middle of the
-        # stream somehow.
         if previous is None and message.header.sequence != 0:
             raise InvalidSequenceStartError(
                 'Invalid sequence start point: {0}'.format(
@@ -5,7 +5,6 @@ import functools
 from collections import namedtuple
 
 from pgshovel.interfaces.streams_pb2 import (
-    BatchOperation,
     BeginOperation,
     CommitOperation,
     MutationOperation,
@@ -47,12 +46,15 @@ class StatefulStreamValidator(object):
         #: look up the event receiver for the current sate.
         self.key_function = key_function
 
-    def __call__(self, events):
+    def __call__(self, events, start=None):
         """
         Accepts a stream of events, yielding a two-tuple of ``(new state,
         event)`` for each input.
+
+        The starting state can be overridden (for example, when resuming from
+        a checkpoint) by providing a ``start`` state.
         """
-        state = self.start
+        state = start if start is not None else self.start
 
         for event in events:
             try:
@@ -133,10 +135,20 @@ Committed = namedtuple('Committed', 'publisher batch_identifier')
 RolledBack = namedtuple('RolledBack', 'publisher batch_identifier')
 
 
+#: The operation type for each member of the ``BatchOperation.operation``
+#: oneof. (The operation is identified by name, rather than by type, so that
+#: lazily decoded messages can also be validated.)
+BATCH_OPERATION_TYPES = {
+    'begin_operation': BeginOperation,
+    'mutation_operation': MutationOperation,
+    'commit_operation': CommitOperation,
+    'rollback_operation': RollbackOperation,
+}
+
+
 def get_batch_operation_type(event):
-    operation = get_operation(event)
-    assert isinstance(operation, BatchOperation)
-    return type(get_operation(operation))
+    assert event.WhichOneof('operation') == 'batch_operation'
+    return BATCH_OPERATION_TYPES.get(event.batch_operation.WhichOneof('operation'))
 
 
 validate = StatefulStreamValidator({
@@ -0,0 +1,307 @@
+"""
+Tools for validating and batching input streams in a single pass.
+
+This provides the same semantics as chaining ``sequences.validate``,
+``states.validate`` and ``batches.batched`` together, but avoids much of the
+per-message overhead of the chained pipeline: operations are dispatched using
+precomputed integer tags rather than by type, the stream state is stored as
+attributes on a single validator object rather than as a new state instance
+per message, and duplicate messages are detected by comparing their
+serialized forms.
+"""
+import logging
+
+from pgshovel.interfaces.streams_pb2 import Checkpoint
+from pgshovel.streams.batches import (
+    TransactionAborted,
+    TransactionCancelled,
+)
+from pgshovel.streams.sequences import (
+    InvalidPublisher as InvalidSequencePublisher,
+    InvalidSequenceStartError,
+    RepeatedSequenceError,
+    SequencingError,
+)
+from pgshovel.streams.states import (
+    Committed,
+    InTransaction,
+    InvalidBatch,
+    InvalidEventError,
+    InvalidPublisher,
+    RolledBack,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# Operations
+
+BEGIN = 1
+MUTATION = 2
+COMMIT = 3
+ROLLBACK = 4
+
+OPERATIONS = {
+    'begin_operation': BEGIN,
+    'mutation_operation': MUTATION,
+    'commit_operation': COMMIT,
+    'rollback_operation': ROLLBACK,
+}
+
+
+# States
+
+IN_TRANSACTION = 1
+COMMITTED = 2
+ROLLED_BACK = 3
+
+STATES = {
+    IN_TRANSACTION: InTransaction,
+    COMMITTED: Committed,
+    ROLLED_BACK: RolledBack,
+}
+
+CHECKPOINT_STATES = {
+    IN_TRANSACTION: Checkpoint.IN_TRANSACTION,
+    COMMITTED: Checkpoint.COMMITTED,
+    ROLLED_BACK: Checkpoint.ROLLED_BACK,
+}
+
+CHECKPOINT_STATE_TAGS = dict((value, key) for key, value in CHECKPOINT_STATES.items())
+
+TRANSITIONS = {
+    BEGIN: IN_TRANSACTION,
+    MUTATION: IN_TRANSACTION,
+    COMMIT: COMMITTED,
+    ROLLBACK: ROLLED_BACK,
+}
+
+
+class StreamValidator(object):
+    """
+    Validates the sequencing and state transitions of a stream of messages.
+
+    After each call to ``advance``, the validator attributes describe the
+    most recently accepted message.
+
+    If a ``Checkpoint`` is provided, validation resumes from the checkpoint
+    position (see ``sequences.validate`` for details.)
+    """
+    def __init__(self, messages, checkpoint=None):
+        self.__messages = iter(messages)
+
+        #: The most recently accepted message, and it's operation tag.
+        self.message = None
+        self.operation = None
+
+        #: The publisher and sequence of the most recently accepted message.
+        self.publisher = None
+        self.sequence = None
+
+        #: The current state of the stream, and the batch identifier
+        #: associated with that state.
+        self.state = None
+        self.batch_identifier = None
+
+        #: A counter that is advanced every time the ``(publisher, batch
+        #: identifier)`` pair changes between accepted messages.
+        self.group = 0
+
+        #: Whether or not the input stream has been exhausted.
+        self.exhausted = False
+
+        # All of the publishers that have been previously seen during the
+        # execution of this validator. (Does not include the currently active
+        # publisher.)
+        self.__dead = set()
+
+        # Whether or not messages are being skipped until the checkpoint
+        # position is reached.
+        self.__resuming = checkpoint is not None
+        if checkpoint is not None:
+            self.publisher = checkpoint.publisher
+            self.sequence = checkpoint.sequence
+            self.state = CHECKPOINT_STATE_TAGS[checkpoint.state]
+            self.batch_identifier = checkpoint.batch_identifier
+
+    def get_state(self):
+        """
+        Returns the current state of the stream, as a state object from the
+        ``states`` module (or ``None``, if no messages have been accepted.)
+        """
+        if self.state is None:
+            return None
+        return STATES[self.state](self.publisher, self.batch_identifier)
+
+    def get_checkpoint(self):
+        """
+        Returns a ``Checkpoint`` for the current position of the stream (or
+        ``None``, if no messages have been accepted.)
+        """
+        if self.state is None:
+            return None
+        return Checkpoint(
+            publisher=self.publisher,
+            sequence=self.sequence,
+            state=CHECKPOINT_STATES[self.state],
+            batch_identifier=self.batch_identifier,
+        )
+
+    def advance(self):
+        """
+        Accepts the next message from the stream, returning ``False`` if the
+        stream has been exhausted.
+
+        Duplicate messages are skipped. If the message is not valid for the
+        current state of the stream, an error is raised.
+        """
+        previous = self.message
+        started = self.publisher is not None
+
+        for message in self.__messages:
+            header = message.header
+            publisher = header.publisher
+            sequence = header.sequence
+
+            if publisher in self.__dead:
+                raise InvalidSequencePublisher('Received message from previously used publisher.')
+
+            if started:
+                if publisher == self.publisher:
+                    if self.__resuming and sequence <= self.sequence:
+                        logger.debug('Skipping message preceding checkpoint.')
+                        continue
+                    elif sequence == self.sequence:
+                        # If the message we just received is exactly the same
+                        # as the previous message, we can safely ignore it.
+                        if message.SerializeToString() == previous.SerializeToString():
+                            logger.debug('Skipping duplicate message.')
+                            continue
+                        else:
+                            raise RepeatedSequenceError(previous, message)
+                    elif sequence != self.sequence + 1:
+                        raise SequencingError(
+                            'Invalid sequence: {0} to {1}'.format(
+                                self.sequence,
+                                sequence,
+                            )
+                        )
+                else:
+                    logger.info(
+                        'Publisher of %r has changed from %r to %r.',
+                        self.__messages,
+                        self.publisher,
+                        publisher,
+                    )
+                    self.__dead.add(self.publisher)
+                    started = False
+
+            if not started and sequence != 0:
+                raise InvalidSequenceStartError(
+                    'Invalid sequence start point: {0}'.format(
+                        sequence,
+                    )
+                )
+
+            if message.WhichOneof('operation') != 'batch_operation':
+                raise InvalidEventError('Cannot receive {0!r} while in state: {1!r}'.format(message, self.get_state()))
+
+            batch_operation = message.batch_operation
+            operation = OPERATIONS.get(batch_operation.WhichOneof('operation'))
+            batch_identifier = batch_operation.batch_identifier
+
+            self.__transition(message, publisher, operation, batch_identifier)
+
+            if publisher != self.publisher or \
+                    self.batch_identifier is None or \
+                    batch_identifier.id != self.batch_identifier.id or \
+                    batch_identifier.node != self.batch_identifier.node:
+                self.group += 1
+
+            self.__resuming = False
+            self.message = message
+            self.operation = operation
+            self.publisher = publisher
+            self.sequence = sequence
+            self.state = TRANSITIONS[operation]
+            self.batch_identifier = batch_identifier
+            return True
+
+        self.exhausted = True
+        return False
+
+    def __transition(self, message, publisher, operation, batch_identifier):
+        """
+        Ensures that the operation can be received in the current state.
+        """
+        state = self.state
+        current = self.batch_identifier
+
+        if state is None:
+            if operation != BEGIN:
+                raise InvalidEventError('Cannot receive {0!r} while in state: {1!r}'.format(message, None))
+        elif state == IN_TRANSACTION:
+            if operation == BEGIN:
+                if self.publisher == publisher:
+                    raise InvalidPublisher('Event publisher ID cannot be the same as the current state.')
+                if current.node == batch_identifier.node and current.id != batch_identifier.id:
+                    raise InvalidBatch('Event batch ID must not be advanced from the current state.')
+            elif operation is not None:
+                if self.publisher != publisher:
+                    raise InvalidPublisher('Event publisher ID must be the same as the the current state.')
+                if current.id != batch_identifier.id or current.node != batch_identifier.node:
+                    raise InvalidBatch('Event batch ID must be the same as the current state.')
+            else:
+                raise InvalidEventError('Cannot receive {0!r} while in state: {1!r}'.format(message, self.get_state()))
+        elif operation == BEGIN:
+            if state == COMMITTED:
+                if current.node == batch_identifier.node and current.id >= batch_identifier.id:
+                    raise InvalidBatch('Event batch ID must be advanced from the current state.')
+            else:  # ROLLED_BACK
+                if current.node == batch_identifier.node and current.id != batch_identifier.id:
+                    raise InvalidBatch('Event batch ID must not be advanced from the current state.')
+        else:
+            raise InvalidEventError('Cannot receive {0!r} while in state: {1!r}'.format(message, self.get_state()))
+
+
+def validated_batches(messages, checkpoint=None):
+    """
+    Validates a stream of messages, yielding a ``(batch, mutations)`` tuple for
+    each batch in the stream, where the ``mutations`` member is an iterator of
+    ``MutationOperation`` objects.
+
+    This is equivalent to (but faster than) ``batches.batched`` applied to
+    the output of ``states.validate`` and ``sequences.validate``, and has the
+    same semantics for errors, aborted and cancelled transactions.
+
+    If a ``Checkpoint`` is provided, validation resumes from the checkpoint
+    position.
+    """
+    validator = StreamValidator(messages, checkpoint)
+    if not validator.advance():
+        return
+
+    def make_mutation_iterator(group):
+        while not validator.exhausted and validator.group == group:
+            operation = validator.operation
+            if operation == MUTATION:
+                yield validator.message.batch_operation.mutation_operation
+            elif operation == COMMIT:
+                return
+            elif operation == ROLLBACK:
+                raise TransactionCancelled('Transaction rolled back.')
+            elif operation != BEGIN:
+                raise ValueError('Unexpected operation in transaction.')
+
+            validator.advance()
+
+        raise TransactionAborted('Unexpected end of transaction iterator.')
+
+    while not validator.exhausted:
+        group = validator.group
+        yield validator.batch_identifier, make_mutation_iterator(group)
+
+        # Skip any messages in the batch that were not consumed.
+        while not validator.exhausted and validator.group == group:
+            validator.advance()
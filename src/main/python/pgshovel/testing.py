@@ -0,0 +1,939 @@
+"""
+In-memory stand-ins for the external services used by the relay.
+
+These allow the relay (and it's workers) to be exercised in a single process
+without a running ZooKeeper ensemble, PostgreSQL database (with PgQ), or
+message destination, which is useful for deterministic testing and for
+benchmarking the overhead of the relay itself.
+
+These are *not* complete implementations, and only implement enough of the
+behavior of the services they replace to be used by the relay.
+"""
+import cPickle as pickle
+import collections
+import itertools
+import logging
+import os
+import posixpath
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import psycopg2.extensions
+from kazoo.exceptions import (
+    BadVersionError,
+    NoNodeError,
+    NodeExistsError,
+    NotEmptyError,
+)
+from kazoo.protocol.states import (
+    EventType,
+    KazooState,
+    KeeperState,
+    WatchedEvent,
+    ZnodeStat,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+# ZooKeeper
+
+
+class FakeHandler(object):
+    """
+    Implements the subset of the Kazoo callback handler interface used by the
+    Kazoo recipes.
+
+    Callbacks are executed immediately on the calling thread, which makes the
+    ordering of watch notifications deterministic.
+    """
+    sleep_func = staticmethod(time.sleep)
+
+    def lock_object(self):
+        return threading.Lock()
+
+    def rlock_object(self):
+        return threading.RLock()
+
+    def event_object(self):
+        return threading.Event()
+
+    def spawn(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+
+class FakeAsyncResult(object):
+    def __init__(self, function, *args, **kwargs):
+        try:
+            self.__value = function(*args, **kwargs)
+            self.__exception = None
+        except Exception as exception:
+            self.__value = None
+            self.__exception = exception
+
+    def get(self, block=True, timeout=None):
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__value
+
+    def rawlink(self, callback):
+        callback(self)
+
+
+FakeNode = collections.namedtuple('FakeNode', 'data stat')
+
+
+class FakeZooKeeper(object):
+    """
+    An in-memory ZooKeeper client, implementing the subset of the
+    ``KazooClient`` API used by pgshovel (including the ``DataWatch`` and
+    ``ChildrenWatch`` recipes.)
+
+    Watches are one-time triggers (as they are with ZooKeeper), and are
+    notified synchronously from the thread performing the modification.
+    """
+    def __init__(self):
+        self.handler = FakeHandler()
+        self.state = KazooState.LOST
+
+        self.__lock = threading.RLock()
+        self.__zxid = itertools.count(1)
+        self.__nodes = {
+            '/': FakeNode('', self.__create_stat(0, 0, 0)),
+        }
+
+        self.__listeners = []
+        self.__data_watches = collections.defaultdict(list)
+        self.__child_watches = collections.defaultdict(list)
+
+    def __repr__(self):
+        return '<%s: %s nodes>' % (type(self).__name__, len(self.__nodes))
+
+    def __create_stat(self, zxid, version, children, created=None):
+        now = int(time.time() * 1000)
+        created = created or (zxid, now)
+        return ZnodeStat(
+            czxid=created[0],
+            mzxid=zxid,
+            ctime=created[1],
+            mtime=now,
+            version=version,
+            cversion=0,
+            aversion=0,
+            ephemeralOwner=0,
+            dataLength=0,
+            numChildren=children,
+            pzxid=zxid,
+        )
+
+    def __get_children(self, path):
+        prefix = path.rstrip('/') + '/'
+        return sorted(
+            p[len(prefix):] for p in self.__nodes
+            if p != path and p.startswith(prefix) and '/' not in p[len(prefix):]
+        )
+
+    def __notify(self, watches, path, type):
+        # Watches are only triggered once, so they are removed before calling
+        # to allow the watcher to reestablish a watch from it's callback.
+        callbacks = watches.pop(path, [])
+        event = WatchedEvent(type, KeeperState.CONNECTED, path)
+        for callback in callbacks:
+            callback(event)
+
+    # Connection Management
+
+    def start(self, timeout=None):
+        self.__set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        self.__set_state(KazooState.LOST)
+
+    def __set_state(self, state):
+        if self.state == state:
+            return
+        self.state = state
+        for listener in list(self.__listeners):
+            if listener(state) is True:
+                self.remove_listener(listener)
+
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def suspend(self):
+        """
+        Simulates a (temporary) loss of connection to the ensemble.
+        """
+        self.__set_state(KazooState.SUSPENDED)
+
+    # Read Operations
+
+    def exists(self, path, watch=None):
+        with self.__lock:
+            node = self.__nodes.get(path)
+            if watch is not None:
+                self.__data_watches[path].append(watch)
+            return node.stat if node is not None else None
+
+    def get(self, path, watch=None):
+        with self.__lock:
+            try:
+                node = self.__nodes[path]
+            except KeyError:
+                raise NoNodeError(path)
+
+            if watch is not None:
+                self.__data_watches[path].append(watch)
+
+            return node.data, node.stat
+
+    def get_async(self, path, watch=None):
+        return FakeAsyncResult(self.get, path, watch)
+
+    def get_children(self, path, watch=None, include_data=False):
+        with self.__lock:
+            if path not in self.__nodes:
+                raise NoNodeError(path)
+
+            if watch is not None:
+                self.__child_watches[path].append(watch)
+
+            children = self.__get_children(path)
+            if include_data:
+                return children, self.__nodes[path].stat
+            else:
+                return children
+
+    # Write Operations
+
+    def create(self, path, value='', makepath=False, **kwargs):
+        with self.__lock:
+            if path in self.__nodes:
+                raise NodeExistsError(path)
+
+            parent = posixpath.dirname(path)
+            if parent not in self.__nodes:
+                if makepath:
+                    self.create(parent, makepath=True)
+                else:
+                    raise NoNodeError(parent)
+
+            self.__nodes[path] = FakeNode(value, self.__create_stat(next(self.__zxid), 0, 0))
+            self.__update_children(parent)
+
+        self.__notify(self.__data_watches, path, EventType.CREATED)
+        self.__notify(self.__child_watches, parent, EventType.CHILD)
+        return path
+
+    def create_async(self, path, value='', makepath=False, **kwargs):
+        return FakeAsyncResult(self.create, path, value, makepath=makepath, **kwargs)
+
+    def ensure_path(self, path):
+        if self.exists(path) is None:
+            self.create(path, makepath=True)
+        return True
+
+    def set(self, path, value, version=-1):
+        with self.__lock:
+            node = self.__nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+
+            if version != -1 and version != node.stat.version:
+                raise BadVersionError(path)
+
+            stat = self.__create_stat(
+                next(self.__zxid),
+                node.stat.version + 1,
+                node.stat.numChildren,
+                created=(node.stat.czxid, node.stat.ctime),
+            )
+            self.__nodes[path] = FakeNode(value, stat)
+
+        self.__notify(self.__data_watches, path, EventType.CHANGED)
+        return stat
+
+    def set_async(self, path, value, version=-1):
+        return FakeAsyncResult(self.set, path, value, version)
+
+    def delete(self, path, version=-1, recursive=False):
+        with self.__lock:
+            node = self.__nodes.get(path)
+            if node is None:
+                raise NoNodeError(path)
+
+            if version != -1 and version != node.stat.version:
+                raise BadVersionError(path)
+
+            children = self.__get_children(path)
+            if children:
+                if not recursive:
+                    raise NotEmptyError(path)
+                for child in children:
+                    self.delete(posixpath.join(path, child), recursive=True)
+
+            del self.__nodes[path]
+            parent = posixpath.dirname(path)
+            self.__update_children(parent)
+
+        self.__notify(self.__data_watches, path, EventType.DELETED)
+        self.__notify(self.__child_watches, path, EventType.DELETED)
+        self.__notify(self.__child_watches, parent, EventType.CHILD)
+        return True
+
+    def __update_children(self, path):
+        node = self.__nodes[path]
+        self.__nodes[path] = FakeNode(node.data, node.stat._replace(numChildren=len(self.__get_children(path))))
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    # Recipes
+
+    def DataWatch(self, *args, **kwargs):
+        from kazoo.recipe.watchers import DataWatch
+        return DataWatch(self, *args, **kwargs)
+
+    def ChildrenWatch(self, *args, **kwargs):
+        from kazoo.recipe.watchers import ChildrenWatch
+        return ChildrenWatch(self, *args, **kwargs)
+
+
+class FakeTransaction(object):
+    """
+    Implements the ``TransactionRequest`` API for ``FakeZooKeeper``.
+
+    All operations are validated before any of them are applied, so a failed
+    transaction results in no changes.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.committed = False
+
+    def __repr__(self):
+        return '<%s: %s operations>' % (type(self).__name__, len(self.operations))
+
+    def create(self, path, value='', *args, **kwargs):
+        self.operations.append(('create', path, value))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', path, version))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set_data', path, value, version))
+
+    def check(self, path, version):
+        self.operations.append(('check', path, version))
+
+    def __validate(self, operation, paths):
+        # ``paths`` contains the existence and version state of each path as
+        # a result of the previously validated operations.
+        type, path = operation[:2]
+
+        def get_version():
+            if path in paths:
+                return paths[path]
+            stat = self.client.exists(path)
+            return stat.version if stat is not None else None
+
+        version = get_version()
+        if type == 'create':
+            if version is not None:
+                return NodeExistsError(path)
+            parent = posixpath.dirname(path)
+            if paths.get(parent, True) is None or (parent not in paths and self.client.exists(parent) is None):
+                return NoNodeError(parent)
+            paths[path] = 0
+        elif type in ('delete', 'set_data', 'check'):
+            expected = operation[-1]
+            if version is None:
+                return NoNodeError(path)
+            if expected != -1 and expected != version:
+                return BadVersionError(path)
+            if type == 'delete':
+                paths[path] = None
+            elif type == 'set_data':
+                paths[path] = version + 1
+
+    def commit(self):
+        paths = {}
+        errors = [self.__validate(operation, paths) for operation in self.operations]
+        self.committed = True
+        if any(errors):
+            return [error or None for error in errors]
+
+        results = []
+        for operation in self.operations:
+            type, path = operation[:2]
+            if type == 'create':
+                results.append(self.client.create(path, operation[2]))
+            elif type == 'delete':
+                results.append(self.client.delete(path))
+            elif type == 'set_data':
+                results.append(self.client.set(path, operation[2]))
+            elif type == 'check':
+                results.append(True)
+        return results
+
+
+# PgQ
+
+
+def to_event_payload(schema, table, operation, primary_keys, old=None, new=None, configuration_version='fake'):
+    """
+    Returns an event payload in the same format as the log trigger function.
+    """
+    return '0:%s' % pickle.dumps((
+        (schema, table),
+        operation,
+        primary_keys,
+        (old, new),
+        configuration_version,
+    ))
+
+
+def get_event_table(payload):
+    """
+    Returns the ``(schema, table)`` of an event payload.
+    """
+    version, payload = payload.split(':', 1)
+    return pickle.loads(payload)[0]
+
+
+def generate_events(count, size=100, tables=(('public', 'example'),), operation='INSERT'):
+    """
+    Generates ``count`` event payloads for the provided tables (chosen in
+    order, wrapping around), each containing a row with a padding column that
+    is ``size`` bytes long.
+    """
+    tables = itertools.cycle(tables)
+    for i in xrange(count):
+        schema, table = next(tables)
+        row = {'id': i, 'padding': 'x' * size}
+        old, new = (None, row) if operation == 'INSERT' else (row, row if operation == 'UPDATE' else None)
+        yield to_event_payload(schema, table, operation, ['id'], old, new)
+
+
+FakeTick = collections.namedtuple('FakeTick', 'id snapshot time events')
+
+FakeBatch = collections.namedtuple('FakeBatch', 'id start end')
+
+
+class FakeQueue(object):
+    """
+    An in-memory PgQ event queue.
+
+    Ticks (and the events contained within them) can be added explicitly by
+    calling ``tick``, or the queue can be provided with a ``source`` iterator,
+    which yields sequences of event payloads that will be used to create a new
+    tick whenever a consumer has consumed all previously existing ticks.
+    """
+    def __init__(self, name, source=None):
+        self.name = name
+        self.source = iter(source) if source is not None else None
+
+        self.ticks = [FakeTick(1, '1:1:', time.time(), ())]
+        self.consumers = {}
+
+        self.__event_id = itertools.count(1)
+        self.__transaction_id = itertools.count(2)
+
+    def __repr__(self):
+        return '<%s: %s (%s ticks)>' % (type(self).__name__, self.name, len(self.ticks))
+
+    def tick(self, payloads):
+        """
+        Adds a tick to the queue, containing events with the provided payloads.
+        """
+        transaction = next(self.__transaction_id)
+        now = time.time()
+        events = tuple(
+            (next(self.__event_id), payload, now, transaction)
+            for payload in payloads
+        )
+        tick = FakeTick(
+            self.ticks[-1].id + 1,
+            '%s:%s:' % (transaction + 1, transaction + 1),
+            now,
+            events,
+        )
+        self.ticks.append(tick)
+        return tick
+
+    def get_tick(self, id):
+        # Tick identifiers are sequential, starting from 1.
+        return self.ticks[id - 1]
+
+    def get_next_tick(self, id):
+        if id >= len(self.ticks) and self.source is not None:
+            try:
+                self.tick(next(self.source))
+            except StopIteration:
+                self.source = None
+
+        if id < len(self.ticks):
+            return self.ticks[id]
+
+
+class FakeConsumer(object):
+    def __init__(self, tick):
+        #: The last tick that was completely consumed.
+        self.tick = tick
+
+        #: The current batch (if one is in progress.)
+        self.batch = None
+
+    def copy(self):
+        consumer = FakeConsumer(self.tick)
+        consumer.batch = self.batch
+        return consumer
+
+
+class FakeServer(object):
+    """
+    An in-memory database server, providing ``pgq.*`` function semantics for
+    the functions used by the relay.
+
+    The ``get_database`` method can be used as a ``database_factory`` for
+    relays and workers.
+    """
+    def __init__(self, id=None):
+        self.id = id or uuid.uuid1()
+        self.queues = {}
+
+        # Operations that modify the queue state are serialized, mimicking
+        # the row locks that would be held by the database.
+        self.lock = threading.RLock()
+
+        self.__batch_id = itertools.count(1)
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.id)
+
+    def create_queue(self, name, source=None):
+        queue = self.queues[name] = FakeQueue(name, source)
+        return queue
+
+    def get_database(self, cluster, dsn):
+        return FakeDatabase(cluster, dsn, self)
+
+    def connect_async(self, dsn):
+        return FakeAsyncConnection(self, dsn)
+
+    # pgq.* functions, taking an additional ``state`` argument that contains
+    # the consumer state for the current transaction.
+
+    def register_consumer(self, state, queue, consumer):
+        queue = self.queues[queue]
+        if consumer in queue.consumers or (queue.name, consumer) in state:
+            return [(0,)]
+        state[(queue.name, consumer)] = FakeConsumer(queue.ticks[-1].id)
+        return [(1,)]
+
+    def next_batch_info(self, state, queue, consumer):
+        c = self.__get_consumer(state, queue, consumer)
+        if c.batch is None:
+            tick = self.queues[queue].get_next_tick(c.tick)
+            if tick is None:
+                return [(None,)]
+            c.batch = FakeBatch(next(self.__batch_id), c.tick, tick.id)
+        return [(c.batch.id,)]
+
+    def next_batch_custom(self, state, queue, consumer, min_lag, min_count, min_interval):
+        c = self.__get_consumer(state, queue, consumer)
+        if c.batch is None:
+            if min_count is None and min_interval is None:
+                return self.next_batch_info(state, queue, consumer)
+
+            # Custom batches span all of the ticks that are available (and at
+            # least ``min_lag`` seconds old), as long as they contain at least
+            # ``min_count`` events or cover at least ``min_interval`` seconds.
+            q = self.queues[queue]
+            q.get_next_tick(c.tick)
+            ticks = q.ticks[c.tick:]
+            if min_lag is not None:
+                ticks = [tick for tick in ticks if time.time() - tick.time >= min_lag]
+            if not ticks:
+                return [(None,)]
+
+            start, end = q.get_tick(c.tick), ticks[-1]
+            events = sum(len(tick.events) for tick in ticks)
+            if not ((min_count is not None and events >= min_count) or
+                    (min_interval is not None and end.time - start.time >= min_interval)):
+                return [(None,)]
+
+            c.batch = FakeBatch(next(self.__batch_id), c.tick, end.id)
+        return [(c.batch.id,)]
+
+    def get_batch_info(self, state, batch_id):
+        queue, batch = self.__find_batch(state, batch_id)
+        start, end = queue.get_tick(batch.start), queue.get_tick(batch.end)
+        return [(start.id, start.snapshot, start.time, end.id, end.snapshot, end.time, time.time() - end.time)]
+
+    def get_batch_events(self, state, batch_id, tables=None):
+        queue, batch = self.__find_batch(state, batch_id)
+        events = itertools.chain.from_iterable(
+            queue.get_tick(id).events for id in xrange(batch.start + 1, batch.end + 1)
+        )
+        if tables is not None:
+            # Mimics the selection of events by the table recorded in their
+            # extra fields.
+            events = (event for event in events if get_event_table(event[1]) in tables)
+        return list(events)
+
+    def finish_batch(self, state, batch_id):
+        for (queue, name), consumer in self.__iter_consumers(state):
+            if consumer.batch is not None and consumer.batch.id == batch_id:
+                c = self.__get_consumer(state, queue, name)
+                c.tick = c.batch.end
+                c.batch = None
+                return [(1,)]
+        return [(0,)]
+
+    def __iter_consumers(self, state):
+        for queue in self.queues.values():
+            for name in set(queue.consumers) | set(n for q, n in state if q == queue.name):
+                key = (queue.name, name)
+                yield key, state[key] if key in state else queue.consumers[name]
+
+    def __get_consumer(self, state, queue, consumer):
+        key = (queue, consumer)
+        if key not in state:
+            try:
+                state[key] = self.queues[queue].consumers[consumer].copy()
+            except KeyError:
+                raise FakeDatabaseError('Not subscriber to queue: %s/%s' % (queue, consumer))
+        return state[key]
+
+    def __find_batch(self, state, batch_id):
+        for (queue, name), consumer in self.__iter_consumers(state):
+            if consumer.batch is not None and consumer.batch.id == batch_id:
+                return self.queues[queue], consumer.batch
+        raise FakeDatabaseError('batch not found: %s' % (batch_id,))
+
+    def commit(self, state):
+        for (queue, name), consumer in state.items():
+            self.queues[queue].consumers[name] = consumer
+
+
+class FakeDatabaseError(Exception):
+    pass
+
+
+class FakeCursor(object):
+    FUNCTION_EXPRESSION = re.compile(r'\bpgq\.(\w+)\(')
+    PREPARE_EXPRESSION = re.compile(r'^PREPARE "?(\w+)"?(?: \(.*?\))? AS (.*)$', re.DOTALL)
+    EXECUTE_EXPRESSION = re.compile(r'^EXECUTE "?(\w+)"?')
+
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.__results = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.__results
+
+    def close(self):
+        self.__results = iter(())
+
+    def execute(self, statement, parameters=()):
+        match = self.PREPARE_EXPRESSION.match(statement)
+        if match is not None:
+            name, statement = match.groups()
+            if name in self.connection.prepared:
+                raise FakeDatabaseError('prepared statement "%s" already exists' % (name,))
+            self.connection.prepared[name] = statement
+            self.__results = iter(())
+            return
+
+        match = self.EXECUTE_EXPRESSION.match(statement)
+        if match is not None:
+            try:
+                statement = self.connection.prepared[match.group(1)]
+            except KeyError:
+                raise FakeDatabaseError('prepared statement "%s" does not exist' % (match.group(1),))
+
+        # Only the first pgq function is used for dispatching, since the
+        # statements used by the relay only call one pgq function each.
+        match = self.FUNCTION_EXPRESSION.search(statement)
+        if match is None:
+            raise FakeDatabaseError('Unsupported statement: %s' % (statement,))
+        self.__results = iter(self.connection.call(match.group(1), *parameters))
+
+    def fetchone(self):
+        return next(self.__results, None)
+
+    def fetchall(self):
+        return list(self.__results)
+
+
+class FakeConnection(object):
+    def __init__(self, server, dsn):
+        self.server = server
+        self.dsn = dsn
+        self.closed = False
+
+        #: Prepared statements, by name.
+        self.prepared = {}
+
+        self.__state = None
+
+    @property
+    def in_transaction(self):
+        return self.__state is not None
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def call(self, function, *args):
+        with self.server.lock:
+            if self.__state is None:
+                self.__state = {}
+
+            try:
+                method = getattr(self.server, function)
+            except AttributeError:
+                raise FakeDatabaseError('Unsupported function: pgq.%s' % (function,))
+
+            return method(self.__state, *args)
+
+    def commit(self):
+        with self.server.lock:
+            if self.__state is not None:
+                self.server.commit(self.__state)
+            self.__state = None
+
+    def rollback(self):
+        self.__state = None
+
+    def close(self):
+        self.rollback()
+        self.prepared.clear()
+        self.closed = True
+
+
+class FakeDatabase(object):
+    """
+    Implements the ``ManagedDatabase`` API for a ``FakeServer``.
+    """
+    def __init__(self, cluster, dsn, server):
+        self.cluster = cluster
+        self.dsn = dsn
+        self.server = server
+
+        self.__connection = FakeConnection(server, dsn)
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        return '%s' % (self.dsn,)
+
+    def __repr__(self):
+        return '<%s: %s (%s)>' % (type(self).__name__, self.dsn, self.id)
+
+    @property
+    def id(self):
+        return self.server.id
+
+    def close(self):
+        pass
+
+    @contextmanager
+    def connection(self):
+        with self.__lock:
+            connection = self.__connection
+            try:
+                yield connection
+            except Exception:
+                connection.rollback()
+                raise
+            else:
+                if connection.in_transaction:
+                    connection.rollback()
+                    raise RuntimeError("Did not commit or rollback open transaction before releasing connection.")
+
+
+class FakeAsyncCursor(object):
+    DECLARE_EXPRESSION = re.compile(r'^DECLARE (\w+) .*?CURSOR FOR (.*)$', re.DOTALL)
+    FETCH_EXPRESSION = re.compile(r'^FETCH %s FROM (\w+)$')
+    CLOSE_EXPRESSION = re.compile(r'^CLOSE (\w+)$')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.__results = []
+
+    def execute(self, statement, parameters=()):
+        self.connection.begin_operation()
+
+        self.description = None
+        self.__results = []
+
+        connection = self.connection.connection
+        if statement == 'BEGIN':
+            self.connection.in_transaction = True
+        elif statement in ('COMMIT', 'ROLLBACK'):
+            if statement == 'COMMIT':
+                connection.commit()
+            else:
+                connection.rollback()
+            self.connection.in_transaction = False
+        elif 'configuration' in statement:
+            self.__set_results([(self.connection.server.id.hex,)])
+        elif self.DECLARE_EXPRESSION.match(statement):
+            name, statement = self.DECLARE_EXPRESSION.match(statement).groups()
+            with connection.cursor() as cursor:
+                cursor.execute(statement, parameters)
+                self.connection.cursors[name] = iter(cursor.fetchall())
+        elif self.FETCH_EXPRESSION.match(statement):
+            (count,) = parameters
+            rows = self.connection.cursors[self.FETCH_EXPRESSION.match(statement).group(1)]
+            self.__set_results(list(itertools.islice(rows, count)))
+        elif self.CLOSE_EXPRESSION.match(statement):
+            del self.connection.cursors[self.CLOSE_EXPRESSION.match(statement).group(1)]
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute(statement, parameters)
+                if not statement.startswith('PREPARE'):
+                    self.__set_results(cursor.fetchall())
+
+        # Asynchronous connections are in autocommit mode.
+        if not self.connection.in_transaction:
+            connection.commit()
+
+    def __set_results(self, results):
+        self.description = ()
+        self.__results = results
+
+    def fetchall(self):
+        if self.description is None:
+            raise FakeDatabaseError('no results to fetch')
+        return self.__results
+
+
+class FakeAsyncConnection(object):
+    """
+    Implements the asynchronous ``psycopg2.connection`` API for a
+    ``FakeServer``, as used by the evented relay.
+
+    Statements are executed immediately, but each operation reports that it
+    is waiting to read once before completing, so that it is dispatched
+    through the event loop.
+    """
+    def __init__(self, server, dsn):
+        self.server = server
+        self.dsn = dsn
+        self.closed = False
+
+        self.connection = FakeConnection(server, dsn)
+        self.in_transaction = False
+
+        #: Declared cursors, by name.
+        self.cursors = {}
+
+        # A pipe that is always readable, to stand in for the socket.
+        self.__read, self.__write = os.pipe()
+        os.write(self.__write, '\0')
+
+        self.__waiting = True
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.dsn)
+
+    def begin_operation(self):
+        if self.closed:
+            raise FakeDatabaseError('connection already closed')
+        self.__waiting = True
+
+    def fileno(self):
+        return self.__read
+
+    def poll(self):
+        if self.closed:
+            raise FakeDatabaseError('connection already closed')
+
+        if self.__waiting:
+            self.__waiting = False
+            return psycopg2.extensions.POLL_READ
+        return psycopg2.extensions.POLL_OK
+
+    def cursor(self):
+        return FakeAsyncCursor(self)
+
+    def close(self):
+        if not self.closed:
+            self.connection.close()
+            os.close(self.__read)
+            os.close(self.__write)
+            self.closed = True
+
+
+# Handlers
+
+
+class CountingHandler(object):
+    """
+    A handler that discards all messages, while keeping count of the messages
+    (and completed batches) that it has acknowledged.
+    """
+    def __init__(self):
+        self.messages = 0
+        self.mutations = 0
+        self.commits = 0
+        self.rollbacks = 0
+
+        self.__condition = threading.Condition()
+
+    def __str__(self):
+        return 'Counting handler'
+
+    def __repr__(self):
+        return '<%s: %s messages, %s commits, %s rollbacks>' % (
+            type(self).__name__,
+            self.messages,
+            self.commits,
+            self.rollbacks,
+        )
+
+    def push(self, messages):
+        with self.__condition:
+            for message in messages:
+                self.messages += 1
+                operation = message.batch_operation.WhichOneof('operation')
+                if operation == 'mutation_operation':
+                    self.mutations += 1
+                elif operation == 'commit_operation':
+                    self.commits += 1
+                elif operation == 'rollback_operation':
+                    self.rollbacks += 1
+            self.__condition.notify_all()
+
+    def wait(self, commits=0, timeout=None, mutations=0):
+        """
+        Blocks until at least ``commits`` batches have been committed (and at
+        least ``mutations`` mutations have been received), returning a boolean
+        representing whether or not the counts were reached within the
+        timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.__condition:
+            while self.commits < commits or self.mutations < mutations:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__condition.wait(remaining)
+            return True
@@ -1,3 +1,4 @@
+import decimal
 import numbers
 
 from pgshovel.interfaces.common_pb2 import (
@@ -27,8 +28,12 @@ def to_snapshot(value):
 class ColumnConverter(object):
     def __init__(self):
         self.conversions = {
-            basestring: lambda value: {'string': value.encode('utf8')},
+            # Text is provided by PL/Python as UTF-8 encoded bytes.
+            basestring: lambda value: {'string': value.encode('utf8') if isinstance(value, unicode) else value},
             bool: lambda value: {'boolean': value},
+            # ``numeric`` values are provided as ``Decimal`` by PL/Python
+            # (since PostgreSQL 9.5), and are represented exactly as strings.
+            decimal.Decimal: lambda value: {'string': str(value)},
             float: lambda value: {'float': value},
             numbers.Integral: lambda value: {'integer64': value},
         }
@@ -1,7 +1,14 @@
 import logging
+import operator
+import sys
 import uuid
 from contextlib import contextmanager
 
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    wait,
+)
+
 from pgshovel.utilities.exceptions import chained
 
 
@@ -71,34 +78,76 @@ class Transaction(object):
         logger.info('Successfully rolled back %s.', self)
 
 
-@contextmanager
-def managed(transactions):
+#: The maximum number of nodes that are communicated with concurrently when
+#: performing administrative operations.
+DEFAULT_MAX_WORKERS = 16
+
+
+def run_concurrently(function, items, max_workers=DEFAULT_MAX_WORKERS):
     """
-    Prepares a sequence of transactions (in the order they were provided),
-    committing them all if the managed block executes successfully, otherwise
-    rolling them all back.
+    Calls ``function`` with each of the provided items using a bounded thread
+    pool, returning a list of ``(item, future)`` pairs (in the order the items
+    were provided) after all calls have completed, successfully or not.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    with ThreadPoolExecutor(min(max_workers, len(items))) as executor:
+        futures = [executor.submit(function, item) for item in items]
+        wait(futures)
+
+    return zip(items, futures)
+
 
-    If any of the ``commit`` or ``rollback`` operations fail, the transactions
-    will need to be manually recovered by an administrator.
+def raise_first_exception(results):
     """
-    prepared = []
+    Returns the results of a sequence of ``(item, future)`` pairs (as returned
+    by ``run_concurrently``), raising the first exception that was
+    encountered, if any.
+    """
+    return [future.result() for item, future in results]
+
+
+@contextmanager
+def managed(transactions, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Prepares a sequence of transactions concurrently, committing them all if
+    the managed block executes successfully, otherwise rolling them all back.
+
+    If any of the transactions cannot be prepared, all of the transactions
+    that were successfully prepared are rolled back. If any of the ``commit``
+    or ``rollback`` operations fail, the transactions will need to be manually
+    recovered by an administrator. (All transactions are attempted to be
+    committed or rolled back, even if one fails, to minimize the number of
+    transactions that require recovery.)
+    """
+    def finish(prepared, operation):
+        raise_first_exception(run_concurrently(
+            operator.methodcaller(operation),
+            prepared,
+            max_workers=max_workers,
+        ))
+
+    # Prepare all of the database transactions...
+    results = run_concurrently(
+        operator.methodcaller('prepare'),
+        transactions,
+        max_workers=max_workers,
+    )
+    prepared = [transaction for transaction, future in results if future.exception() is None]
 
     try:
-        # Prepare all of the database transactions...
-        for transaction in transactions:
-            transaction.prepare()
-            prepared.append(transaction)
+        raise_first_exception(results)
         yield
     except Exception:
         # If an exception is raised (for any reason) during the transaction
         # block, roll back all of the transations that have already been
         # prepared.
-        for transaction in prepared:
-            transaction.rollback()
-
-        raise
+        error = sys.exc_info()
+        finish(prepared, 'rollback')
+        raise error[0], error[1], error[2]
 
     # If we got this far, then everything is OK and we can finalize all
     # transactions.
-    for transaction in prepared:
-        transaction.commit()
+    finish(prepared, 'commit')
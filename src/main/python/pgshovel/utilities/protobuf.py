@@ -26,3 +26,37 @@ class TextCodec(object):
         # TODO: Replace this with a better validation routine.
         m.SerializeToString()
         return m
+
+
+def encode_varint(value):
+    """
+    Encodes a non-negative integer as a base 128 varint, as used by the
+    protocol buffer wire format (and for delimiting messages in streams.)
+    """
+    assert value >= 0
+    output = []
+    while value > 0x7f:
+        output.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    output.append(chr(value))
+    return ''.join(output)
+
+
+def decode_varint(buffer, offset=0):
+    """
+    Decodes a base 128 varint starting at the provided offset of the buffer,
+    returning a ``(value, offset)`` tuple, where the offset is the position
+    following the varint.
+
+    If the buffer ends before the varint is complete, an ``IndexError`` is
+    raised.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(buffer[offset])
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
@@ -1,12 +1,30 @@
 import uuid
 
+import psycopg2
+import pytest
+from psycopg2 import errorcodes
+
+from pgshovel import administration
 from pgshovel.administration import (
+    LockPolicy,
+    apply_trigger_changes,
+    configure_queue,
     create_set,
     drop_set,
+    get_set_status,
+    initialize_cluster,
+    get_trigger_arguments,
+    get_trigger_changes,
     update_set,
     upgrade_cluster,
 )
-from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.cluster import Cluster
+from pgshovel.interfaces.configurations_pb2 import (
+    ReplicationSetConfiguration,
+    TableFilterConfiguration,
+)
+from pgshovel.testing import FakeZooKeeper
+from tests.pgshovel.cluster import encode_set
 from tests.pgshovel.fixtures import (
     cluster,
     create_temporary_database
@@ -41,3 +59,214 @@ def test_workflows(cluster):
         update_set(cluster, 'example', replication_set)
 
         drop_set(cluster, 'example')
+
+
+class TriggerCursor(object):
+    def __init__(self, installed):
+        self.installed = installed
+
+    def execute(self, statement, parameters=()):
+        pass
+
+    def fetchall(self):
+        return [(schema, table, ''.join('%s\0' % (argument,) for argument in arguments)) for (schema, table), arguments in self.installed.items()]
+
+    def mogrify(self, statement, parameters):
+        return statement % tuple(map(repr, parameters))
+
+
+def test_trigger_changes():
+    example_cluster = Cluster('example', None)
+
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = 'postgres:///example'
+    unchanged = configuration.tables.add(name='unchanged', primary_keys=['id'])
+    changed = configuration.tables.add(name='changed', primary_keys=['id'])
+    configuration.tables.add(name='added', primary_keys=['id'])
+
+    installed = {
+        ('public', 'unchanged'): get_trigger_arguments(example_cluster, 'example', unchanged),
+        ('public', 'changed'): get_trigger_arguments(example_cluster, 'example', changed),
+        ('public', 'removed'): ('arguments',),
+    }
+    changed.columns.extend(['id', 'name'])
+
+    # Relay filters are not used by the trigger, and do not require changes.
+    unchanged.filter.operations.append(TableFilterConfiguration.INSERT)
+
+    changes = get_trigger_changes(example_cluster, TriggerCursor(installed), 'example', configuration.tables)
+    assert [key for key, statement in changes] == [
+        ('public', 'changed'),
+        ('public', 'added'),
+        ('public', 'removed'),
+    ]
+
+    statements = dict(changes)
+    assert 'UPDATE OF "id", "name" OR DELETE' in statements[('public', 'changed')]
+    assert statements[('public', 'removed')].startswith('DROP TRIGGER')
+
+
+class LockNotAvailable(psycopg2.OperationalError):
+    pgcode = errorcodes.LOCK_NOT_AVAILABLE
+
+
+class LockingCursor(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.statements = []
+
+    def execute(self, statement, parameters=()):
+        self.statements.append(statement)
+        if self.failures.get(statement, 0) > 0:
+            self.failures[statement] -= 1
+            raise LockNotAvailable('could not obtain lock')
+
+
+def test_apply_trigger_changes_retries():
+    changes = [(('public', 'a'), 'CREATE a'), (('public', 'b'), 'CREATE b')]
+    policy = LockPolicy(timeout=100, attempts=3, backoff=0, max_backoff=0, tables_per_transaction=None)
+
+    # The batch times out once, then each table is applied individually, with
+    # the second table being retried.
+    cursor = LockingCursor({'CREATE a;\nCREATE b': 1, 'CREATE b': 2})
+    apply_trigger_changes(cursor, changes, policy)
+    assert [statement for statement in cursor.statements if statement.startswith('CREATE')] == [
+        'CREATE a;\nCREATE b',
+        'CREATE a',
+        'CREATE b',
+        'CREATE b',
+        'CREATE b',
+    ]
+    assert cursor.statements[-1] == 'RELEASE SAVEPOINT pgshovel_triggers'
+
+    # Exceeding the number of attempts for any table raises the error.
+    cursor = LockingCursor({'CREATE a;\nCREATE b': 1, 'CREATE a': 3})
+    with pytest.raises(LockNotAvailable):
+        apply_trigger_changes(cursor, changes, policy)
+    assert cursor.statements[-1] == 'ROLLBACK TO SAVEPOINT pgshovel_triggers'
+
+
+class UpgradeConnection(object):
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = False
+
+    def xid(self, *args):
+        return args
+
+    def tpc_begin(self, xid):
+        pass
+
+    def cursor(self):
+        # The connection is also used as its own cursor, so that the cursor
+        # can identify the database that it belongs to.
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_upgrade_cluster_failure(monkeypatch):
+    connections = dict((dsn, UpgradeConnection(dsn)) for dsn in ('postgres:///a', 'postgres:///b'))
+    monkeypatch.setattr(administration, 'get_managed_databases', lambda *args, **kwargs: connections)
+
+    def setup_database(_, cursor):
+        if cursor.dsn.endswith('b'):
+            raise psycopg2.OperationalError('could not upgrade')
+
+    monkeypatch.setattr(administration, 'setup_database', setup_database)
+
+    fake_cluster = Cluster('test', FakeZooKeeper())
+    with fake_cluster:
+        initialize_cluster(fake_cluster)
+        with pytest.raises(psycopg2.OperationalError):
+            upgrade_cluster(fake_cluster, force=True)
+
+    # All connections (including those that were upgraded successfully) are
+    # closed, rather than being left with open transactions.
+    assert all(connection.closed for connection in connections.values())
+
+
+class StatusCursor(object):
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def execute(self, statement, parameters):
+        (queue,) = parameters
+        if 'get_queue_info' in statement:
+            self.results = [(1.5, 1440000000.5, 10, 65536)] if not queue.endswith(':d') else []
+        elif queue.endswith(':a'):
+            self.results = [('default', 25, 3.0, 0.5)]
+        else:
+            self.results = []
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def fetchall(self):
+        return self.results
+
+
+class StatusConnection(object):
+    def __init__(self, dsn):
+        if dsn.endswith('unavailable'):
+            raise psycopg2.OperationalError('could not connect')
+        self.dsn = dsn
+
+    def cursor(self):
+        return StatusCursor(self.dsn)
+
+    def close(self):
+        pass
+
+
+def test_set_status(monkeypatch):
+    monkeypatch.setattr(psycopg2, 'connect', StatusConnection)
+
+    fake_cluster = Cluster('test', FakeZooKeeper())
+    with fake_cluster:
+        initialize_cluster(fake_cluster)
+        for name, dsn in (('a', 'postgres:///a'), ('b', 'postgres:///a'), ('c', 'postgres:///unavailable'), ('d', 'postgres:///a')):
+            fake_cluster.zookeeper.create(fake_cluster.get_set_path(name), encode_set(dsn))
+
+        a, b, c, d = get_set_status(fake_cluster)
+
+    assert (a.name, a.consumer, a.pending_events, a.consumer_lag, a.ticker_lag, a.last_tick, a.table_size) == ('a', 'default', 25, 3.0, 1.5, 1440000000.5, 65536)
+    assert (b.name, b.consumer, b.pending_events, b.new_events) == ('b', None, None, 10)
+    assert (c.name, c.dsn, c.ticker_lag) == ('c', 'postgres:///unavailable', None)
+    assert isinstance(c.error, psycopg2.OperationalError)
+
+    # A set without a queue is reported as such, without affecting the other
+    # sets in the same database.
+    assert (d.name, d.dsn, d.ticker_lag) == ('d', 'postgres:///a', None)
+    assert isinstance(d.error, LookupError)
+
+
+def test_configure_queue():
+    cursor = LockingCursor({})
+    cursor.mogrify = lambda statement, parameters: statement % tuple(map(repr, parameters))
+
+    configuration = ReplicationSetConfiguration()
+    configuration.queue.ticker_max_lag = 0.5
+    configure_queue(Cluster('example', None), cursor, 'set', configuration)
+
+    (statement,) = cursor.statements
+    assert statement.split(';\n') == [
+        "SELECT pgq.set_queue_config('pgshovel:example:set', 'ticker_max_count', '500')",
+        "SELECT pgq.set_queue_config('pgshovel:example:set', 'ticker_max_lag', '0.5 seconds')",
+        "SELECT pgq.set_queue_config('pgshovel:example:set', 'ticker_idle_period', '60.0 seconds')",
+        "SELECT pgq.set_queue_config('pgshovel:example:set', 'rotation_period', '7200.0 seconds')",
+    ]
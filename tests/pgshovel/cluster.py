@@ -0,0 +1,104 @@
+import collections
+
+import pytest
+from kazoo.exceptions import NoNodeError
+
+from pgshovel import __version__
+from pgshovel.administration import (
+    fetch_sets,
+    initialize_cluster,
+)
+from pgshovel.cluster import (
+    Cluster,
+    VersionMismatchError,
+    check_version,
+)
+from pgshovel.interfaces.configurations_pb2 import (
+    ClusterConfiguration,
+    ReplicationSetConfiguration,
+)
+from pgshovel.testing import FakeZooKeeper
+from pgshovel.utilities.protobuf import BinaryCodec
+
+
+class CountingZooKeeper(FakeZooKeeper):
+    def __init__(self):
+        super(CountingZooKeeper, self).__init__()
+        self.reads = collections.Counter()
+
+    def get(self, path, watch=None):
+        self.reads[path] += 1
+        return super(CountingZooKeeper, self).get(path, watch)
+
+    def get_children(self, path, watch=None, include_data=False):
+        self.reads[path] += 1
+        return super(CountingZooKeeper, self).get_children(path, watch, include_data)
+
+
+def encode_set(dsn):
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = dsn
+    return BinaryCodec(ReplicationSetConfiguration).encode(configuration)
+
+
+@pytest.yield_fixture
+def cluster():
+    cluster = Cluster('test', CountingZooKeeper())
+    with cluster:
+        initialize_cluster(cluster)
+        for name in ('a', 'b'):
+            cluster.zookeeper.create(cluster.get_set_path(name), encode_set('postgres:///%s' % (name,)))
+        yield cluster
+
+
+def test_cached_sets(cluster):
+    zookeeper = cluster.zookeeper
+
+    for i in xrange(3):
+        sets = fetch_sets(cluster)
+        assert [(name, configuration.database.dsn) for name, (configuration, stat) in sets] == [
+            ('a', 'postgres:///a'),
+            ('b', 'postgres:///b'),
+        ]
+
+    assert zookeeper.reads[cluster.get_set_path()] == 1
+    assert zookeeper.reads[cluster.get_set_path('a')] == 1
+
+    # Returned configurations can be modified without affecting the cache.
+    ((name, (configuration, stat)),) = fetch_sets(cluster, ('a',))
+    configuration.database.dsn = 'postgres:///modified'
+    assert fetch_sets(cluster, ('a',))[0][1][0].database.dsn == 'postgres:///a'
+
+    # Changes (and deletions) are picked up through watches.
+    zookeeper.set(cluster.get_set_path('a'), encode_set('postgres:///updated'))
+    zookeeper.delete(cluster.get_set_path('b'))
+    zookeeper.create(cluster.get_set_path('c'), encode_set('postgres:///c'))
+
+    sets = fetch_sets(cluster)
+    assert [(set_name, set_configuration.database.dsn) for set_name, (set_configuration, set_stat) in sets] == [
+        ('a', 'postgres:///updated'),
+        ('c', 'postgres:///c'),
+    ]
+    assert zookeeper.reads[cluster.get_set_path('a')] == 2
+
+    with pytest.raises(NoNodeError):
+        fetch_sets(cluster, ('b',))
+
+
+def test_cached_cluster_configuration(cluster):
+    zookeeper = cluster.zookeeper
+
+    check_version(cluster)
+    check_version(cluster)
+    assert zookeeper.reads[cluster.path] == 1
+
+    zookeeper.set(cluster.path, BinaryCodec(ClusterConfiguration).encode(ClusterConfiguration(version='0.0.0')))
+    with pytest.raises(VersionMismatchError):
+        check_version(cluster)
+
+    # Interrupting the session clears the cache.
+    zookeeper.set(cluster.path, BinaryCodec(ClusterConfiguration).encode(ClusterConfiguration(version=__version__)))
+    zookeeper.suspend()
+    zookeeper.start()
+    check_version(cluster)
+    assert zookeeper.reads[cluster.path] == 3
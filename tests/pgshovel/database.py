@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+
+import pytest
+
+from pgshovel.database import (
+    ConnectionPool,
+    PreparedStatement,
+)
+from pgshovel.testing import (
+    FakeConnection,
+    FakeDatabaseError,
+    FakeServer,
+)
+
+
+class StubConnection(object):
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = False
+
+    @contextmanager
+    def __call__(self, close=False):
+        yield self
+        if close:
+            self.closed = True
+
+
+def test_prepared_statement():
+    server = FakeServer()
+    server.create_queue('queue')
+
+    statement = PreparedStatement('register', 'SELECT * FROM pgq.register_consumer($1, $2)', ('text', 'text'))
+
+    connection = FakeConnection(server, 'fake://')
+    with connection.cursor() as cursor:
+        statement.execute(cursor, ('queue', 'a'))
+        assert cursor.fetchone() == (1,)
+
+        # Subsequent executions reuse the prepared statement.
+        statement.execute(cursor, ('queue', 'b'))
+        assert cursor.fetchone() == (1,)
+    connection.commit()
+
+    assert list(connection.prepared) == ['register']
+    assert set(server.queues['queue'].consumers) == set(['a', 'b'])
+
+    # Statements are prepared again on new connections.
+    connection = FakeConnection(server, 'fake://')
+    with connection.cursor() as cursor:
+        statement.execute(cursor, ('queue', 'a'))
+        assert cursor.fetchone() == (0,)
+    connection.commit()
+
+    with pytest.raises(FakeDatabaseError):
+        with connection.cursor() as cursor:
+            cursor.execute('PREPARE register AS SELECT 1')
+
+
+def test_connection_pool():
+    pool = ConnectionPool(max_idle=1)
+
+    a, b = StubConnection('postgres:///a'), StubConnection('postgres:///a')
+    pool.put(a)
+    pool.put(b)
+    assert b.closed  # exceeds the number of idle connections
+
+    assert pool.get('postgres:///a') is a
+    assert pool.get('postgres:///a') is not a
+
+    pool.put(a)
+    pool.clear()
+    assert a.closed
+    assert pool.get('postgres:///a') is not a
@@ -0,0 +1,249 @@
+import decimal
+import re
+import uuid
+
+from pgshovel.interfaces.configurations_pb2 import (
+    ColumnPredicate,
+    ReplicationSetConfiguration,
+)
+from pgshovel.relay.bootstrap import (
+    BOOTSTRAP_BATCH_ID,
+    Bootstrap,
+    RowReader,
+    get_chunks,
+    get_converters,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.utilities.conversions import row_converter
+from tests.pgshovel.relay.replay import ListHandler
+
+
+node = uuid.uuid1()
+
+
+class Cluster(object):
+    schema = 'pgshovel'
+
+
+def to_copy_text(value):
+    """
+    Returns the ``COPY`` text format representation of a value.
+    """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+class FakeCursor(object):
+    LOWER_BOUND = re.compile(r'> \((\d+)\)')
+    UPPER_BOUND = re.compile(r'<= \((\d+)\)')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.results = None
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def execute(self, statement, parameters=()):
+        self.connection.statements.append(statement)
+        if 'pg_export_snapshot' in statement:
+            self.results = [('00000003-1', 12, '10:14:12', 1440000000.5)]
+        elif 'configuration' in statement:
+            self.results = [(node.hex,)]
+        elif 'LIMIT 0' in statement:
+            self.description = [(name, type) for name, type in self.connection.types]
+            self.results = []
+        elif 'OFFSET' in statement:
+            ids = sorted(self.connection.rows)
+            if len(parameters) > 1:
+                ((lower,), offset) = parameters
+                ids = [id for id in ids if id > lower]
+            else:
+                (offset,) = parameters
+            self.results = [(id,) for id in ids[offset:offset + 1]]
+        else:
+            self.results = []
+
+    def fetchone(self):
+        return self.results[0] if self.results else None
+
+    def fetchall(self):
+        return self.results
+
+    def mogrify(self, statement, parameters):
+        return statement % tuple('(%s)' % (value,) for (value,) in parameters)
+
+    def copy_expert(self, statement, file):
+        lower = self.LOWER_BOUND.search(statement)
+        upper = self.UPPER_BOUND.search(statement)
+        for id, row in sorted(self.connection.rows.items()):
+            if lower and id <= int(lower.group(1)):
+                continue
+            if upper and id > int(upper.group(1)):
+                continue
+            file.write('\t'.join(to_copy_text(row[name]) for name, type in self.connection.types) + '\n')
+
+
+class FakeConnection(object):
+    def __init__(self, rows, types):
+        self.rows = rows
+        self.types = types
+        self.statements = []
+        self.closed = False
+
+    def set_session(self, **kwargs):
+        pass
+
+    def set_client_encoding(self, encoding):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+def test_get_chunks():
+    assert list(get_chunks('table', [])) == [('table', None, None)]
+    assert list(get_chunks('table', iter([(10,), (20,)]))) == [
+        ('table', None, (10,)),
+        ('table', (10,), (20,)),
+        ('table', (20,), None),
+    ]
+
+
+def test_row_reader():
+    # Text format output of (int4, text, json, bool, numeric, int8,
+    # timestamptz, bytea) columns, as it is written by ``COPY``.
+    reader = RowReader(get_converters([
+        ('id', 23),
+        ('name', 25),
+        ('data', 114),
+        ('active', 16),
+        ('balance', 1700),
+        ('counter', 20),
+        ('updated', 1184),
+        ('data_bytes', 17),
+    ]))
+    reader.write('1\tback\\\\slash\ttab\\there\t\\N\t12345678901234567890.000000000001\t9223372036854775807\t')
+    reader.write('2015-08-19 21:07:52.123456+00\t\\\\x005c7f\n2\t\\N\t{"key": [1, 2]}\tt\t-0.10\t-1\t\\N\t\\N\n')
+
+    # The values are the same as those provided to the log trigger by
+    # PL/Python.
+    assert reader.rows == [
+        {
+            'id': 1,
+            'name': 'back\\slash',
+            'data': 'tab\there',
+            'active': None,
+            'balance': decimal.Decimal('12345678901234567890.000000000001'),
+            'counter': 9223372036854775807,
+            'updated': '2015-08-19 21:07:52.123456+00',
+            'data_bytes': '\x00\\\x7f',
+        },
+        {
+            'id': 2,
+            'name': None,
+            'data': '{"key": [1, 2]}',
+            'active': True,
+            'balance': decimal.Decimal('-0.10'),
+            'counter': -1,
+            'updated': None,
+            'data_bytes': None,
+        },
+    ]
+
+    # Values are represented without loss of precision.
+    assert row_converter.to_python(row_converter.to_protobuf(reader.rows[0])) == {
+        'id': 1,
+        'name': 'back\\slash',
+        'data': 'tab\there',
+        'active': None,
+        'balance': '12345678901234567890.000000000001',
+        'counter': 9223372036854775807,
+        'updated': '2015-08-19 21:07:52.123456+00',
+        'data_bytes': '\x00\\\x7f',
+    }
+
+
+def test_bootstrap():
+    rows = dict((id, {'id': id, 'name': 'row %s' % (id,)}) for id in xrange(1, 8))
+    connections = []
+
+    def connect(dsn):
+        connection = FakeConnection(rows, [('id', 23), ('name', 25)])
+        connections.append(connection)
+        return connection
+
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = 'postgres:///example'
+    table = configuration.tables.add(name='example', primary_keys=['id'])
+
+    handler = ListHandler()
+    bootstrap = Bootstrap(Cluster(), configuration, handler, workers=2, chunk_size=3, connect=connect)
+    assert bootstrap.run() == 7
+
+    # Every worker should have imported the exported snapshot before reading.
+    for connection in connections[1:]:
+        assert connection.statements[0] == 'SET TRANSACTION SNAPSHOT %s'
+    assert all(connection.closed for connection in connections)
+
+    # Chunk boundaries should be found by paging through the primary key
+    # (after rows 3 and 6), rather than by numbering every row in the table.
+    boundaries = [statement for connection in connections for statement in connection.statements if 'OFFSET' in statement]
+    assert len(boundaries) == 3
+    assert 'row_number' not in ''.join(boundaries)
+
+    ((batch, mutations),) = [(batch, list(mutations)) for batch, mutations in batched(states.validate(sequences.validate(handler.messages)))]
+    assert batch.id == BOOTSTRAP_BATCH_ID
+    assert batch.node == node.bytes
+
+    begin = handler.messages[0].batch_operation.begin_operation
+    assert begin.start == begin.end
+    assert begin.start.snapshot.min == 10
+    assert list(begin.start.snapshot.active) == [12]
+
+    assert [row_converter.to_python(mutation.new) for mutation in mutations] == [rows[id] for id in sorted(rows)]
+    for mutation in mutations:
+        assert mutation.table == table.name
+        assert list(mutation.identity_columns) == ['id']
+        assert mutation.transaction == 12
+
+
+def test_bootstrap_filtered_text():
+    rows = {
+        1: {'id': 1, 'city': u'Z\xfcrich'.encode('utf-8')},
+        2: {'id': 2, 'city': 'Bern'},
+        3: {'id': 3, 'city': u'Gen\xe8ve'.encode('utf-8')},
+    }
+
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = 'postgres:///example'
+    included = configuration.tables.add(name='included', primary_keys=['id'])
+    included.filter.predicates.add(column='city').values.add(string=u'Z\xfcrich')
+    excluded = configuration.tables.add(name='excluded', primary_keys=['id'])
+    excluded.filter.predicates.add(column='city', operator=ColumnPredicate.NOT_IN).values.add(string=u'Z\xfcrich')
+
+    handler = ListHandler()
+    connect = lambda dsn: FakeConnection(rows, [('id', 23), ('city', 25)])
+    bootstrap = Bootstrap(Cluster(), configuration, handler, workers=2, chunk_size=2, connect=connect)
+    assert bootstrap.run() == 3
+
+    # Non-ASCII text is compared to the predicate values in the same (UTF-8
+    # encoded) form as it is when relaying mutations from the queue.
+    ((batch, mutations),) = [(batch, list(mutations)) for batch, mutations in batched(states.validate(sequences.validate(handler.messages)))]
+    assert [(mutation.table, row_converter.to_python(mutation.new)['city']) for mutation in mutations] == [
+        ('included', u'Z\xfcrich'),
+        ('excluded', u'Bern'),
+        ('excluded', u'Gen\xe8ve'),
+    ]
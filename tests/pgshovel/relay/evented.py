@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.relay.evented import (
+    EventLoop,
+    EventedRelay,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.testing import (
+    CountingHandler,
+    FakeServer,
+    generate_events,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+from tests.pgshovel.testing import (
+    create_cluster,
+    create_set,
+)
+
+
+class RecordingHandler(CountingHandler):
+    def __init__(self):
+        super(RecordingHandler, self).__init__()
+        self.recorded = []
+
+    def push(self, messages):
+        messages = list(messages)
+        self.recorded.extend(messages)
+        super(RecordingHandler, self).push(messages)
+
+
+def test_event_loop():
+    loop = EventLoop()
+    calls = []
+
+    loop.call_later(0.02, calls.append, 'later')
+    loop.call_later(0.01, calls.append, 'sooner')
+    loop.call_later(0.005, calls.append, 'cancelled').cancel()
+    loop.call_soon(calls.append, 'soon')
+
+    read, write = os.pipe()
+
+    def readable(revents):
+        calls.append(os.read(read, 1))
+        loop.unwatch(read)
+
+    loop.watch(read, 1, readable)
+    os.write(write, 'x')
+
+    def stop():
+        calls.append('stop')
+        loop.stop()
+
+    thread = threading.Timer(0.05, loop.call_soon_threadsafe, (stop,))
+    thread.start()
+    loop.run()
+    loop.close()
+
+    assert calls == ['x', 'soon', 'sooner', 'later', 'stop']
+
+
+def test_evented_relay():
+    cluster = create_cluster()
+    server = FakeServer()
+
+    connections = []
+
+    def connect(dsn):
+        connections.append(dsn)
+        return server.connect_async(dsn)
+
+    handlers = {}
+    for name in ('a', 'b'):
+        server.create_queue(
+            cluster.get_queue_name(name),
+            source=[list(generate_events(5)) for _ in xrange(10)],
+        )
+        create_set(cluster, name, 'fake://%s' % (name,))
+        handlers[name] = RecordingHandler()
+
+    relay = EventedRelay(cluster, ['a', 'b'], 'consumer', handlers, idle_interval=0.01, connect=connect)
+    relay.start()
+
+    for handler in handlers.values():
+        assert handler.wait(10, timeout=5)
+        assert handler.mutations == 50
+
+        batches = list(batched(states.validate(sequences.validate(handler.recorded))))
+        assert len(batches) == 10
+
+    assert sorted(connections) == ['fake://a', 'fake://b']
+
+    # Changing the database of a set restarts its task.
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = 'fake://c'
+    cluster.zookeeper.set(cluster.get_set_path('a'), BinaryCodec(ReplicationSetConfiguration).encode(configuration))
+
+    deadline = time.time() + 5
+    while len(connections) < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    assert connections[-1] == 'fake://c'
+
+    relay.stop_async()
+    relay.result(1)
@@ -0,0 +1,96 @@
+import time
+
+from pgshovel.interfaces.configurations_pb2 import (
+    ColumnPredicate,
+    ReplicationSetConfiguration,
+    TableFilterConfiguration,
+)
+from pgshovel.interfaces.streams_pb2 import MutationOperation
+from pgshovel.relay.filters import compile_filters
+from pgshovel.relay.relay import to_mutation
+from pgshovel.testing import to_event_payload
+from pgshovel.utilities.conversions import row_converter
+
+
+def create_configuration():
+    configuration = ReplicationSetConfiguration()
+    configuration.tables.add(schema='public', name='unfiltered', primary_keys=['id'])
+
+    table = configuration.tables.add(schema='public', name='user', primary_keys=['id'])
+    table.filter.operations.extend([TableFilterConfiguration.INSERT, TableFilterConfiguration.UPDATE])
+    table.filter.predicates.add(column='status', operator=ColumnPredicate.NOT_IN).values.add(string=u'deleted')
+    predicate = table.filter.predicates.add(column='region')
+    predicate.values.add(string=u'us')
+    predicate.values.add()  # NULL
+    table.filter.columns.extend(['name'])
+
+    return configuration
+
+
+def test_compile_filters():
+    assert compile_filters(ReplicationSetConfiguration()) is None
+
+    filters = compile_filters(create_configuration())
+    assert filters.keys() == [('public', 'user')]
+
+    apply = filters[('public', 'user')]
+    row = {'id': 1, 'name': 'example', 'status': 'active', 'region': 'us', 'email': 'example@example.com'}
+    projected = {'id': 1, 'name': 'example'}
+
+    assert apply('INSERT', None, row) == ('INSERT', None, projected)
+    assert apply('UPDATE', row, row) == ('UPDATE', projected, projected)
+    assert apply('INSERT', None, dict(row, region=None)) == ('INSERT', None, projected)
+
+    # Filtered operations and rows are not published.
+    assert apply('DELETE', row, None) is None
+    assert apply('INSERT', None, dict(row, region='eu')) is None
+    assert apply('INSERT', None, dict(row, status='deleted')) is None
+
+    # Predicates are evaluated against both states of updated rows. Rows
+    # that enter the filtered subset are inserted, and rows that leave it are
+    # deleted (unless deletes are filtered.)
+    assert apply('UPDATE', dict(row, status='deleted'), row) == ('INSERT', None, projected)
+    assert apply('UPDATE', row, dict(row, status='deleted')) is None
+    assert apply('UPDATE', dict(row, status='deleted'), dict(row, region='eu')) is None
+
+
+def test_updates_leaving_filter():
+    configuration = ReplicationSetConfiguration()
+    table = configuration.tables.add(schema='public', name='user', primary_keys=['id'])
+    table.filter.predicates.add(column='region').values.add(string=u'us')
+    filters = compile_filters(configuration)
+
+    def to_row(*args, **kwargs):
+        return (1, to_event_payload(*args, **kwargs), time.time(), 1)
+
+    row = {'id': 1, 'region': 'us'}
+
+    mutation = to_mutation(to_row('public', 'user', 'UPDATE', ['id'], old=row, new=dict(row, region='eu')), filters)
+    assert mutation.operation == MutationOperation.DELETE
+    assert row_converter.to_python(mutation.old) == row
+    assert not mutation.HasField('new')
+
+    mutation = to_mutation(to_row('public', 'user', 'UPDATE', ['id'], old=dict(row, region='eu'), new=row), filters)
+    assert mutation.operation == MutationOperation.INSERT
+    assert row_converter.to_python(mutation.new) == row
+    assert not mutation.HasField('old')
+
+    mutation = to_mutation(to_row('public', 'user', 'UPDATE', ['id'], old=row, new=row), filters)
+    assert mutation.operation == MutationOperation.UPDATE
+
+
+def test_filtered_mutations():
+    filters = compile_filters(create_configuration())
+
+    def to_row(*args, **kwargs):
+        return (1, to_event_payload(*args, **kwargs), time.time(), 1)
+
+    row = {'id': 1, 'name': 'example', 'status': 'active', 'region': 'us', 'email': 'example@example.com'}
+
+    mutation = to_mutation(to_row('public', 'user', 'INSERT', ['id'], new=row), filters)
+    assert sorted(column.name for column in mutation.new.columns) == ['id', 'name']
+
+    assert to_mutation(to_row('public', 'user', 'DELETE', ['id'], old=row), filters) is None
+
+    mutation = to_mutation(to_row('public', 'unfiltered', 'DELETE', ['id'], old=row), filters)
+    assert len(mutation.old.columns) == len(row)
@@ -0,0 +1,97 @@
+import os
+import time
+
+from click.testing import CliRunner
+
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.relay.entrypoint import construct_handler
+from pgshovel.relay.evented import EventedRelay
+from pgshovel.relay.handlers.archive import (
+    ArchiveWriter,
+    main,
+)
+from pgshovel.streams.archives import (
+    SegmentWriter,
+    read_archive,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.testing import (
+    FakeServer,
+    generate_events,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    make_batch_messages,
+    mutation,
+)
+from tests.pgshovel.testing import (
+    create_cluster,
+    create_set,
+)
+
+
+def test_handler(tmpdir):
+    directory = str(tmpdir)
+    writer = ArchiveWriter(SegmentWriter(directory, fsync=False))
+
+    messages = list(make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'commit_operation': commit},
+    ]))
+    for message in messages:
+        writer.push((message,))
+    writer.close()
+
+    assert map(BinaryCodec(Message).decode, read_archive(directory)) == messages
+
+
+def test_multiple_sets(tmpdir):
+    # Several sets cannot share an archive directory.
+    directory = str(tmpdir.join('shared'))
+    result = CliRunner().invoke(main, ['--engine', 'evented', '--directory', directory, 'a', 'b'])
+    assert result.exit_code == 2
+    assert '{set}' in result.output
+    assert not os.path.exists(directory)
+
+    # Each set is archived to its own directory when the path contains the
+    # set name.
+    cluster = create_cluster()
+    server = FakeServer()
+
+    handlers = {}
+    for name in ('a', 'b'):
+        server.create_queue(
+            cluster.get_queue_name(name),
+            source=[list(generate_events(5)) for _ in xrange(3)],
+        )
+        create_set(cluster, name, 'fake://%s' % (name,))
+        handlers[name] = construct_handler(cluster, name, ['archive', '--no-fsync', '--directory', str(tmpdir.join('{set}'))])
+
+    relay = EventedRelay(cluster, ['a', 'b'], 'consumer', handlers, idle_interval=0.01, connect=server.connect_async)
+    relay.start()
+
+    def consumed(name):
+        queue = server.queues[cluster.get_queue_name(name)]
+        return 'consumer' in queue.consumers and queue.consumers['consumer'].tick == 4
+
+    deadline = time.time() + 5
+    while not all(map(consumed, ('a', 'b'))) and time.time() < deadline:
+        relay.join(0.01)
+
+    relay.stop_async()
+    relay.result(1)
+
+    for name in ('a', 'b'):
+        handlers[name].close()
+        messages = map(BinaryCodec(Message).decode, read_archive(str(tmpdir.join(name))))
+        batches = [list(mutations) for batch, mutations in batched(states.validate(sequences.validate(messages)))]
+        assert map(len, batches) == [5, 5, 5]
+
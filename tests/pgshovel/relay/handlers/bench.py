@@ -0,0 +1,34 @@
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.relay.handlers.bench import (
+    BenchmarkWriter,
+    SizeDistribution,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+from tests.pgshovel.streams.fixtures import transaction
+
+
+def test_size_distribution():
+    sizes = SizeDistribution()
+    for size in xrange(1, 101):
+        sizes.add(size)
+
+    assert sizes.count == 100
+    assert sizes.maximum == 100
+    assert sizes.percentile(50) == 63
+    assert sizes.percentile(100) == 100
+
+
+def test_handler():
+    codec = BinaryCodec(Message)
+    writer = BenchmarkWriter(codec)
+
+    messages = list(transaction)
+    for message in messages:
+        writer.push((message,))
+
+    assert writer.messages == 3
+    assert writer.batches == 1
+    assert writer.sizes.total == sum(len(codec.encode(message)) for message in messages)
+    assert writer.idle_time == 0
+
+    writer.report()
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from pgshovel.cluster import Cluster
+from pgshovel.relay.handlers.fanout import FanoutWriter
+from pgshovel.relay.handlers.stream import StreamWriter
+from pgshovel.relay.entrypoint import construct_handler
+from pgshovel.testing import FakeZooKeeper
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    make_batch_messages,
+    mutation,
+)
+
+
+def get_messages():
+    return list(make_batch_messages(batch_identifier, (
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'commit_operation': commit},
+    )))
+
+
+class BlockingHandler(object):
+    def __init__(self, wait=None, error=None):
+        self.wait = wait
+        self.error = error
+        self.received = threading.Event()
+        self.messages = []
+
+    def push(self, messages):
+        self.received.set()
+        if self.wait is not None:
+            assert self.wait.received.wait(1)
+        self.messages.extend(messages)
+        if self.error is not None:
+            raise self.error
+
+
+def test_handler():
+    # Each handler waits for the other to receive the messages, which can only
+    # happen if they are pushed to concurrently.
+    a = BlockingHandler()
+    b = BlockingHandler(wait=a)
+    a.wait = b
+
+    writer = FanoutWriter([a, b])
+
+    messages = get_messages()
+    writer.push(iter(messages))
+    assert a.messages == b.messages == messages
+
+
+def test_handler_failure():
+    a = BlockingHandler(error=NotImplementedError())
+    b = BlockingHandler(wait=a)
+
+    writer = FanoutWriter([a, b])
+    with pytest.raises(NotImplementedError):
+        writer.push(get_messages())
+
+    # The error is raised after all handlers have accepted the messages.
+    assert len(b.messages) == 3
+
+
+def test_construct_handler(tmpdir):
+    cluster = Cluster('test', FakeZooKeeper())
+    path, other = str(tmpdir.join('stream')), str(tmpdir.join('other'))
+
+    handler = construct_handler(cluster, 'example', ['stream', '--stream', path])
+    assert isinstance(handler, StreamWriter)
+    assert handler.stream.name == path
+
+    handler = construct_handler(cluster, 'example', ['fanout', '--handler', 'stream --stream %s' % (path,), '--handler', 'stream --stream %s' % (other,)])
+    assert isinstance(handler, FanoutWriter)
+    assert [h.stream.name for h in handler.handlers] == [path, other]
@@ -4,10 +4,27 @@ import operator
 import uuid
 
 from pgshovel.interfaces.streams_pb2 import Message
-from pgshovel.relay.handlers.kafka import KafkaWriter
+from pgshovel.relay.handlers.kafka import (
+    KafkaWriter,
+    TableRouter,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
 from pgshovel.utilities import import_extras
 from pgshovel.utilities.protobuf import BinaryCodec
-from tests.pgshovel.streams.fixtures import transaction
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    copy,
+    make_batch_messages,
+    mutation,
+    rollback,
+    transaction,
+)
 
 with import_extras('kafka'):
     from kafka.client import KafkaClient
@@ -38,3 +55,43 @@ def test_handler():
     )
 
     assert outputs == inputs
+
+
+def test_table_router():
+    router = TableRouter('{schema}.{table}')
+
+    messages = list(make_batch_messages(batch_identifier, (
+        {'begin_operation': begin},
+        {'mutation_operation': copy(mutation, table='users')},
+        {'mutation_operation': copy(mutation, id=2, table='groups')},
+        {'mutation_operation': copy(mutation, id=3, table='users')},
+        {'commit_operation': commit},
+    )))
+    messages.extend(make_batch_messages(copy(batch_identifier, id=2), (
+        {'begin_operation': begin},
+        {'mutation_operation': copy(mutation, id=4, table='groups')},
+        {'rollback_operation': rollback},
+    )))
+    for sequence, message in enumerate(messages):
+        message.header.sequence = sequence
+
+    topics = {}
+    for message in messages:
+        for topic, routed in router.route([message]):
+            topics.setdefault(topic, []).extend(routed)
+
+    assert sorted(topics) == ['public.groups', 'public.users']
+
+    # Each topic is a valid stream, only containing its own mutations.
+    users = [(batch.id, [m.id for m in mutations]) for batch, mutations in batched(states.validate(sequences.validate(topics['public.users'])))]
+    assert users == [(1, [1, 3])]
+
+    groups = list(states.validate(sequences.validate(topics['public.groups'])))
+    assert [event.batch_operation.WhichOneof('operation') for state, event in groups] == [
+        'begin_operation',
+        'mutation_operation',
+        'commit_operation',
+        'begin_operation',
+        'mutation_operation',
+        'rollback_operation',
+    ]
@@ -0,0 +1,95 @@
+import pytest
+from kazoo.exceptions import NoNodeError
+
+from pgshovel.interfaces.common_pb2 import BatchIdentifier
+from pgshovel.relay.ledger import Ledger
+from pgshovel.relay.relay import Worker
+from pgshovel.testing import (
+    CountingHandler,
+    FakeServer,
+    generate_events,
+)
+from tests.pgshovel.testing import create_cluster
+
+
+def test_ledger():
+    cluster = create_cluster()
+    server = FakeServer()
+
+    ledger = Ledger(cluster, 'example', 'consumer')
+    assert ledger.get(server.id.bytes) is None
+
+    batch = BatchIdentifier(id=1, node=server.id.bytes)
+    ledger.record(batch)
+    assert ledger.get(server.id.bytes) == batch
+    assert ledger.is_published(batch)
+    assert not ledger.is_published(BatchIdentifier(id=2, node=server.id.bytes))
+
+    ledger.record(BatchIdentifier(id=2, node=server.id.bytes))
+    assert ledger.get(server.id.bytes).id == 2
+
+    # Ledgers are separate for each consumer.
+    assert Ledger(cluster, 'example', 'other').get(server.id.bytes) is None
+
+
+def test_worker_skips_published_batches():
+    cluster = create_cluster()
+
+    server = FakeServer()
+    queue = server.create_queue(
+        cluster.get_queue_name('example'),
+        source=[generate_events(3), generate_events(2)],
+    )
+
+    # Simulate a relay that exited after publishing the first batch, but
+    # before the batch was finished.
+    ledger = Ledger(cluster, 'example', 'consumer')
+    ledger.record(BatchIdentifier(id=1, node=server.id.bytes))
+
+    handler = CountingHandler()
+    worker = Worker(cluster, 'fake://', 'example', 'consumer', handler, server.get_database, ledger=ledger)
+    worker.start()
+
+    assert handler.wait(1, timeout=5)
+
+    worker.stop_async()
+    worker.result(1)
+
+    assert handler.commits == 1
+    assert handler.mutations == 2
+    assert ledger.get(server.id.bytes).id == 2
+
+    (consumer,) = queue.consumers.values()
+    assert consumer.batch is None and consumer.tick == queue.ticks[-1].id
+
+
+def test_ledger_reads_once():
+    cluster = create_cluster()
+    server = FakeServer()
+
+    ledger = Ledger(cluster, 'example', 'consumer')
+    assert ledger.load(server.id.bytes) is None
+
+    batch = BatchIdentifier(id=1, node=server.id.bytes)
+    ledger.record(batch)
+    ledger.record(BatchIdentifier(id=2, node=server.id.bytes))
+
+    # Duplicates are checked against the batch in memory, rather than by
+    # reading the ledger from ZooKeeper again.
+    get = cluster.zookeeper.get
+    cluster.zookeeper.get = None
+    try:
+        assert not ledger.is_published(batch)
+        assert ledger.is_published(BatchIdentifier(id=2, node=server.id.bytes))
+    finally:
+        cluster.zookeeper.get = get
+
+    assert ledger.get(server.id.bytes).id == 2
+
+    # Errors from writes are raised when the next batch is recorded, and the
+    # ledger is read again afterwards.
+    cluster.zookeeper.delete(ledger.get_path(server.id.bytes))
+    ledger.record(BatchIdentifier(id=3, node=server.id.bytes))
+    with pytest.raises(NoNodeError):
+        ledger.record(BatchIdentifier(id=4, node=server.id.bytes))
+    assert not ledger.is_published(BatchIdentifier(id=3, node=server.id.bytes))
@@ -0,0 +1,135 @@
+import pytest
+
+from pgshovel.interfaces.streams_pb2 import MutationOperation
+from pgshovel.relay.pipeline import (
+    ColumnFilter,
+    Metrics,
+    Sample,
+    TableFilter,
+    build,
+    parse_stage,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.streams.publisher import Publisher
+from pgshovel.utilities.conversions import row_converter
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+)
+
+
+class RecordingHandler(object):
+    def __init__(self):
+        self.chunks = []
+
+    @property
+    def messages(self):
+        return [message for chunk in self.chunks for message in chunk]
+
+    def push(self, messages):
+        self.chunks.append(list(messages))
+
+
+def create_mutation(id, table='users', **row):
+    return MutationOperation(
+        id=id,
+        schema='public',
+        table=table,
+        operation=MutationOperation.INSERT,
+        identity_columns=['id'],
+        new=row_converter.to_protobuf(dict(row, id=id)),
+        timestamp=begin.end.timestamp,
+        transaction=1,
+    )
+
+
+def publish(handler, mutations, chunk_size=1000):
+    publisher = Publisher(handler.push, chunk_size)
+    with publisher.batch(batch_identifier, begin) as publish:
+        for mutation in mutations:
+            publish(mutation)
+
+
+def get_mutations(messages):
+    (mutations,) = [list(mutations) for batch, mutations in batched(states.validate(sequences.validate(messages)))]
+    return mutations
+
+
+def test_table_filter():
+    handler = RecordingHandler()
+    stage = TableFilter(handler, ['users', 'public.auth_*'])
+
+    tables = ['users', 'groups', 'auth_user', 'users', 'auth_group'] * 2
+    publish(stage, [create_mutation(i, table) for i, table in enumerate(tables)], chunk_size=2)
+
+    # The stream is resequenced, and remains valid.
+    assert [mutation.table for mutation in get_mutations(handler.messages)] == ['users', 'auth_user', 'users', 'auth_group'] * 2
+
+
+def test_column_filter():
+    handler = RecordingHandler()
+    stage = ColumnFilter(handler, ['id', 'password'])
+
+    mutations = [
+        create_mutation(1, username='ted', password='secret'),
+        create_mutation(2, username='bob'),
+    ]
+    publish(stage, mutations)
+
+    result = get_mutations(handler.messages)
+    assert [row_converter.to_python(mutation.new) for mutation in result] == [
+        {'id': 1, 'username': 'ted'},
+        {'id': 2, 'username': 'bob'},
+    ]
+
+    # The published mutations are not modified.
+    assert len(mutations[0].new.columns) == 3
+
+
+def test_sample():
+    handler = RecordingHandler()
+    stage = Sample(handler, 0.25)
+
+    publish(stage, [create_mutation(i) for i in xrange(1000)])
+    selected = set(mutation.id for mutation in get_mutations(handler.messages))
+    assert 150 < len(selected) < 350
+
+    # The same rows are selected for subsequent mutations.
+    handler.chunks = []
+    publish(stage, [create_mutation(i, username='updated') for i in xrange(1000)])
+    assert set(mutation.id for mutation in get_mutations(handler.messages)) == selected
+
+
+def test_metrics():
+    handler = RecordingHandler()
+    stage = Metrics(handler, interval=0)
+
+    publish(stage, [create_mutation(i, table) for i, table in enumerate(['users', 'groups', 'users'])])
+    assert stage.counts == {
+        ('public', 'users', MutationOperation.INSERT): 2,
+        ('public', 'groups', MutationOperation.INSERT): 1,
+    }
+    assert len(get_mutations(handler.messages)) == 3
+
+
+def test_build():
+    handler = RecordingHandler()
+    stage = build(map(parse_stage, ['tables:users', 'exclude-columns:password', 'metrics']), handler)
+
+    assert isinstance(stage, TableFilter)
+    assert isinstance(stage.handler, ColumnFilter)
+    assert isinstance(stage.handler.handler, Metrics)
+    assert stage.handler.handler.handler is handler
+
+    publish(stage, [create_mutation(1, password='secret'), create_mutation(2, 'groups')], chunk_size=2)
+    (mutation,) = get_mutations(handler.messages)
+    assert row_converter.to_python(mutation.new) == {'id': 1}
+    assert stage.handler.handler.counts.values() == [1]
+
+    for specification in ('unknown', 'sample:2', 'sample:half', 'metrics:x'):
+        with pytest.raises(ValueError):
+            parse_stage(specification)
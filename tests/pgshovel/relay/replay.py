@@ -0,0 +1,100 @@
+import os
+
+from click.testing import CliRunner
+
+from pgshovel.cli import main
+from pgshovel.relay.replay import Replayer
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.archives import (
+    ArchiveReader,
+    SegmentWriter,
+)
+from pgshovel.streams.batches import batched
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    copy,
+    make_batch_messages,
+    mutation,
+)
+
+
+class ListHandler(object):
+    def __init__(self):
+        self.pushes = []
+
+    def push(self, messages):
+        self.pushes.append(list(messages))
+
+    @property
+    def messages(self):
+        return [message for messages in self.pushes for message in messages]
+
+
+def create_archive(directory, batches=5):
+    messages = []
+    for id in xrange(1, batches + 1):
+        messages.extend(make_batch_messages(copy(batch_identifier, id=id), [
+            {'begin_operation': begin},
+            {'mutation_operation': copy(mutation, id=id)},
+            {'commit_operation': commit},
+        ]))
+
+    for sequence, message in enumerate(messages):
+        message.header.sequence = sequence
+
+    writer = SegmentWriter(directory, max_size=1, fsync=False)
+    for message in messages:
+        writer.write(message)
+    writer.close()
+
+    return messages
+
+
+def get_batch_ids(messages):
+    batches = batched(states.validate(sequences.validate(messages)))
+    return [identifier.id for identifier, mutations in batches]
+
+
+def test_replay(tmpdir):
+    directory = str(tmpdir)
+    messages = create_archive(directory)
+
+    handler = ListHandler()
+    replayer = Replayer(ArchiveReader(directory), handler, batch_size=4, workers=2)
+    assert replayer.run() == len(messages)
+
+    assert [len(pushed) for pushed in handler.pushes] == [4, 4, 4, 3]
+    assert handler.messages == messages
+    assert get_batch_ids(handler.messages) == [1, 2, 3, 4, 5]
+
+
+def test_replay_from_position(tmpdir):
+    directory = str(tmpdir)
+    messages = create_archive(directory)
+
+    reader = ArchiveReader(directory)
+    handler = ListHandler()
+    Replayer(reader, handler, reader.seek_batch(3)).run()
+
+    # The remainder of the stream is renumbered so that it can be validated.
+    assert len(handler.messages) == 9
+    assert handler.messages[0].header.publisher != messages[0].header.publisher
+    assert get_batch_ids(handler.messages) == [3, 4, 5]
+
+
+def test_command(tmpdir):
+    directory = str(tmpdir.mkdir('archive'))
+    create_archive(directory)
+    output = os.path.join(str(tmpdir), 'output')
+
+    result = CliRunner().invoke(main, ['replay', '--batch-id', '4', directory, 'stream', '--stream', output, 'example'])
+    assert result.exit_code == 0, result.output
+    assert 'Replayed 6 messages' in result.output
+
+    with open(output) as f:
+        assert f.read().count('commit_operation') == 2
@@ -0,0 +1,178 @@
+import os
+import uuid
+
+import pytest
+
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.archives import (
+    PARTIAL_SUFFIX,
+    ArchiveReader,
+    SegmentWriter,
+    list_segments,
+    read_archive,
+    read_segment,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.utilities.protobuf import (
+    BinaryCodec,
+    encode_varint,
+)
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    copy,
+    make_batch_messages,
+    mutation,
+)
+
+
+codec = BinaryCodec(Message)
+
+
+def make_messages(batches=3):
+    messages = []
+    for id in xrange(1, batches + 1):
+        # Each batch ends 10 seconds after the previous batch.
+        operation = copy(begin)
+        operation.start.id, operation.end.id = id, id + 1
+        operation.end.timestamp.seconds = id * 10
+
+        messages.extend(make_batch_messages(copy(batch_identifier, id=id), [
+            {'begin_operation': operation},
+            {'mutation_operation': copy(mutation, id=id)},
+            {'commit_operation': commit},
+        ]))
+
+    for sequence, message in enumerate(messages):
+        message.header.sequence = sequence
+
+    return messages
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'bz2'])
+def test_archive(tmpdir, compression):
+    directory = str(tmpdir)
+    messages = make_messages()
+
+    # Rotate after every batch.
+    writer = SegmentWriter(directory, max_size=1, compression=compression, fsync=False)
+    for message in messages:
+        writer.write(message)
+    writer.close()
+
+    assert len(list_segments(directory)) == 3
+
+    received = map(codec.decode, read_archive(directory))
+    assert received == messages
+
+    batches = list(batched(states.validate(sequences.validate(received))))
+    assert [identifier.id for identifier, mutations in batches] == [1, 2, 3]
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'bz2'])
+def test_flush_at_batch_end(tmpdir, compression):
+    directory = str(tmpdir)
+    messages = make_messages(2)
+
+    writer = SegmentWriter(directory, compression=compression, fsync=False)
+    for message in messages[:4]:
+        writer.write(message)
+
+    # Only complete batches are guaranteed to be written to the segment.
+    (name,) = [name for name in os.listdir(directory) if name.endswith(PARTIAL_SUFFIX)]
+    received = map(codec.decode, read_segment(os.path.join(directory, name)))
+    assert received == messages[:3]
+
+
+def test_recovery(tmpdir):
+    directory = str(tmpdir)
+    messages = make_messages(2)
+
+    writer = SegmentWriter(directory, fsync=False)
+    for message in messages[:3]:
+        writer.write(message)
+
+    # Simulate a crash that occurred while writing the next message.
+    (name,) = [name for name in os.listdir(directory) if name.endswith(PARTIAL_SUFFIX)]
+    with open(os.path.join(directory, name), 'ab') as f:
+        payload = codec.encode(messages[3])
+        f.write(encode_varint(len(payload)) + payload[:5])
+
+    writer = SegmentWriter(directory, fsync=False)
+    for message in messages[3:]:
+        writer.write(message)
+    writer.close()
+
+    assert len(list_segments(directory)) == 2
+    assert map(codec.decode, read_archive(directory)) == messages
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'bz2'])
+def test_seek(tmpdir, compression):
+    directory = str(tmpdir)
+    messages = make_messages(6)
+
+    # Rotate after every other batch.
+    writer = SegmentWriter(directory, max_size=len(codec.encode(messages[0])) * 4, compression=compression, fsync=False)
+    for message in messages:
+        writer.write(message)
+    writer.close()
+
+    assert len(list_segments(directory)) == 3
+
+    reader = ArchiveReader(directory)
+
+    def read_batches(position):
+        received = map(codec.decode, reader.read(position))
+        return [message.batch_operation.batch_identifier.id for message in received[::3]]
+
+    # Batches within a segment.
+    assert read_batches(reader.seek_batch(4)) == [4, 5, 6]
+    assert read_batches(reader.seek_time(30)) == [3, 4, 5, 6]
+    assert read_batches(reader.seek_time(25)) == [3, 4, 5, 6]
+
+    # Batches at the start of a segment.
+    assert read_batches(reader.seek_batch(5)) == [5, 6]
+    assert read_batches(reader.seek_time(0)) == [1, 2, 3, 4, 5, 6]
+
+    # Batches that do not exist.
+    assert reader.seek_batch(7) is None
+    assert reader.seek_batch(1, node='invalid') is None
+    assert reader.seek_time(61) is None
+
+
+def test_seek_node_change(tmpdir):
+    directory = str(tmpdir)
+    messages = make_messages(6)
+
+    # Simulate a failover to another node after the third batch, where batch
+    # identifiers start again from the first batch.
+    node = uuid.uuid1().bytes
+    for message in messages[9:]:
+        identifier = message.batch_operation.batch_identifier
+        identifier.node, identifier.id = node, identifier.id - 3
+
+    writer = SegmentWriter(directory, fsync=False)
+    for message in messages:
+        writer.write(message)
+    writer.close()
+
+    # Segments are rotated when the node changes.
+    assert len(list_segments(directory)) == 2
+
+    reader = ArchiveReader(directory)
+
+    def read_batches(position):
+        received = map(codec.decode, reader.read(position))
+        return [(message.batch_operation.batch_identifier.node, message.batch_operation.batch_identifier.id) for message in received[::3]]
+
+    original = batch_identifier.node
+    assert read_batches(reader.seek_batch(2, node=node)) == [(node, 2), (node, 3)]
+    assert read_batches(reader.seek_batch(3, node=original)) == [(original, 3), (node, 1), (node, 2), (node, 3)]
+    assert read_batches(reader.seek_batch(3)) == [(original, 3), (node, 1), (node, 2), (node, 3)]
+    assert reader.seek_batch(4, node=node) is None
@@ -0,0 +1,129 @@
+import os
+import uuid
+
+import pytest
+
+from pgshovel.interfaces.common_pb2 import BatchIdentifier
+from pgshovel.interfaces.streams_pb2 import Checkpoint
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.streams.checkpoints import (
+    FileCheckpointStore,
+    SQLiteCheckpointStore,
+    get_state,
+    to_checkpoint,
+)
+from pgshovel.streams.sequences import (
+    InvalidSequenceStartError,
+    SequencingError,
+)
+from pgshovel.streams.validation import validated_batches
+from tests.pgshovel.streams.fixtures import (
+    begin,
+    commit,
+    copy,
+    make_batch_messages,
+    mutation,
+)
+
+
+node = uuid.uuid1().bytes
+publisher = uuid.uuid1().bytes
+
+
+def make_messages():
+    messages = []
+    for id in (1, 2):
+        messages.extend(make_batch_messages(BatchIdentifier(id=id, node=node), [
+            {'begin_operation': begin},
+            {'mutation_operation': copy(mutation, id=id)},
+            {'commit_operation': commit},
+        ], publisher=publisher))
+
+    for sequence, message in enumerate(messages):
+        message.header.sequence = sequence
+
+    return messages
+
+
+def chained(messages, checkpoint):
+    messages = sequences.validate(messages, checkpoint=checkpoint)
+    return batched(states.validate(messages, start=get_state(checkpoint)))
+
+
+def consume(batches):
+    return [(batch_identifier.id, [operation.id for operation in mutations]) for batch_identifier, mutations in batches]
+
+
+@pytest.yield_fixture(params=['file', 'sqlite'])
+def store(request, tmpdir):
+    if request.param == 'file':
+        yield FileCheckpointStore(os.path.join(str(tmpdir), 'checkpoint'))
+    else:
+        yield SQLiteCheckpointStore(os.path.join(str(tmpdir), 'checkpoints.db'))
+
+
+def test_store(store):
+    assert store.get() is None
+
+    checkpoint = Checkpoint(
+        publisher=publisher,
+        sequence=2,
+        state=Checkpoint.COMMITTED,
+        batch_identifier=BatchIdentifier(id=1, node=node),
+    )
+    store.set(checkpoint)
+    assert store.get() == checkpoint
+
+    checkpoint.sequence = 5
+    store.set(checkpoint)
+    assert store.get() == checkpoint
+
+
+def test_resume():
+    messages = make_messages()
+
+    # Record a checkpoint after the first batch is committed.
+    results = list(states.validate(sequences.validate(messages)))
+    state, message = results[2]
+    assert isinstance(state, states.Committed)
+    checkpoint = to_checkpoint(state, message)
+    assert get_state(checkpoint) == state
+
+    # Resuming from the start of the stream should skip the first batch.
+    for pipeline in (chained, validated_batches):
+        assert consume(pipeline(messages, checkpoint)) == [(2, [2])]
+
+    # Resuming from the checkpoint position should also be possible.
+    for pipeline in (chained, validated_batches):
+        assert consume(pipeline(messages[3:], checkpoint)) == [(2, [2])]
+
+
+def test_resume_sequence_gap():
+    messages = make_messages()
+    checkpoint = to_checkpoint(*list(states.validate(sequences.validate(messages)))[1])
+
+    for pipeline in (chained, validated_batches):
+        with pytest.raises(SequencingError):
+            consume(pipeline(messages[3:], checkpoint))
+
+
+def test_resume_publisher_changed():
+    messages = make_messages()
+    checkpoint = to_checkpoint(*list(states.validate(sequences.validate(messages)))[2])
+
+    restarted = list(make_batch_messages(BatchIdentifier(id=2, node=node), [
+        {'begin_operation': begin},
+        {'mutation_operation': copy(mutation, id=2)},
+        {'commit_operation': commit},
+    ]))
+    for pipeline in (chained, validated_batches):
+        assert consume(pipeline(restarted, checkpoint)) == [(2, [2])]
+
+    # A new publisher must start from the beginning of it's sequence.
+    for pipeline in (chained, validated_batches):
+        with pytest.raises(InvalidSequenceStartError):
+            consume(pipeline(restarted[1:], checkpoint))
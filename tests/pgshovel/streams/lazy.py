@@ -0,0 +1,61 @@
+from pgshovel.interfaces.streams_pb2 import Message
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.streams.lazy import LazyMessage
+from pgshovel.streams.validation import validated_batches
+from pgshovel.utilities.protobuf import BinaryCodec
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    make_batch_messages,
+    mutation,
+)
+
+
+def make_payloads():
+    messages = make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'mutation_operation': mutation},
+        {'commit_operation': commit},
+    ])
+    return map(BinaryCodec(Message).encode, messages)
+
+
+def test_lazy_message():
+    payload = make_payloads()[1]
+    message = BinaryCodec(LazyMessage).decode(payload)
+
+    assert message.header == Message.FromString(payload).header
+    assert message.WhichOneof('operation') == 'batch_operation'
+    assert message.batch_operation.batch_identifier == batch_identifier
+    assert message.batch_operation.WhichOneof('operation') == 'mutation_operation'
+    assert message.decode() == Message.FromString(payload)
+    assert BinaryCodec(LazyMessage).encode(message) == payload
+
+    operation = message.batch_operation.mutation_operation
+    assert operation.table == mutation.table
+    assert not operation.HasField('old')
+    assert operation.new == mutation.new
+    assert operation == mutation
+
+
+def test_validation():
+    decode = BinaryCodec(LazyMessage).decode
+
+    for pipeline in (lambda messages: batched(states.validate(sequences.validate(messages))), validated_batches):
+        payloads = make_payloads()
+        payloads.insert(2, payloads[1])  # duplicate
+
+        ((received_batch_identifier, mutations),) = list(
+            (received_batch_identifier, list(mutations))
+            for received_batch_identifier, mutations
+            in pipeline(map(decode, payloads))
+        )
+
+        assert received_batch_identifier == batch_identifier
+        assert [operation.decode() for operation in mutations] == [mutation] * 2
@@ -64,3 +64,28 @@ def test_publisher_failure():
     publisher.publish()
     assert len(messages) == 3
     assert messages[2].header.sequence == 2
+
+
+def test_publisher_chunks():
+    chunks = []
+    publisher = Publisher(chunks.append, chunk_size=2)
+
+    with publisher.batch(batch_identifier, begin) as publish:
+        for _ in xrange(4):
+            publish(mutation)
+
+    assert map(len, chunks) == [2, 2, 2]
+
+    published_messages = map(reserialize, sum(map(list, chunks), []))
+    assert list(states.validate(published_messages))
+    assert list(sequences.validate(published_messages))
+
+    # The rollback is provided along with any buffered messages.
+    del chunks[:]
+    with pytest.raises(NotImplementedError):
+        with publisher.batch(batch_identifier, begin):
+            raise NotImplementedError
+
+    assert map(len, chunks) == [2]
+    assert get_operation(get_operation(chunks[0][1])) == rollback
+
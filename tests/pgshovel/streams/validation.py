@@ -0,0 +1,164 @@
+import itertools
+import uuid
+
+import pytest
+
+from pgshovel.interfaces.common_pb2 import BatchIdentifier
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import (
+    TransactionAborted,
+    TransactionCancelled,
+    batched,
+)
+from pgshovel.streams.sequences import (
+    RepeatedSequenceError,
+    SequencingError,
+)
+from pgshovel.streams.states import (
+    InvalidBatch,
+    InvalidEventError,
+)
+from pgshovel.streams.validation import validated_batches
+from tests.pgshovel.streams.fixtures import (
+    batch_identifier,
+    begin,
+    commit,
+    copy,
+    make_batch_messages,
+    mutation,
+    reserialize,
+    rollback,
+)
+
+
+def consume(batches):
+    """
+    Collects the contents of a batch stream, recording the outcome of each
+    batch rather than raising.
+    """
+    results = []
+    for received_batch_identifier, mutations in batches:
+        received = []
+        try:
+            for operation in mutations:
+                received.append(operation)
+        except (TransactionAborted, TransactionCancelled) as error:
+            outcome = type(error)
+        else:
+            outcome = None
+        results.append((received_batch_identifier, received, outcome))
+    return results
+
+
+def test_matches_chained_pipeline():
+    node = uuid.uuid1().bytes
+    first = BatchIdentifier(id=1, node=node)
+    second = BatchIdentifier(id=2, node=node)
+
+    def make_messages():
+        publisher = uuid.uuid1().bytes
+        aborted = make_batch_messages(first, [
+            {'begin_operation': begin},
+            {'mutation_operation': mutation},
+        ], publisher=uuid.uuid1().bytes)
+        retried = make_batch_messages(first, [
+            {'begin_operation': begin},
+            {'mutation_operation': copy(mutation, id=2)},
+            {'rollback_operation': rollback},
+            {'begin_operation': begin},
+            {'mutation_operation': copy(mutation, id=3)},
+            {'mutation_operation': copy(mutation, id=4)},
+            {'commit_operation': commit},
+        ], publisher=publisher)
+        advanced = list(make_batch_messages(second, [
+            {'begin_operation': begin},
+            {'mutation_operation': copy(mutation, id=5)},
+            {'commit_operation': commit},
+        ], publisher=publisher))
+        for i, message in enumerate(advanced):
+            message.header.sequence = 7 + i
+
+        return itertools.chain(aborted, retried, advanced)
+
+    expected = consume(batched(states.validate(sequences.validate(make_messages()))))
+    assert consume(validated_batches(make_messages())) == expected
+    # A retried batch is grouped with the rolled back attempt that preceded
+    # it, since they share a publisher and batch identifier.
+    assert [outcome for _, _, outcome in expected] == [TransactionAborted, TransactionCancelled, None]
+
+
+def test_skips_duplicates():
+    messages = list(make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'commit_operation': commit},
+    ]))
+    messages.insert(2, reserialize(messages[1]))
+
+    ((received_batch_identifier, mutations, outcome),) = consume(validated_batches(messages))
+    assert received_batch_identifier == batch_identifier
+    assert mutations == [mutation]
+    assert outcome is None
+
+
+def test_repeated_sequence():
+    messages = list(make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'mutation_operation': copy(mutation, id=2)},
+    ]))
+    messages[2].header.sequence = 1
+
+    with pytest.raises(RepeatedSequenceError):
+        consume(validated_batches(messages))
+
+
+def test_sequence_gap():
+    messages = list(make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+    ]))
+    messages[1].header.sequence = 2
+
+    with pytest.raises(SequencingError):
+        consume(validated_batches(messages))
+
+
+def test_invalid_start_state():
+    messages = make_batch_messages(batch_identifier, [
+        {'mutation_operation': mutation},
+    ])
+
+    with pytest.raises(InvalidEventError):
+        consume(validated_batches(messages))
+
+
+def test_batch_not_advanced():
+    messages = make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'commit_operation': commit},
+        {'begin_operation': begin},
+    ])
+
+    with pytest.raises(InvalidBatch):
+        consume(validated_batches(messages))
+
+
+def test_early_exit():
+    messages = make_batch_messages(batch_identifier, [
+        {'begin_operation': begin},
+        {'mutation_operation': mutation},
+        {'commit_operation': commit},
+    ])
+    batches = validated_batches(messages)
+
+    received_batch_identifier, mutations = next(batches)
+    with pytest.raises(StopIteration):
+        next(batches)
+
+    # The unconsumed batch was skipped, so the iterator is no longer valid.
+    with pytest.raises(TransactionAborted):
+        next(mutations)
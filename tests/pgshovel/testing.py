@@ -0,0 +1,202 @@
+import itertools
+from Queue import Queue
+
+from pgshovel.administration import initialize_cluster
+from pgshovel.cluster import Cluster
+from pgshovel.interfaces.configurations_pb2 import ReplicationSetConfiguration
+from pgshovel.relay.relay import (
+    AdaptiveBatching,
+    Relay,
+    Worker,
+    get_batch_events_query,
+)
+from pgshovel.streams import (
+    sequences,
+    states,
+)
+from pgshovel.streams.batches import batched
+from pgshovel.testing import (
+    CountingHandler,
+    FakeServer,
+    FakeZooKeeper,
+    generate_events,
+)
+from pgshovel.utilities.protobuf import BinaryCodec
+from tests.pgshovel.relay import (
+    QueueHandler,
+    get_events,
+    unwrap_transaction,
+)
+
+
+def create_cluster():
+    cluster = Cluster('test', FakeZooKeeper())
+    cluster.start()
+    initialize_cluster(cluster)
+    return cluster
+
+
+def create_set(cluster, name, dsn):
+    configuration = ReplicationSetConfiguration()
+    configuration.database.dsn = dsn
+    cluster.zookeeper.create(
+        cluster.get_set_path(name),
+        BinaryCodec(ReplicationSetConfiguration).encode(configuration),
+    )
+
+
+def test_data_watch():
+    zookeeper = FakeZooKeeper()
+    zookeeper.start()
+
+    calls = []
+    zookeeper.DataWatch('/node', lambda data, stat: calls.append(data))
+    assert calls == [None]
+
+    zookeeper.create('/node', 'a')
+    zookeeper.set('/node', 'b')
+    assert calls == [None, 'a', 'b']
+
+    zookeeper.delete('/node')
+    assert calls == [None, 'a', 'b', None]
+
+
+def test_transaction():
+    zookeeper = FakeZooKeeper()
+    zookeeper.create('/node', 'a')
+
+    transaction = zookeeper.transaction()
+    transaction.set_data('/node', 'b')
+    transaction.check('/node', version=0)  # previous version
+    results = transaction.commit()
+    assert isinstance(results[1], Exception)
+    assert zookeeper.get('/node')[0] == 'a'
+
+
+def test_worker():
+    cluster = create_cluster()
+
+    server = FakeServer()
+    queue = server.create_queue(
+        cluster.get_queue_name('example'),
+        source=[generate_events(3)],
+    )
+
+    messages = Queue()
+    worker = Worker(cluster, 'fake://', 'example', 'consumer', QueueHandler(messages), server.get_database)
+    worker.start()
+
+    events = get_events(messages, 5)
+    assert len(unwrap_transaction(events)) == 3
+
+    worker.stop_async()
+    worker.result(1)
+
+    # Ensure the published stream is valid.
+    batches = list(batched(states.validate(sequences.validate(events))))
+    assert len(batches) == 1
+
+    # The batch should have been finished, and not be returned to the
+    # consumer again.
+    (consumer,) = queue.consumers.values()
+    assert consumer.batch is None and consumer.tick == queue.ticks[-1].id
+
+
+def test_relay():
+    cluster = create_cluster()
+
+    server = FakeServer()
+    server.create_queue(
+        cluster.get_queue_name('example'),
+        source=itertools.repeat(list(generate_events(5)), 10),
+    )
+
+    create_set(cluster, 'example', 'fake://')
+
+    handler = CountingHandler()
+    relay = Relay(cluster, 'example', 'consumer', handler, throttle=0.1, database_factory=server.get_database)
+    relay.start()
+
+    assert handler.wait(10, timeout=5)
+    assert handler.mutations == 50
+
+    relay.stop_async()
+    relay.result(1)
+
+
+def test_adaptive_batching():
+    batching = AdaptiveBatching(max_events=100, target_latency=1.0, max_latency=5.0)
+    assert batching.get_parameters() == (None, None, None)
+
+    # Batches grow while the relay is behind, up to the maximum.
+    batching.update(30, 10.0)
+    assert batching.get_parameters() == (None, 60, 5.0)
+    batching.update(60, 10.0)
+    assert batching.get_parameters() == (None, 100, 5.0)
+
+    # Batches shrink once the relay has caught up.
+    batching.update(100, 0.5)
+    batching.update(10, 0.5)
+    assert batching.get_parameters() == (None, 25, 5.0)
+    for _ in xrange(5):
+        batching.update(10, 0.5)
+    assert batching.get_parameters() == (None, None, None)
+
+
+def test_worker_adaptive_batching():
+    cluster = create_cluster()
+
+    server = FakeServer()
+    queue = server.create_queue(cluster.get_queue_name('example'))
+
+    # Register the consumer before creating a backlog of ticks to consume.
+    state = {}
+    server.register_consumer(state, queue.name, 'consumer')
+    server.commit(state)
+    for _ in xrange(20):
+        queue.tick(list(generate_events(5)))
+
+    handler = CountingHandler()
+    batching = AdaptiveBatching(target_latency=0)
+    worker = Worker(cluster, 'fake://', 'example', 'consumer', handler, server.get_database, batching)
+    worker.start()
+
+    assert handler.wait(mutations=100, timeout=5)
+
+    worker.stop_async()
+    worker.result(1)
+
+    # The first batch is a single tick, after which the remaining backlog is
+    # combined into one batch.
+    assert handler.commits == 2
+    assert batching.min_events == 190
+
+
+def test_worker_tables():
+    cluster = create_cluster()
+
+    server = FakeServer()
+    tables = (('public', 'a'), ('public', 'b'))
+    server.create_queue(
+        cluster.get_queue_name('example'),
+        source=[generate_events(6, tables=tables)],
+    )
+
+    messages = Queue()
+    worker = Worker(cluster, 'fake://', 'example', 'consumer', QueueHandler(messages), server.get_database, tables=[('public', 'a')])
+    worker.start()
+
+    events = get_events(messages, 5)
+    mutations = unwrap_transaction(events)
+    assert [(mutation.schema, mutation.table) for mutation in mutations] == [('public', 'a')] * 3
+
+    worker.stop_async()
+    worker.result(1)
+
+    assert messages.empty()
+
+    # The events for other tables are excluded by the database.
+    statement, parameters = get_batch_events_query(1, [('public', 'b'), ('public', 'a')])
+    assert 'ev_extra2' in statement
+    assert parameters == (1, (('public', 'a'), ('public', 'b')))
+    assert get_batch_events_query(1) == get_batch_events_query(1, ())
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from pgshovel.utilities.postgresql import (
+    managed,
+    raise_first_exception,
+    run_concurrently,
+)
+
+
+class FakeTransaction(object):
+    def __init__(self, name, barrier=None, fail=None):
+        self.name = name
+        self.barrier = barrier
+        self.fail = fail
+        self.operations = []
+
+    def __perform(self, operation):
+        if self.barrier is not None and operation == 'prepare':
+            # Ensure that all transactions are being prepared concurrently.
+            self.barrier.wait()
+        if operation == self.fail:
+            raise ValueError('could not %s %s' % (operation, self.name))
+        self.operations.append(operation)
+
+    def prepare(self):
+        self.__perform('prepare')
+
+    def commit(self):
+        self.__perform('commit')
+
+    def rollback(self):
+        self.__perform('rollback')
+
+
+class Barrier(object):
+    def __init__(self, parties):
+        self.parties = parties
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.count += 1
+            self.condition.notify_all()
+            deadline = time.time() + 5
+            while self.count < self.parties and time.time() < deadline:
+                self.condition.wait(0.1)
+            assert self.count >= self.parties, 'timed out waiting for other parties'
+
+
+def test_run_concurrently():
+    results = run_concurrently(lambda value: 10 / value, [1, 2, 0, 5])
+    assert [item for item, future in results] == [1, 2, 0, 5]
+    with pytest.raises(ZeroDivisionError):
+        raise_first_exception(results)
+
+    assert raise_first_exception(run_concurrently(lambda value: value * 2, [1, 2])) == [2, 4]
+    assert run_concurrently(lambda value: value, []) == []
+
+
+def test_managed_commit():
+    barrier = Barrier(3)
+    transactions = [FakeTransaction(name, barrier) for name in 'abc']
+    with managed(transactions):
+        pass
+
+    for transaction in transactions:
+        assert transaction.operations == ['prepare', 'commit']
+
+
+def test_managed_block_failure():
+    transactions = [FakeTransaction(name) for name in 'abc']
+    with pytest.raises(KeyError):
+        with managed(transactions):
+            raise KeyError('failure')
+
+    for transaction in transactions:
+        assert transaction.operations == ['prepare', 'rollback']
+
+
+def test_managed_prepare_failure():
+    transactions = [FakeTransaction('a'), FakeTransaction('b', fail='prepare'), FakeTransaction('c')]
+
+    executed = []
+    with pytest.raises(ValueError):
+        with managed(transactions):
+            executed.append(True)
+
+    assert not executed
+    assert [transaction.operations for transaction in transactions] == [
+        ['prepare', 'rollback'],
+        [],
+        ['prepare', 'rollback'],
+    ]
+
+
+def test_managed_commit_failure():
+    transactions = [FakeTransaction('a', fail='commit'), FakeTransaction('b')]
+    with pytest.raises(ValueError):
+        with managed(transactions):
+            pass
+
+    # The remaining transactions are still committed.
+    assert [transaction.operations for transaction in transactions] == [
+        ['prepare'],
+        ['prepare', 'commit'],
+    ]
@@ -0,0 +1,17 @@
+import pytest
+
+from pgshovel.utilities.protobuf import (
+    decode_varint,
+    encode_varint,
+)
+
+
+def test_varint():
+    for value in (0, 1, 127, 128, 300, 2 ** 32, 2 ** 64 - 1):
+        encoded = encode_varint(value)
+        assert decode_varint('x' + encoded + 'y', 1) == (value, len(encoded) + 1)
+
+    assert encode_varint(300) == '\xac\x02'
+
+    with pytest.raises(IndexError):
+        decode_varint(encode_varint(300)[:1])